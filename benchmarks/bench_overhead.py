@@ -0,0 +1,336 @@
+"""Benchmarks for the overhead of ox_profile itself.
+
+This script builds synthetic thread and stack workloads and measures:
+
+  1. sample: per-sample latency of `Sampler.run` vs. the number of threads
+     and their stack depth.
+  2. memory: memory held by a `CountingRecorder` vs. number of distinct
+     stacks recorded.
+  3. query: latency of `CountingRecorder.query` vs. number of distinct
+     stacks.
+  4. slowdown: throughput slowdown of a reference CPU-bound workload
+     when profiled at various sampling intervals.
+
+Results are printed as a table and can be saved as JSON via `--json` so
+that you can later compare a new run against a saved baseline via
+`--compare` to catch regressions in the hot paths. For example:
+
+    python benchmarks/bench_overhead.py --json baseline.json
+    # ... change some code ...
+    python benchmarks/bench_overhead.py --compare baseline.json
+
+The `--quick` flag uses smaller workloads for a fast smoke test.
+"""
+
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from ox_profile.core import (  # pylint: disable=wrong-import-position
+    launchers, recording, sampling)
+
+
+class SyntheticMeasurement(object):
+    """Stand-in for a Measurement with a given name (no frame needed).
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+
+def make_stack_names(num_stacks, depth=20, num_funcs=500):
+    """Return list of num_stacks distinct synthetic stack names.
+
+    Stacks share a common prefix (like a server loop would) and differ
+    towards the leaf so the names look like real profiles.
+    """
+    prefix = ['main(server)', 'serve_forever(socketserver)',
+              'handle(wsgi)', 'dispatch(app)']
+    names = []
+    for i in range(num_stacks):
+        body = ['func_%i(mod_%i)' % ((i * 7 + j * 13) % num_funcs, j % 17)
+                for j in range(depth - len(prefix) - 1)]
+        names.append(';'.join(prefix + body + ['leaf_%i(leaves)' % i]))
+    return names
+
+
+def _park(depth, ready, release):
+    "Recurse to given depth and then wait until release is set."
+    if depth <= 1:
+        ready.release()
+        release.wait()
+        return
+    _park(depth - 1, ready, release)
+
+
+class ParkedThreads(object):
+    """Context manager to run threads parked at a given stack depth.
+    """
+
+    def __init__(self, num_threads, depth):
+        self.num_threads = num_threads
+        self.depth = depth
+        self.release = threading.Event()
+        self.threads = []
+
+    def __enter__(self):
+        ready = threading.Semaphore(0)
+        for dummy in range(self.num_threads):
+            my_thread = threading.Thread(target=_park, args=(
+                self.depth, ready, self.release), daemon=True)
+            my_thread.start()
+            self.threads.append(my_thread)
+        for dummy in range(self.num_threads):
+            ready.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release.set()
+        for my_thread in self.threads:
+            my_thread.join()
+
+
+def summarize(times):
+    "Return dict summarizing list of times in seconds."
+    times = sorted(times)
+    return {'mean': sum(times) / len(times),
+            'median': times[len(times) // 2],
+            'p95': times[min(len(times) - 1, int(len(times) * .95))],
+            'min': times[0]}
+
+
+def bench_sample(thread_counts, depths, reps, cache_sizes=(0, 20000)):
+    "Measure per-sample latency of Sampler.run."
+    results = []
+    for num_threads in thread_counts:
+        for depth in depths:
+            with ParkedThreads(num_threads, depth):
+                for cache_size in cache_sizes:
+                    sampler = sampling.Sampler(recording.CountingRecorder(),
+                                               cache_size=cache_size)
+                    sampler.run()  # warm up
+                    times = []
+                    for dummy in range(reps):
+                        start = time.perf_counter()
+                        sampler.run()
+                        times.append(time.perf_counter() - start)
+                    results.append(dict(
+                        bench='sample', threads=num_threads, depth=depth,
+                        cache=cache_size, **summarize(times)))
+    return results
+
+
+def bench_memory(stack_counts):
+    """Measure memory used by a CountingRecorder holding distinct stacks.
+
+    We build the stack names inside the traced window (and drop
+    everything but the recorder before measuring) so the result counts
+    the names the recorder keeps as well as its dict. The 'name_bytes'
+    entry shows how much of that is the names themselves.
+    """
+    results = []
+    for num_stacks in stack_counts:
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        recorder = recording.CountingRecorder()
+        for name in make_stack_names(num_stacks):
+            recorder.record(SyntheticMeasurement(name))
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        name_bytes = sum(sys.getsizeof(name) for name in recorder.my_db)
+        results.append({'bench': 'memory', 'stacks': num_stacks,
+                        'bytes': after - before, 'name_bytes': name_bytes,
+                        'bytes_per_stack': (after - before) / num_stacks})
+        del recorder
+    return results
+
+
+def bench_query(stack_counts, reps, re_filter='.*'):
+    "Measure latency of CountingRecorder.query vs. distinct stacks."
+    results = []
+    for num_stacks in stack_counts:
+        recorder = recording.CountingRecorder()
+        for name in make_stack_names(num_stacks):
+            recorder.record(SyntheticMeasurement(name))
+        times = []
+        for dummy in range(reps):
+            start = time.perf_counter()
+            recorder.query(re_filter=re_filter, max_records=100)
+            times.append(time.perf_counter() - start)
+        results.append(dict(bench='query', stacks=num_stacks,
+                            re_filter=re_filter, **summarize(times)))
+    return results
+
+
+def reference_workload(size):
+    "Reference CPU-bound workload used to measure throughput slowdown."
+    total = 0.0
+    for i in range(size):
+        total += math.sqrt(i) * math.sin(i)
+    return total
+
+
+def _time_workload(size, reps):
+    "Return best time out of reps runs of reference_workload."
+    return min(_timed(reference_workload, size) for dummy in range(reps))
+
+
+def _timed(func, *args):
+    "Return time taken to call func(*args)."
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def bench_slowdown(intervals, size, reps, engines=('thread',)):
+    "Measure slowdown of reference workload at various sampling intervals."
+    results = []
+    baseline = _time_workload(size, reps)
+    for engine in engines:
+        for interval in intervals:
+            if engine == 'signal':
+                launcher = launchers.SignalLauncher(interval=interval)
+            else:
+                launcher = launchers.SimpleLauncher(interval=interval)
+            launcher.start()
+            launcher.unpause()
+            try:
+                elapsed = _time_workload(size, reps)
+            finally:
+                launcher.pause()
+                launcher.cancel()
+            launcher.unpause()  # let the thread see cancel and exit
+            launcher.join()
+            results.append({'bench': 'slowdown', 'engine': engine,
+                            'interval': interval, 'baseline': baseline,
+                            'time': elapsed, 'slowdown': elapsed / baseline,
+                            'samples': launcher.tracker.calls})
+    return results
+
+
+def run_all(args):
+    "Run all requested benchmarks and return list of result dicts."
+    results = []
+    if 'sample' in args.benches:
+        results.extend(bench_sample(args.threads, args.depths, args.reps,
+                                    args.cache_sizes))
+    if 'memory' in args.benches:
+        results.extend(bench_memory(args.stacks))
+    if 'query' in args.benches:
+        results.extend(bench_query(args.stacks, max(1, args.reps // 10)))
+    if 'slowdown' in args.benches:
+        engines = ['thread']
+        if hasattr(launchers.signal, 'setitimer'):
+            engines.append('signal')
+        results.extend(bench_slowdown(
+            args.intervals, args.workload_size, 3, engines))
+    return results
+
+
+#: Metric to compare for each bench and whether larger is worse.
+REGRESSION_METRICS = {'sample': 'median', 'memory': 'bytes',
+                      'query': 'median', 'slowdown': 'slowdown'}
+#: Keys which identify a benchmark case.
+CASE_KEYS = ('bench', 'threads', 'depth', 'cache', 'stacks', 're_filter',
+             'engine', 'interval')
+
+
+def case_key(item):
+    "Return tuple identifying the benchmark case for item."
+    return tuple((k, item[k]) for k in CASE_KEYS if k in item)
+
+
+def compare(results, baseline, tolerance):
+    """Compare results to baseline and return list of regression messages.
+    """
+    old = {case_key(item): item for item in baseline['results']}
+    problems = []
+    for item in results:
+        prev = old.get(case_key(item))
+        if prev is None:
+            continue
+        metric = REGRESSION_METRICS[item['bench']]
+        if item[metric] > prev[metric] * tolerance:
+            problems.append('%s: %s went from %.6g to %.6g' % (
+                dict(case_key(item)), metric, prev[metric], item[metric]))
+    return problems
+
+
+def format_results(results):
+    "Return human readable string for results."
+    lines = []
+    for item in results:
+        lines.append('  '.join('%s=%s' % (key, (
+            '%.6g' % value) if isinstance(value, float) else value)
+                               for key, value in item.items()))
+    return '\n'.join(lines)
+
+
+def make_parser():
+    "Make command line parser."
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--benches', nargs='+', default=list(
+        REGRESSION_METRICS), choices=list(REGRESSION_METRICS))
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=[1, 50, 500])
+    parser.add_argument('--depths', type=int, nargs='+', default=[10, 200])
+    parser.add_argument('--cache-sizes', type=int, nargs='+',
+                        default=[0, 20000], help=(
+                            'Sampler stack cache sizes (0 disables).'))
+    parser.add_argument('--stacks', type=int, nargs='+',
+                        default=[100, 1000, 10000, 100000])
+    parser.add_argument('--intervals', type=float, nargs='+',
+                        default=[.01, .001, .0001])
+    parser.add_argument('--workload-size', type=int, default=1000000)
+    parser.add_argument('--reps', type=int, default=100)
+    parser.add_argument('--quick', action='store_true', help=(
+        'Use small workloads for a fast smoke test.'))
+    parser.add_argument('--json', help='Path to write JSON results to.')
+    parser.add_argument('--compare', help=(
+        'Path to baseline JSON results to check for regressions.'))
+    parser.add_argument('--tolerance', type=float, default=1.25, help=(
+        'Ratio to baseline above which we report a regression.'))
+    return parser
+
+
+def main(argv=None):
+    "Main function to run benchmarks."
+    args = make_parser().parse_args(argv)
+    if args.quick:
+        args.threads, args.depths = [1, 20], [10, 50]
+        args.stacks, args.intervals = [100, 2000], [.001]
+        args.workload_size, args.reps = 100000, 10
+    results = run_all(args)
+    print(format_results(results))
+    output = {'meta': {'python': platform.python_version(),
+                       'implementation': platform.python_implementation(),
+                       'platform': platform.platform(),
+                       'time': time.time()},
+              'results': results}
+    if args.json:
+        with open(args.json, 'w') as my_fd:
+            json.dump(output, my_fd, indent=2)
+    if args.compare:
+        with open(args.compare) as my_fd:
+            problems = compare(results, json.load(my_fd), args.tolerance)
+        if problems:
+            print('Regressions found:\n  ' + '\n  '.join(problems))
+            return 1
+        print('No regressions found.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
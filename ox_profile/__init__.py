@@ -219,3 +219,16 @@ Thus you should consider statistical profiling as a tool to find the
 relatively slow issues in production and not a tool for optimizing
 issues faster than about a millisecond.
 """
+
+
+def __getattr__(name):
+    """Import profile_block when first used.
+
+    This keeps `import ox_profile.middleware` (and other light modules)
+    from importing the sampler and its dependencies.
+    """
+    if name == 'profile_block':
+        # pylint: disable=import-outside-toplevel
+        from ox_profile.core.blocks import profile_block
+        return profile_block
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
@@ -0,0 +1,12 @@
+"""Allow running ox_profile via `python -m ox_profile`.
+
+See ox_profile.cli for details.
+"""
+
+import sys
+
+from ox_profile.cli import main
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,435 @@
+"""Control agent to profile a running process over a Unix socket.
+
+Processes without a web UI (workers, consumers, cron jobs) can start an
+agent thread at startup with
+
+    from ox_profile import agent
+    agent.start_agent()
+
+The agent listens on a Unix domain socket named after the process id
+(see `socket_path`) which only the same user can connect to. It does
+nothing until someone connects: no launcher thread is started and no
+samples are taken. From a shell on the same machine you can then do
+
+    python -m ox_profile.agent 1234 start --interval .005
+    python -m ox_profile.agent 1234 show
+    python -m ox_profile.agent 1234 delta -o more.folded
+    python -m ox_profile.agent 1234 pause
+
+where 1234 is the process id. The commands are
+
+  - status: show whether profiling is running, the interval and size,
+  - start [interval]: start (or unpause) the sampling launcher,
+  - pause: pause sampling,
+  - interval <seconds>: change the sampling interval,
+  - show [limit]: show the top functions as text,
+  - delta [client]: get the hits recorded since the previous delta for
+    the same client name in a compact binary encoding (see
+    `encode_delta`); the command line client prints it as folded stacks,
+  - reset: forget everything recorded so far.
+
+The protocol is one request line of text per connection answered by a
+1 byte status (0 for success), a 4 byte big-endian length and a body
+(JSON for status, UTF-8 text for errors and show, binary for delta).
+
+>>> from ox_profile.agent import encode_delta, decode_delta
+>>> data = encode_delta([('main;work', 3), ('main;idle', 1)])
+>>> len(data)
+25
+>>> decode_delta(data)
+[('main;work', 3), ('main;idle', 1)]
+"""
+
+import argparse
+import atexit
+import json
+import logging
+import os
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import threading
+
+from ox_profile.core import launchers
+
+
+DELTA_MAGIC = b'OXD1'
+OK, ERROR = 0, 1
+
+
+def socket_path(pid=None, directory=None):
+    """Return path of the agent socket for process pid (default is ours).
+    """
+    return os.path.join(directory or tempfile.gettempdir(),
+                        'ox_profile.%i.sock' % (
+                            os.getpid() if pid is None else int(pid)))
+
+
+def _varint(value):
+    "Return bytes for a non-negative int as a base 128 varint."
+    result = bytearray()
+    while value > 0x7f:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def _read_varint(data, pos):
+    "Return (value, new_pos) for the varint at data[pos:]."
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def encode_delta(stacks):
+    """Encode (stack name, hits) pairs compactly.
+
+    :param stacks:   Iterable of (name, hits) where name is the
+                     semi-colon separated list of functions.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Bytes with DELTA_MAGIC then, as varints, the number of
+              stacks and for each stack the number of frames, a symbol
+              reference for each frame and the hits. A symbol reference
+              is 2*index+1 for a symbol we already sent and 2*length for
+              a new symbol whose UTF-8 text follows. Functions appear in
+              many stacks so each name is sent once.
+
+    """
+    symbols = {}
+    stacks = list(stacks)
+    out = [DELTA_MAGIC, _varint(len(stacks))]
+    for name, hits in stacks:
+        frames = name.split(';')
+        out.append(_varint(len(frames)))
+        for fname in frames:
+            index = symbols.get(fname)
+            if index is None:
+                symbols[fname] = len(symbols)
+                text = fname.encode('utf8')
+                out.append(_varint(2 * len(text)))
+                out.append(text)
+            else:
+                out.append(_varint(2 * index + 1))
+        out.append(_varint(hits))
+    return b''.join(out)
+
+
+def decode_delta(data):
+    """Decode bytes from `encode_delta` into a list of (name, hits).
+    """
+    if data[:len(DELTA_MAGIC)] != DELTA_MAGIC:
+        raise ValueError('Data does not start with %r' % DELTA_MAGIC)
+    symbols, result = [], []
+    count, pos = _read_varint(data, len(DELTA_MAGIC))
+    for dummy in range(count):
+        depth, pos = _read_varint(data, pos)
+        frames = []
+        for dummy_frame in range(depth):
+            ref, pos = _read_varint(data, pos)
+            if ref & 1:
+                frames.append(symbols[ref >> 1])
+            else:
+                text = data[pos:pos + (ref >> 1)].decode('utf8')
+                pos += ref >> 1
+                symbols.append(text)
+                frames.append(text)
+        hits, pos = _read_varint(data, pos)
+        result.append((';'.join(frames), hits))
+    return result
+
+
+def _parse_interval(text):
+    "Return text as a sampling interval (raising ValueError if invalid)."
+    interval = float(text)
+    if not 0 < interval < 10:  # same limits as SimpleLauncher.set_interval
+        raise ValueError('Interval %s is not between 0 and 10 seconds' % text)
+    return interval
+
+
+class Agent(threading.Thread):
+    """Thread serving control requests on a Unix socket (see module doc).
+    """
+
+    def __init__(self, launcher=None, path=None, max_clients=16):
+        """Initializer.
+
+        :param launcher=None:   `launchers.SimpleLauncher` to control. If
+                                None, we make one when first asked to
+                                start.
+
+        :param path=None:       Path for the socket (default is from
+                                `socket_path`).
+
+        :param max_clients=16:  Maximum client names to keep delta
+                                baselines for.
+
+        """
+        threading.Thread.__init__(self, name='ox_profile_agent')
+        self.daemon = True
+        self.launcher = launcher
+        self.path = path or socket_path()
+        self.max_clients = max_clients
+        self.baselines = {}  # client name -> {stack name: hits} at last delta
+        self.stopped = threading.Event()
+        self.server = None
+
+    def listen(self):
+        """Create the listening socket (only the owner may connect).
+        """
+        if os.path.exists(self.path) and stat.S_ISSOCK(
+                os.stat(self.path).st_mode):
+            os.remove(self.path)  # left over from an earlier process
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        os.chmod(self.path, 0o600)  # before listen so nobody else gets in
+        server.listen(4)
+        self.server = server
+
+    def run(self):
+        """Accept and handle connections until `stop` is called.
+
+        *IMPORTANT*:  This is a *thread* so call `self.start()`.
+        """
+        if self.server is None:
+            self.listen()
+        while not self.stopped.is_set():
+            try:
+                conn, dummy_addr = self.server.accept()
+            except OSError:
+                break
+            with conn:
+                if not self.stopped.is_set():
+                    self.serve(conn)
+        self.server.close()
+
+    def stop(self):
+        """Stop the agent thread and remove its socket.
+        """
+        self.stopped.set()
+        try:  # connect to wake up accept
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+                conn.connect(self.path)
+        except OSError:
+            pass
+        if self.is_alive():
+            self.join()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def serve(self, conn):
+        """Read one request line from conn and send the response.
+        """
+        conn.settimeout(5)
+        try:
+            request = conn.makefile('rb').readline(4096).decode('utf8')
+            body = self.handle(request.split())
+            status = OK
+        except Exception as problem:  # pylint: disable=broad-except
+            logging.warning('ox_profile agent request failed: %s', problem)
+            status, body = ERROR, str(problem)
+        if isinstance(body, dict):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode('utf8')
+        try:
+            conn.sendall(struct.pack('>BI', status, len(body)) + body)
+        except OSError as problem:
+            logging.warning('ox_profile agent could not reply: %s', problem)
+
+    def get_launcher(self):
+        "Return self.launcher (making one if necessary)."
+        if self.launcher is None:
+            self.launcher = launchers.SimpleLauncher()
+        return self.launcher
+
+    def handle(self, words):
+        """Handle the command in the list of words and return the result.
+
+        :return:  A dict (sent as JSON), string or bytes. Raises
+                  ValueError for a bad command.
+
+        """
+        command, args = (words[0], words[1:]) if words else ('status', [])
+        handler = getattr(self, 'do_%s' % command, None)
+        if handler is None:
+            raise ValueError('Unknown command %r' % command)
+        return handler(*args)
+
+    def do_status(self):
+        "Return dict describing the state of profiling."
+        launcher = self.launcher
+        result = {'pid': os.getpid(), 'running': False, 'interval': None,
+                  'stacks': 0}
+        if launcher is not None:
+            result.update(
+                running=launcher.is_alive() and not launcher.is_paused(),
+                interval=launcher.interval,
+                stacks=len(launcher.sampler.my_db.my_db))
+        return result
+
+    def do_start(self, interval=None):
+        "Start (or unpause) sampling; optionally set the interval first."
+        launcher = self.get_launcher()
+        if interval is not None:
+            launcher.set_interval(_parse_interval(interval))
+        if not launcher.is_alive():
+            launcher.start()
+        launcher.unpause()
+        return self.do_status()
+
+    def do_pause(self):
+        "Pause sampling."
+        if self.launcher is not None:
+            self.launcher.pause()
+        return self.do_status()
+
+    def do_interval(self, interval):
+        "Set the sampling interval."
+        self.get_launcher().set_interval(_parse_interval(interval))
+        return self.do_status()
+
+    def do_show(self, limit='20'):
+        "Return text showing the top functions."
+        return self.get_launcher().show(limit=int(limit))
+
+    def do_delta(self, client='default'):
+        """Return encode_delta of hits since the last delta for client.
+
+        If a stack has fewer hits than before (the recorder was reset),
+        we count all its hits as new.
+        """
+        stacks = self.get_launcher().sampler.my_db.stacks()
+        baseline = self.baselines.pop(client, {})
+        changed = []
+        for name, hits in stacks:
+            old = baseline.get(name, 0)
+            if hits != old:
+                changed.append((name, hits - old if hits > old else hits))
+        if len(self.baselines) >= self.max_clients:
+            self.baselines.pop(next(iter(self.baselines)))
+        self.baselines[client] = dict(stacks)
+        return encode_delta(changed)
+
+    def do_reset(self):
+        "Forget recorded stacks and delta baselines."
+        launcher = self.get_launcher()
+        launcher.sampler.my_db.reset()
+        launcher.tracker.reset()
+        self.baselines = {}
+        return self.do_status()
+
+
+_AGENT = []  # the agent started by start_agent (if any)
+
+
+def start_agent(launcher=None, path=None):
+    """Start an `Agent` for this process (if one is not already running).
+
+    :param launcher=None, path=None:  As for `Agent`.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  The running Agent. We stop it (and remove the socket) when
+              the process exits.
+
+    """
+    if _AGENT and _AGENT[0].is_alive():
+        return _AGENT[0]
+    my_agent = Agent(launcher, path)
+    my_agent.listen()
+    my_agent.start()
+    _AGENT[:] = [my_agent]
+    atexit.register(my_agent.stop)
+    return my_agent
+
+
+def request(pid, command, path=None, timeout=30):
+    """Send command to the agent of process pid and return the response.
+
+    :param pid:      Process id of the target (ignored if path is given).
+
+    :param command:  Command line such as 'start .005' or 'delta'.
+
+    :param path=None:   Optional path to the socket.
+
+    :param timeout=30:  Seconds to wait for the response.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Response body as bytes. Raises RuntimeError if the agent
+              reported an error.
+
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(timeout)
+        conn.connect(path or socket_path(pid))
+        conn.sendall(command.encode('utf8') + b'\n')
+        reader = conn.makefile('rb')
+        header = reader.read(5)
+        if len(header) < 5:
+            raise RuntimeError('No response from ox_profile agent')
+        status, size = struct.unpack('>BI', header)
+        body = reader.read(size)
+    if status != OK:
+        raise RuntimeError('ox_profile agent error: %s' % body.decode(
+            'utf8', 'replace'))
+    return body
+
+
+def make_parser():
+    "Make command line parser."
+    parser = argparse.ArgumentParser(
+        prog='python -m ox_profile.agent', description=(
+            'Control profiling of a process running an ox_profile agent.'))
+    parser.add_argument('pid', type=int, help='Process id of the target.')
+    parser.add_argument('command', choices=[
+        'status', 'start', 'pause', 'interval', 'show', 'delta', 'reset'])
+    parser.add_argument('args', nargs='*', help=(
+        'Arguments for the command (e.g., seconds for interval).'))
+    parser.add_argument('--interval', help='Sampling interval for start.')
+    parser.add_argument('--client', default='cli', help=(
+        'Client name for delta (each name gets its own deltas).'))
+    parser.add_argument('-o', '--output', help=(
+        'For delta, append folded stacks to this file instead of stdout.'))
+    parser.add_argument('--socket', help='Path to the agent socket.')
+    return parser
+
+
+def main(argv=None):
+    """Main entry point for the agent client.
+    """
+    args = make_parser().parse_args(argv)
+    words = [args.command] + args.args
+    if args.command == 'start' and args.interval:
+        words.append(args.interval)
+    elif args.command == 'delta':
+        words.append(args.client)
+    try:
+        body = request(args.pid, ' '.join(words), args.socket)
+    except (OSError, RuntimeError) as problem:
+        sys.stderr.write('ox_profile.agent: %s\n' % problem)
+        return 1
+    if args.command == 'delta':
+        lines = ['%s %i\n' % item for item in decode_delta(body)]
+        if args.output:
+            with open(args.output, 'a') as my_fd:
+                my_fd.writelines(lines)
+        else:
+            sys.stdout.writelines(lines)
+    else:
+        sys.stdout.write(body.decode('utf8').rstrip('\n') + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,330 @@
+"""Command line interface to profile a whole script or module.
+
+This lets you profile a program without changing its code via something
+like
+
+    python -m ox_profile -o etl.folded my_etl_job.py --some-arg
+    python -m ox_profile --engine signal -m my_package.my_module
+
+The profile is written when the program exits and (on platforms which
+have it) whenever the process receives SIGUSR1 so you can peek at a
+long running job. Use `python -m ox_profile --help` for details.
+"""
+
+import argparse
+import logging
+import os
+import runpy
+import signal
+import socket
+import sys
+import threading
+import time
+
+from ox_profile.core import (
+    exporters, launchers, metrics, recording, sampling, states)
+
+
+def write_text(recorder, my_fd, metadata):
+    """Write profile as the table produced by recorder.show().
+
+    If samples were labelled by state (see the --states option), we also
+    write the table from recorder.show_states().
+    """
+    del metadata
+    my_fd.write(recorder.show(limit=None))
+    records, totals = recorder.query_states(max_records=50)
+    if totals[states.NATIVE] or totals[states.BLOCKED]:
+        my_fd.write('\n%s\n' % states.show_breakdown(records, totals))
+
+
+def write_folded(recorder, my_fd, metadata):
+    "Write profile in the folded stacks format (see CountingRecorder.save)."
+    recorder.save(my_fd, metadata)
+
+
+def write_pprof(recorder, my_fd, metadata):
+    "Write profile in the gzipped pprof format (see exporters.iter_pprof)."
+    exporters.export(recorder, 'pprof', my_fd, metadata)
+
+
+def write_speedscope(recorder, my_fd, metadata):
+    "Write profile in the speedscope JSON format."
+    exporters.export(recorder, 'speedscope', my_fd, metadata)
+
+
+def write_callgrind(recorder, my_fd, metadata):
+    "Write profile in the callgrind format (for KCachegrind)."
+    exporters.export(recorder, 'callgrind', my_fd, metadata)
+
+
+#: Dictionary of output format name to (writer, file mode, extension).
+WRITERS = {
+    'text': (write_text, 'w', 'txt'),
+    'folded': (write_folded, 'w', 'folded'),
+    'pprof': (write_pprof, 'wb', 'pb.gz'),
+    'speedscope': (write_speedscope, 'w', 'speedscope.json'),
+    'callgrind': (write_callgrind, 'w', 'callgrind'),
+    }
+
+
+class ProfileRunner(object):
+    """Run a target script or module under a profiling launcher.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.metadata = dict(
+            [item.split('=', 1) for item in args.label],
+            host=socket.gethostname(), pid=os.getpid(),
+            interval=args.interval,
+            command=' '.join([args.module or args.target] + args.target_args))
+        self.write_lock = threading.Lock()
+        self.launcher = self.make_launcher()
+
+    def make_launcher(self):
+        "Make the launcher based on command line arguments."
+        thread_filter = None
+        if self.args.threads:
+            thread_filter = sampling.ThreadNameFilter(self.args.threads)
+        frame_filter = None
+        if (self.args.max_depth or self.args.drop or self.args.collapse
+                or self.args.collapse_site_packages):
+            frame_filter = metrics.FrameFilter(
+                max_depth=self.args.max_depth, drop_modules=self.args.drop,
+                collapse_packages=self.args.collapse,
+                collapse_site_packages=self.args.collapse_site_packages)
+        sampler = sampling.Sampler(recording.make_recorder(),
+                                   thread_filter=thread_filter,
+                                   frame_filter=frame_filter)
+        if self.args.gil:
+            sampler.enable_gil_estimation()
+        if self.args.states:
+            sampler.enable_state_labels()
+        if self.args.contention:
+            sampler.enable_contention()
+        if self.args.engine == 'signal':
+            return launchers.SignalLauncher(sampler=sampler,
+                                            interval=self.args.interval)
+        return launchers.SimpleLauncher(sampler=sampler,
+                                        interval=self.args.interval)
+
+    def get_output_path(self):
+        "Return path to write the profile to."
+        if self.args.output:
+            return self.args.output
+        return 'ox_profile.%i.%s' % (os.getpid(), WRITERS[
+            self.args.format][2])
+
+    def write(self):
+        """Write the profile to disk.
+
+        We write to a temporary file first and then rename it so readers
+        never see a partially written profile.
+        """
+        writer, mode, dummy_ext = WRITERS[self.args.format]
+        path = self.get_output_path()
+        with self.write_lock:
+            metadata = dict(self.metadata, time=time.time())
+            tmp_path = '%s.tmp' % path
+            with open(tmp_path, mode) as my_fd:
+                writer(self.launcher.sampler.my_db, my_fd, metadata)
+            os.replace(tmp_path, path)
+        logging.info('Wrote profile to %s', path)
+        return path
+
+    def _on_dump_signal(self, signum, frame):
+        "Signal handler to write the profile in a separate thread."
+        del signum, frame
+        threading.Thread(target=self.write, daemon=True).start()
+
+    def run(self):
+        """Run target under the profiler and write the profile at the end.
+        """
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self._on_dump_signal)
+        self.launcher.start()
+        self.launcher.unpause()
+        sys.argv = [self.args.module or self.args.target] + list(
+            self.args.target_args)
+        try:
+            if self.args.module:
+                sys.path.insert(0, os.getcwd())  # as python -m does
+                runpy.run_module(self.args.module, run_name='__main__',
+                                 alter_sys=True)
+            else:
+                sys.path.insert(0, os.path.dirname(os.path.abspath(
+                    self.args.target)))
+                runpy.run_path(self.args.target, run_name='__main__')
+        finally:
+            self.launcher.pause()
+            self.launcher.cancel()
+            self.launcher.unpause()  # so the thread sees cancel and exits
+            self.launcher.join()
+            path = self.write()
+            if not self.args.quiet:
+                sys.stderr.write('ox_profile: wrote profile to %s\n' % path)
+            if self.args.gil:
+                sys.stderr.write(format_gil_report(
+                    self.launcher.sampler.gil_estimator.report(5)))
+            if self.args.contention:
+                sys.stderr.write(format_contention_report(
+                    self.launcher.sampler.contention.report(5)))
+
+
+def format_gil_report(report):
+    "Format result of GILEstimator.report as text."
+    lines = ['ox_profile: GIL utilization %.1f%%, contention %.1f%% (%s)' % (
+        100 * report['gil_utilization'], 100 * report['contention'],
+        ', '.join('%s=%s' % item for item in sorted(
+            report['thread_states'].items())))]
+    for name, count in report['waiting_stacks']:
+        lines.append('  waiting %i: %s' % (count, name))
+    return '\n'.join(lines) + '\n'
+
+
+def format_contention_report(report):
+    "Format result of ContentionProfiler.report as text."
+    lines = ['ox_profile: %i samples blocked on locks over %.3f seconds' % (
+        report['blocked'], report['wall'])]
+    for item in report['locks']:
+        lines.append('  %s (%s): ~%.3f seconds waiting in %i samples' % (
+            item['lock'], item['kind'], item['wait'], item['samples']))
+        if item['tracked']:
+            lines.append('    tracked: %(contended)i of %(acquires)i'
+                         ' acquires waited %(wait).3f seconds' % item[
+                             'tracked'])
+        for name, count in item['waiters'][:1]:
+            lines.append('    waiting %i: %s' % (count, name))
+        for name, count in item['holders'][:1]:
+            lines.append('    holding %i: %s' % (count, name))
+    return '\n'.join(lines) + '\n'
+
+
+def make_parser():
+    "Make command line parser."
+    parser = argparse.ArgumentParser(
+        prog='ox_profile', description=(
+            'Run a python script or module under the ox_profile sampler.'))
+    parser.add_argument('-i', '--interval', type=float, default=.001, help=(
+        'Seconds between samples (CPU seconds for the signal engine).'))
+    parser.add_argument('-e', '--engine', choices=['thread', 'signal'],
+                        default='thread', help=(
+                            'Sampling engine: thread samples all threads'
+                            ' from a background thread; signal uses'
+                            ' setitimer to sample the main thread.'))
+    parser.add_argument('-t', '--threads', help=(
+        'Only sample threads whose name matches this regular expression'
+        ' (e.g., MainThread).'))
+    parser.add_argument('--gil', action='store_true', help=(
+        'Estimate GIL utilization and contention (thread engine only).'))
+    parser.add_argument('--contention', action='store_true', help=(
+        'Report the locks threads most often wait on (thread engine only).'))
+    parser.add_argument('--states', action='store_true', help=(
+        'Label samples as running python, calling native code or blocked'
+        ' (adds a breakdown by state to the text output).'))
+    parser.add_argument('--max-depth', type=int, help=(
+        'Only keep this many frames back from the top of each stack.'))
+    parser.add_argument('--drop', action='append', default=[],
+                        metavar='REGEXP', help=(
+                            'Drop frames whose module matches REGEXP;'
+                            ' may be repeated.'))
+    parser.add_argument('--collapse', action='append', default=[],
+                        metavar='PACKAGE', help=(
+                            'Collapse runs of frames from PACKAGE into one;'
+                            ' may be repeated.'))
+    parser.add_argument('--collapse-site-packages', action='store_true',
+                        help=('Collapse runs of frames from any installed'
+                              ' third-party package.'))
+    parser.add_argument('-f', '--format', choices=sorted(WRITERS),
+                        default='folded', help='Output format.')
+    parser.add_argument('-o', '--output', help=(
+        'Path to write profile to (default ox_profile.<pid>.<ext>).'))
+    parser.add_argument('-l', '--label', action='append', default=[],
+                        metavar='KEY=VALUE', help=(
+                            'Metadata to save with the profile (e.g.,'
+                            ' release=1.2); may be repeated.'))
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='Do not print where the profile was written.')
+    parser.add_argument('-m', dest='module', help=(
+        'Run library module as a script (like python -m).'))
+    parser.add_argument('target', nargs='?', help='Script to run.')
+    parser.add_argument('target_args', nargs=argparse.REMAINDER,
+                        help='Arguments for the script or module.')
+    return parser
+
+
+def split_argv(parser, argv):
+    """Split command line into our options and the target to run.
+
+    :param parser:    Parser from `make_parser`.
+
+    :param argv:      List of command line arguments (without the program).
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  The tuple (options, module, target, target_args) where
+              options are the arguments before '-m MODULE' or the script
+              path, module and target are the module or script (or None)
+              and target_args are all arguments after them.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    PURPOSE:  Like python itself (and cProfile), everything after the
+              module or script belongs to the target even if it looks
+              like one of our options (e.g., -q or --sort-keys), so we
+              only give argparse the part before it.
+
+    >>> from ox_profile import cli
+    >>> cli.split_argv(cli.make_parser(), ['-o', 'x.py', '-m', 'mod', '-q'])
+    (['-o', 'x.py'], 'mod', None, ['-q'])
+    >>> cli.split_argv(cli.make_parser(), ['-q', 'run.py', '-o', 'out'])
+    (['-q'], None, 'run.py', ['-o', 'out'])
+    """
+    with_values = set(
+        option for option, action in (
+            parser._option_string_actions.items())  # pylint: disable=W0212
+        if action.nargs != 0)
+    index = 0
+    while index < len(argv):
+        item = argv[index]
+        if item == '-m':
+            if index + 1 < len(argv):
+                return argv[:index], argv[index + 1], None, argv[index + 2:]
+            break
+        if item.startswith('-m') and not item.startswith('--'):
+            return argv[:index], item[2:], None, argv[index + 1:]
+        if item == '--':
+            if index + 1 < len(argv):
+                return argv[:index], None, argv[index + 1], argv[index + 2:]
+            break
+        if not item.startswith('-') or item == '-':
+            return argv[:index], None, item, argv[index + 1:]
+        if item in with_values:  # value is the next argument
+            index += 1
+        index += 1
+    return argv, None, None, []
+
+
+def main(argv=None):
+    """Main entry point for the command line interface.
+    """
+    parser = make_parser()
+    options, module, target, target_args = split_argv(
+        parser, sys.argv[1:] if argv is None else list(argv))
+    args = parser.parse_args(options)
+    args.module, args.target, args.target_args = module, target, target_args
+    if not (args.module or args.target):
+        parser.error('Must provide a script or -m module to run.')
+    bad_labels = [item for item in args.label if '=' not in item]
+    if bad_labels:
+        parser.error('Labels must look like KEY=VALUE not %s' % bad_labels)
+    if args.engine == 'signal' and (args.threads or args.gil
+                                    or args.contention):
+        parser.error('The signal engine only samples the main thread.')
+    ProfileRunner(args).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
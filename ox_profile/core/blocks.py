@@ -0,0 +1,266 @@
+"""Tools to profile a targeted block of code.
+
+The `SimpleLauncher` samples every thread in the process which is
+great for getting an overall picture but not so great if you want a
+detailed look at one batch job or one expensive call. This module
+provides the `profile_block` function which gives you a `ProfileBlock`
+you can use as either a context manager or a decorator to sample only
+the calling thread (at a high rate) while it is inside the block.
+
+All blocks share a single launcher thread so using many blocks does not
+spawn many threads. The shared launcher stays paused while no blocks
+are active.
+
+>>> import math
+>>> from ox_profile.core.blocks import profile_block
+>>> def busy_func(count):
+...     return sum(math.sqrt(i) for i in range(count))
+...
+>>> with profile_block(interval=.0005) as prof:
+...     dummy = [busy_func(i) for i in range(3000)]
+...
+>>> query, total_records = prof.query(max_records=None)
+>>> print([i.name for i in query if i.name.startswith('busy_func')])
+['busy_func(ox_profile.core.blocks)']
+>>> @profile_block(interval=.0005)
+... def decorated(count):
+...     return [busy_func(i) for i in range(count)]
+...
+>>> dummy = decorated(3000)
+>>> decorated.profile.query()[1] > 0
+True
+"""
+
+import doctest
+import functools
+import sys
+import threading
+
+from ox_profile.core import sampling, recording, launchers
+
+
+class BlockSampler(sampling.Sampler):
+    """Sampler which only samples threads currently inside a ProfileBlock.
+
+    Instead of recording into a single database, each active
+    ProfileBlock has its own recorder and we only record the frames of
+    the threads which registered with that block.
+    """
+
+    def __init__(self, freezer=None):
+        sampling.Sampler.__init__(self, my_db=None, freezer=freezer)
+        self.active_lock = threading.Lock()
+        # Mapping of thread id to tuple of active blocks for that thread.
+        # We replace (instead of mutate) this dict when things change so
+        # that run can read it without taking active_lock.
+        self.active = {}
+
+    def add(self, thread_id, block):
+        """Start sampling thread_id into the given block.
+        """
+        with self.active_lock:
+            active = dict(self.active)
+            active[thread_id] = active.get(thread_id, ()) + (block,)
+            self.active = active
+
+    def remove(self, thread_id, block):
+        """Stop sampling thread_id into the given block.
+        """
+        with self.active_lock:
+            active = dict(self.active)
+            remaining = tuple(b for b in active.get(thread_id, ())
+                              if b is not block)
+            if remaining:
+                active[thread_id] = remaining
+            else:
+                active.pop(thread_id, None)
+            self.active = active
+
+    def get_intervals(self):
+        """Return list of sampling intervals requested by active blocks.
+        """
+        return [b.interval for blocks in self.active.values()
+                for b in blocks]
+
+    def run(self):
+        """Sample frames for threads in active blocks.
+
+        As in `Sampler.record_frames`, if the GIL is disabled we skip
+        (and count in self.torn_stacks) stacks which change while we
+        walk them instead of killing the shared launcher thread.
+        """
+        active = self.active
+        if not active:
+            return
+        measure_tool = self.get_measure_tool()
+        with self.freezer:
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            for thread_id, blocks in active.items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                try:
+                    measurement = measure_tool(frame)
+                except (AttributeError, RuntimeError, ValueError):
+                    if not self.tolerate_torn:
+                        raise
+                    self.torn_stacks += 1  # thread changed stack under us
+                    continue
+                for block in blocks:
+                    block.my_db.record(measurement)
+
+
+class _SharedLauncher(object):
+    """Manage the single launcher thread shared by all ProfileBlocks.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.launcher = None
+
+    def get(self):
+        """Return the shared launcher (creating and starting it if needed).
+        """
+        with self.lock:
+            if self.launcher is None or not self.launcher.is_alive():
+                self.launcher = launchers.SimpleLauncher(
+                    sampler=BlockSampler())
+                self.launcher.name = 'ox_profiler_BlockLauncher_Thread'
+                self.launcher.start()
+            return self.launcher
+
+    def refresh(self):
+        """Set interval and pause/unpause based on the active blocks.
+        """
+        with self.lock:
+            launcher = self.launcher
+            if launcher is None:
+                return
+            intervals = launcher.sampler.get_intervals()
+            if intervals:
+                if min(intervals) != launcher.interval:
+                    launcher.set_interval(min(intervals))
+                launcher.unpause()
+            else:
+                launcher.pause()
+
+
+SHARED_LAUNCHER = _SharedLauncher()
+
+
+class ProfileBlock(object):
+    """Profile results for a block of code.
+
+    Usually you create this via `profile_block` and use it as a context
+    manager or decorator. You can also call `start` and `stop` yourself
+    (e.g., to profile a thread other than the current one). Results
+    accumulate across uses so a decorated function will collect
+    samples from all of its calls.
+    """
+
+    def __init__(self, interval=.0005, recorder=None):
+        """Initializer.
+
+        :param interval=.0005:  How often (in seconds) to sample the thread
+                                while inside the block.
+
+        :param recorder=None:   Optional recorder to record into. If None,
+                                we create a `CountingRecorder`.
+
+        """
+        assert 0 < interval < 10
+        self.interval = interval
+        self.my_db = recorder if recorder is not None else (
+            recording.CountingRecorder())
+        self._depth_lock = threading.Lock()
+        self._depth = {}
+
+    def start(self, thread_id=None):
+        """Start sampling thread_id (default is current thread) into self.
+        """
+        thread_id = threading.get_ident() if thread_id is None else thread_id
+        with self._depth_lock:
+            depth = self._depth.get(thread_id, 0)
+            self._depth[thread_id] = depth + 1
+        if depth == 0:
+            SHARED_LAUNCHER.get().sampler.add(thread_id, self)
+            SHARED_LAUNCHER.refresh()
+        return self
+
+    def stop(self, thread_id=None):
+        """Stop sampling thread_id (default is current thread) into self.
+        """
+        thread_id = threading.get_ident() if thread_id is None else thread_id
+        with self._depth_lock:
+            depth = self._depth.get(thread_id, 0) - 1
+            if depth > 0:
+                self._depth[thread_id] = depth
+            else:
+                self._depth.pop(thread_id, None)
+        if depth == 0:
+            SHARED_LAUNCHER.get().sampler.remove(thread_id, self)
+            SHARED_LAUNCHER.refresh()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def __call__(self, func):
+        """Use self as a decorator to profile each call to func.
+
+        The wrapped function has a `profile` attribute pointing to self
+        so you can call `func.profile.show()` to see results.
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            "Call wrapped function inside self."
+            with self:
+                return func(*args, **kwargs)
+
+        wrapper.profile = self
+        return wrapper
+
+    def show(self, *args, **kwargs):
+        """Syntactic sugar for calling self.my_db.show(*args, **kwargs).
+
+        Returns string describing results.
+        """
+        return self.my_db.show(*args, **kwargs)
+
+    def query(self, *args, **kwargs):
+        """Syntactic sugar for calling self.my_db.query(*args, **kwargs).
+
+        Returns the pair (result, num_records) as for CountingRecorder.query.
+        """
+        return self.my_db.query(*args, **kwargs)
+
+
+def profile_block(interval=.0005, recorder=None):
+    """Return a ProfileBlock to use as a context manager or decorator.
+
+    :param interval=.0005:  How often (in seconds) to sample the thread
+                            while inside the block.
+
+    :param recorder=None:   Optional recorder (default is a new
+                            `CountingRecorder`).
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  A ProfileBlock instance.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    PURPOSE:  Get high resolution profiles of a single block of code
+              without sampling every thread in the process. See the
+              module docstring for examples.
+
+    """
+    return ProfileBlock(interval=interval, recorder=recorder)
+
+
+if __name__ == '__main__':
+    # Run doctest if file executed as a script
+    doctest.testmod()
+    print('Finished Tests')
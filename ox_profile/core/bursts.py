@@ -0,0 +1,188 @@
+"""Tools to profile only the requests which turn out to be slow.
+
+Sampling every thread at a high rate all the time is too expensive for
+many production servers but the requests you usually care about are
+the rare slow ones. The `BurstProfiler` in this module lets you
+register each request when it starts (via `begin`) and when it ends
+(via `end`). A watcher thread checks the requests in flight and once a
+request has run longer than a threshold, it starts sampling that
+request's thread at a high rate (using a `ProfileBlock`) until the
+request ends. The profile is then kept along with the endpoint and a
+sample id so you can look at recent slow requests later.
+
+For normal (fast) requests, the only cost is adding and removing an
+entry from a dict.
+
+>>> import time
+>>> from ox_profile.core.bursts import BurstProfiler
+>>> bursts = BurstProfiler(threshold=.05, interval=.001)
+>>> def slow_func(seconds):
+...     time.sleep(seconds)
+...
+>>> for seconds in [0, .3]:
+...     sample_id = bursts.begin('my_endpoint')
+...     slow_func(seconds)
+...     dummy = bursts.end(sample_id)
+...
+>>> slow = bursts.get_slow_requests()
+>>> len(slow), slow[0].endpoint, slow[0].duration > .3
+(1, 'my_endpoint', True)
+>>> query, total_records = slow[0].block.query(max_records=None)
+>>> print([i.name for i in query if i.name.startswith('slow_func')])
+['slow_func(ox_profile.core.bursts)']
+>>> bursts.cancel()
+"""
+
+import collections
+import doctest
+import itertools
+import threading
+import time
+
+from ox_profile.core import blocks
+
+
+SlowRequest = collections.namedtuple('SlowRequest', [
+    'sample_id', 'endpoint', 'start_time', 'duration', 'block'])
+
+
+class _InFlight(object):
+    """Information about a request which has started but not ended.
+    """
+
+    __slots__ = ['start', 'start_time', 'endpoint', 'thread_id', 'block']
+
+    def __init__(self, endpoint, thread_id):
+        self.start = time.monotonic()
+        self.start_time = time.time()
+        self.endpoint = endpoint
+        self.thread_id = thread_id
+        self.block = None
+
+
+class BurstProfiler(object):
+    """Profile requests at a high rate once they run longer than a threshold.
+    """
+
+    def __init__(self, threshold=.5, interval=.001, check_interval=None,
+                 max_kept=50):
+        """Initializer.
+
+        :param threshold=.5:  Seconds a request must run before we start
+                              sampling it.
+
+        :param interval=.001:  Sampling interval (in seconds) for slow
+                               requests.
+
+        :param check_interval=None:  How often (in seconds) the watcher
+                                     thread checks requests in flight. If
+                                     None, we use threshold/4 (so sampling
+                                     starts within 25% of the threshold).
+
+        :param max_kept=50:   How many recent slow requests to keep.
+
+        """
+        assert threshold > 0
+        self.threshold = threshold
+        self.interval = interval
+        self.check_interval = check_interval or threshold / 4.0
+        self.lock = threading.Lock()
+        self.in_flight = {}  # sample_id -> _InFlight
+        self.slow = collections.deque(maxlen=max_kept)
+        self.counter = itertools.count(1)
+        self.stop_event = threading.Event()
+        self.watcher = None
+
+    def begin(self, endpoint, thread_id=None):
+        """Note that a request for endpoint started on thread_id.
+
+        :param endpoint:     String name of the endpoint for the request.
+
+        :param thread_id=None:  Id of thread handling the request (default
+                                is the current thread).
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  Integer sample id to pass to `end`.
+
+        """
+        if thread_id is None:
+            thread_id = threading.get_ident()
+        sample_id = next(self.counter)
+        entry = _InFlight(endpoint, thread_id)
+        with self.lock:
+            self.in_flight[sample_id] = entry
+            if self.watcher is None:
+                self.watcher = threading.Thread(
+                    target=self.watch, name='ox_profiler_Burst_Watcher',
+                    daemon=True)
+                self.watcher.start()
+        return sample_id
+
+    def end(self, sample_id):
+        """Note that the request with the given sample_id (from `begin`) ended.
+
+        :return:  A SlowRequest if the request was slow enough to be
+                  profiled and None otherwise.
+
+        """
+        with self.lock:
+            entry = self.in_flight.pop(sample_id, None)
+        if entry is None or entry.block is None:
+            return None
+        entry.block.stop(entry.thread_id)
+        result = SlowRequest(sample_id, entry.endpoint, entry.start_time,
+                             time.monotonic() - entry.start, entry.block)
+        with self.lock:
+            self.slow.append(result)
+        return result
+
+    def check(self):
+        """Start profiling requests in flight for longer than self.threshold.
+
+        This is called periodically by the watcher thread.
+        """
+        cutoff = time.monotonic() - self.threshold
+        with self.lock:
+            for entry in list(self.in_flight.values()):
+                if entry.block is None and entry.start <= cutoff:
+                    # Start while holding self.lock so `end` cannot pop
+                    # the entry before we have a block to stop.
+                    entry.block = blocks.ProfileBlock(self.interval).start(
+                        entry.thread_id)
+
+    def watch(self):
+        """Run the loop for the watcher thread (started by `begin`).
+        """
+        while not self.stop_event.wait(self.check_interval):
+            self.check()
+
+    def get_slow_requests(self):
+        """Return list of recent SlowRequest instances (newest first).
+        """
+        with self.lock:
+            return list(reversed(self.slow))
+
+    def find(self, sample_id):
+        """Return SlowRequest for sample_id or None if we do not have it.
+        """
+        for item in self.get_slow_requests():
+            if item.sample_id == sample_id:
+                return item
+        return None
+
+    def cancel(self):
+        """Stop the watcher thread and any sampling in progress.
+        """
+        self.stop_event.set()
+        with self.lock:
+            in_flight, self.in_flight = self.in_flight, {}
+        for entry in in_flight.values():
+            if entry.block is not None:
+                entry.block.stop(entry.thread_id)
+
+
+if __name__ == '__main__':
+    # Run doctest if file executed as a script
+    doctest.testmod()
+    print('Finished Tests')
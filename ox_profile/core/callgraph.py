@@ -0,0 +1,130 @@
+"""Caller/callee graph of sampled stacks.
+
+Per function totals tell you *what* is hot but not *who calls it* or
+*where the time goes beneath it*. A `CallGraph` keeps, for each pair of
+adjacent frames in the sampled stacks, how many samples went through
+that call (the inclusive weight) and how many were in the callee itself
+(the self weight). Edges are stored by caller and by callee so looking
+up the callers or callees of a function only touches that function's
+edges.
+
+A `CountingRecorder` keeps one of these up to date as stacks come in
+(see `CountingRecorder.callers` and `CountingRecorder.callees`) and
+`exporters.iter_callgrind` builds one to write the callgrind format
+used by KCachegrind and QCachegrind.
+
+>>> from ox_profile.core.callgraph import CallGraph
+>>> graph = CallGraph()
+>>> graph.add(['main', 'render', 'execute'], 3)
+>>> graph.add(['main', 'execute'], 1)
+>>> graph.add(['main', 'render'], 2)
+>>> graph.callers('execute')
+[CallEdge(name='render', inclusive=3, self_hits=3), \
+CallEdge(name='main', inclusive=1, self_hits=1)]
+>>> graph.callees('render')
+[CallEdge(name='execute', inclusive=3, self_hits=3)]
+>>> graph.inclusive['render'], graph.self_hits['render']
+(5, 2)
+"""
+
+import collections
+import doctest
+
+
+CallEdge = collections.namedtuple('CallEdge', ['name', 'inclusive',
+                                               'self_hits'])
+
+
+class CallGraph(object):
+    """Counts of samples through each caller -> callee edge.
+    """
+
+    def __init__(self):
+        self.callee_edges = collections.defaultdict(collections.Counter)
+        self.caller_edges = collections.defaultdict(collections.Counter)
+        self.edge_self = collections.Counter()  # (caller, callee) -> hits
+        self.inclusive = collections.Counter()  # function -> samples in it
+        self.self_hits = collections.Counter()  # function -> samples at top
+        self.total = 0
+
+    def add(self, name_list, hits):
+        """Add hits for a stack.
+
+        :param name_list:   List of function names from the root of the
+                            stack to the top.
+
+        :param hits:        Number of samples with this stack.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Each function and each edge counts at most once per
+                  stack so recursive calls do not count a sample twice
+                  in inclusive weights.
+
+        """
+        self.total += hits
+        seen = set()
+        for index, callee in enumerate(name_list):
+            if callee not in seen:
+                seen.add(callee)
+                self.inclusive[callee] += hits
+            if index:
+                edge = (name_list[index - 1], callee)
+                if edge not in seen:
+                    seen.add(edge)
+                    self.callee_edges[edge[0]][callee] += hits
+                    self.caller_edges[callee][edge[0]] += hits
+        if name_list:
+            self.self_hits[name_list[-1]] += hits
+            if len(name_list) > 1:
+                self.edge_self[(name_list[-2], name_list[-1])] += hits
+
+    def update(self, other):
+        """Add the counts from other CallGraph to self.
+        """
+        for caller, edges in other.callee_edges.items():
+            self.callee_edges[caller].update(edges)
+        for callee, edges in other.caller_edges.items():
+            self.caller_edges[callee].update(edges)
+        self.edge_self.update(other.edge_self)
+        self.inclusive.update(other.inclusive)
+        self.self_hits.update(other.self_hits)
+        self.total += other.total
+
+    def callees(self, name, limit=None):
+        """Return list of CallEdge for functions name calls.
+
+        :param name:        Function name (e.g., 'render(app.views)').
+
+        :param limit=None:  Optional maximum number of edges to return.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  CallEdge tuples sorted by inclusive weight where the
+                  inclusive weight is samples with name calling the callee
+                  and self_hits is samples where the callee was at the top
+                  of the stack and called directly by name.
+
+        """
+        edges = self.callee_edges.get(name)
+        if not edges:
+            return []
+        return [CallEdge(callee, hits, self.edge_self.get((name, callee), 0))
+                for callee, hits in edges.most_common(limit)]
+
+    def callers(self, name, limit=None):
+        """Return list of CallEdge for functions which call name.
+
+        Weights are for the edge from the caller to name (see `callees`).
+        """
+        edges = self.caller_edges.get(name)
+        if not edges:
+            return []
+        return [CallEdge(caller, hits, self.edge_self.get((caller, name), 0))
+                for caller, hits in edges.most_common(limit)]
+
+
+if __name__ == '__main__':
+    # Run doctest if file executed as a script
+    doctest.testmod()
+    print('Finished Tests')
@@ -0,0 +1,204 @@
+"""Columnar representation of recorded stacks for fast aggregation.
+
+The `query` method of `CountingRecorder` loops over every frame of
+every stack in python. For profiles with hundreds of thousands of
+distinct stacks that can take seconds. A `ColumnarProfile` instead
+stores:
+
+  - symbols: list of distinct function names (symbol ids index this),
+  - indptr, indices: the frames of each stack in compressed sparse row
+    (CSR) layout so the symbol ids for stack i (from the root to the
+    top of the stack) are indices[indptr[i]:indptr[i+1]],
+  - counts: hits for each stack.
+
+Totals, regular expression filters (applied once per symbol instead of
+once per occurrence) and top-K selection are then vectorised NumPy
+operations. NumPy is optional (`pip install ox_profile[numpy]`); if it
+is not installed, we use the same layout with python arrays and loops.
+
+>>> from ox_profile.core.columnar import ColumnarProfile
+>>> prof = ColumnarProfile.from_stacks([
+...     ('main;work;sleep', 3), ('main;work', 2), ('main;idle', 1)])
+>>> prof.symbols
+['main', 'work', 'sleep', 'idle']
+>>> prof.query(re_filter='^[mw]')
+([ProfileRecord(name=main, hits=6), ProfileRecord(name=work, hits=5)], 3)
+>>> prof.top(prof.self_totals(), 2)
+[('sleep', 3), ('work', 2)]
+"""
+
+import array
+import doctest
+import functools
+import heapq
+import re
+
+from ox_profile.core import recording
+
+
+@functools.lru_cache(maxsize=None)
+def get_numpy():
+    """Return the numpy module or None if it is not installed.
+
+    We import numpy the first time it is needed (instead of when this
+    module is imported) so importing ox_profile stays cheap.
+    """
+    try:
+        import numpy  # pylint: disable=import-outside-toplevel
+    except ImportError:  # numpy is an optional extra so fall back to python
+        return None
+    return numpy
+
+
+class ColumnarProfile(object):
+    """Stacks and counts stored as arrays (see module docstring).
+    """
+
+    def __init__(self, symbols, indptr, indices, counts, use_numpy=None):
+        """Initializer.
+
+        :param symbols:    List of function names.
+
+        :param indptr:     Sequence of len(counts)+1 offsets into indices.
+
+        :param indices:    Sequence of symbol ids for the frames of stacks.
+
+        :param counts:     Sequence of hits for each stack.
+
+        :param use_numpy=None:  Whether to use numpy (default is to use it
+                                if it is installed).
+
+        """
+        numpy = get_numpy()
+        self.use_numpy = (numpy is not None) if use_numpy is None else (
+            use_numpy)
+        if self.use_numpy:
+            self.indptr = numpy.asarray(indptr, dtype=numpy.int64)
+            self.indices = numpy.asarray(indices, dtype=numpy.int32)
+            self.counts = numpy.asarray(counts, dtype=numpy.int64)
+        else:
+            self.indptr, self.indices, self.counts = indptr, indices, counts
+        self.symbols = symbols
+
+    @classmethod
+    def from_stacks(cls, stacks, use_numpy=None):
+        """Make a ColumnarProfile from an iterable of (stack name, hits).
+
+        :param stacks:     Iterable of (name, hits) pairs (e.g., from
+                           `CountingRecorder.stacks`) where name is the
+                           semi-colon separated list of functions.
+
+        :param use_numpy=None:  As for __init__.
+
+        """
+        symbol_ids = {}
+        indptr = array.array('q', [0])
+        indices = array.array('l')
+        counts = array.array('q')
+        for name, hits in stacks:
+            for fname in name.split(';'):
+                sym = symbol_ids.get(fname)
+                if sym is None:
+                    sym = len(symbol_ids)
+                    symbol_ids[fname] = sym
+                indices.append(sym)
+            indptr.append(len(indices))
+            counts.append(hits)
+        return cls(list(symbol_ids), indptr, indices, counts, use_numpy)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def match(self, re_filter):
+        """Return per symbol booleans for whether re_filter matches it.
+
+        Returns None if re_filter matches everything.
+        """
+        if re_filter in (None, recording.RE_FILTER_ALL_CHARACTERS):
+            return None
+        regexp = re.compile(re_filter)
+        result = [regexp.search(name) is not None for name in self.symbols]
+        if self.use_numpy:
+            return get_numpy().array(result, dtype=bool)
+        return result
+
+    def inclusive_totals(self):
+        """Return hits per symbol id counting each appearance in a stack.
+
+        This matches what `CountingRecorder.query` counts (so a recursive
+        function counts once per frame).
+        """
+        if self.use_numpy:
+            numpy = get_numpy()
+            per_frame = numpy.repeat(self.counts, numpy.diff(self.indptr))
+            return numpy.bincount(self.indices, weights=per_frame,
+                                  minlength=len(self.symbols)).astype(
+                                      numpy.int64)
+        totals = [0] * len(self.symbols)
+        indptr, indices = self.indptr, self.indices
+        for row, hits in enumerate(self.counts):
+            for pos in range(indptr[row], indptr[row + 1]):
+                totals[indices[pos]] += hits
+        return totals
+
+    def self_totals(self):
+        """Return hits per symbol id where it is at the top of the stack.
+        """
+        if self.use_numpy:
+            numpy = get_numpy()
+            tops = self.indices[self.indptr[1:] - 1]
+            return numpy.bincount(tops, weights=self.counts, minlength=len(
+                self.symbols)).astype(numpy.int64)
+        totals = [0] * len(self.symbols)
+        for row, hits in enumerate(self.counts):
+            totals[self.indices[self.indptr[row + 1] - 1]] += hits
+        return totals
+
+    def top(self, totals, limit=None, mask=None):
+        """Return [(name, hits)] for the largest totals.
+
+        :param totals:      Per symbol totals (e.g., from inclusive_totals).
+
+        :param limit=None:  Maximum number of items (None for all).
+
+        :param mask=None:   Optional per symbol booleans (from `match`);
+                            symbols where this is False are left out.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  List of (name, hits) sorted by hits (largest first)
+                  leaving out symbols with 0 hits.
+
+        """
+        if self.use_numpy:
+            numpy = get_numpy()
+            totals = numpy.asarray(totals)
+            if mask is not None:
+                totals = numpy.where(mask, totals, 0)
+            if limit is not None and limit < len(totals):
+                candidates = numpy.argpartition(-totals, limit)[:limit]
+            else:
+                candidates = numpy.arange(len(totals))
+            order = candidates[numpy.argsort(-totals[candidates],
+                                             kind='stable')]
+            return [(self.symbols[i], int(totals[i])) for i in order
+                    if totals[i]]
+        items = ((self.symbols[i], hits) for i, hits in enumerate(totals)
+                 if hits and (mask is None or mask[i]))
+        if limit is None:
+            return sorted(items, key=lambda item: item[1], reverse=True)
+        return heapq.nlargest(limit, items, key=lambda item: item[1])
+
+    def query(self, re_filter='.*', max_records=10):
+        """Same as `CountingRecorder.query` but computed from the columns.
+        """
+        hits = self.top(self.inclusive_totals(), max_records,
+                        self.match(re_filter))
+        return [recording.ProfileRecord(name, count)
+                for name, count in hits], len(self)
+
+
+if __name__ == '__main__':
+    # Run doctest if file executed as a script
+    doctest.testmod()
+    print('Finished Tests')
@@ -0,0 +1,503 @@
+"""Find which locks threads wait on and for how long.
+
+A thread blocked in `threading.Lock.acquire`, `Condition.wait` or
+`queue.Queue.get` shows up in a profile as ordinary hits on those
+frames, so a lock convoy looks like time spent in `threading`. A
+`ContentionProfiler` (fed by `Sampler.run` once you call
+`Sampler.enable_contention`) instead recognises samples whose top frame
+is blocked acquiring a lock (a call to `acquire` or `__enter__` or a
+`with` statement whose `__enter__` is native code). It then walks down
+past frames from the `threading` and `queue` modules to the frame which
+asked to wait (e.g., the caller of `Queue.get`) and groups samples by
+that wait site: the code and offset waiting plus the expression for
+what it waits on (e.g., `self._lock`). We only read the code and
+offsets of other threads' frames (never their locals or attributes of
+their objects, which could run arbitrary code) so waits on different
+objects at the same site are grouped together. Each sample counts the
+time since the previous sample as estimated wait time. We also keep
+the most common waiting stacks.
+
+Samples cannot tell who *holds* a lock. If you wrap selected locks in
+a `TrackedLock` (e.g., via `track`), it remembers its owner thread,
+notes which lock a thread is blocked acquiring (in WAITING) so waits
+are grouped by the lock itself and we also record what the holder was
+doing when a waiter was sampled, and it measures exact wait times for
+contended acquires.
+
+Note that idle worker threads waiting for work (e.g., in `Queue.get`)
+count as waits too; the 'kind' of each lock ('acquire', 'with', 'get',
+'wait', etc.) and the waiting stacks help tell them apart.
+
+>>> import threading
+>>> from ox_profile.core.contention import TrackedLock
+>>> lock = TrackedLock(name='cache lock')
+>>> with lock:
+...     lock.owner == threading.get_ident()
+...
+True
+>>> lock.owner is None, lock.acquires, lock.contended
+(True, 1, 0)
+"""
+
+import collections
+import dis
+import doctest
+import functools
+import itertools
+import queue
+import threading
+import time
+import weakref
+
+from ox_profile.core import gil
+
+
+#: Calls at the top of a stack which block acquiring a lock.
+ACQUIRE_CALLS = frozenset(['acquire', '__enter__'])
+
+WITH_OPS = frozenset(['BEFORE_WITH', 'SETUP_WITH', 'BEFORE_ASYNC_WITH'])
+
+CALL_NAMES = frozenset(dis.opname[code] for code in gil.CALL_OPCODES)
+
+BASE_LOADS = {'LOAD_FAST': 'local', 'LOAD_FAST_CHECK': 'local',
+              'LOAD_FAST_BORROW': 'local', 'LOAD_DEREF': 'local',
+              'LOAD_GLOBAL': 'global', 'LOAD_NAME': 'name'}
+
+ATTR_LOADS = frozenset(['LOAD_ATTR', 'LOAD_METHOD'])
+
+#: Files of modules whose frames we walk past to find the waiting code
+#: (including this one for TrackedLock.acquire).
+SYNC_FILES = frozenset([threading.__file__, queue.__file__, __file__])
+
+#: Code of Thread methods which start a thread's target. These have no
+#: useful wait site so we stop walking at them.
+THREAD_CODES = frozenset([
+    threading.Thread.run.__code__,
+    threading.Thread._bootstrap.__code__,  # pylint: disable=protected-access
+    threading.Thread._bootstrap_inner.__code__])  # pylint: disable=W0212
+
+#: All TrackedLock instances (so we can report them even if no waiter
+#: was sampled).
+TRACKED = weakref.WeakSet()
+
+#: Thread id -> TrackedLock the thread is blocked acquiring.
+WAITING = {}
+
+_TRACKED_KEYS = itertools.count()  # unique keys (ids can be reused)
+
+
+class TrackedLock(object):
+    """Wrapper for a lock which tracks its owner and contended waits.
+
+    This can be used anywhere a `threading.Lock` or `threading.RLock`
+    can (including as the lock for a `threading.Condition`).
+    """
+
+    def __init__(self, lock=None, name=None):
+        """Initializer.
+
+        :param lock=None:   Lock to wrap (default is a new threading.Lock).
+
+        :param name=None:   Optional name to show in reports.
+
+        """
+        self.lock = lock if lock is not None else threading.Lock()
+        self.name = name
+        self.owner = None  # thread id of the holder
+        self.depth = 0  # number of nested acquires by owner (for RLock)
+        self.acquires = 0
+        self.contended = 0  # acquires which had to wait
+        self.wait = 0.0  # total seconds spent waiting
+        self.key = next(_TRACKED_KEYS)  # groups waits in ContentionProfiler
+        TRACKED.add(self)
+
+    def acquire(self, blocking=True, timeout=-1):
+        """Acquire the lock (see `threading.Lock.acquire`).
+
+        We first try without blocking so uncontended acquires only pay
+        for that. While blocked, we are in WAITING so the sampler knows
+        which lock we wait on. Counters are updated while holding the
+        lock.
+        """
+        got = self.lock.acquire(False)
+        if not got and blocking:
+            ident = threading.get_ident()
+            WAITING[ident] = self
+            start = time.perf_counter()
+            try:
+                got = self.lock.acquire(True, timeout)
+            finally:
+                WAITING.pop(ident, None)
+            waited = time.perf_counter() - start
+            if got:
+                self.contended += 1
+                self.wait += waited
+        if got:
+            self.owner = threading.get_ident()
+            self.depth += 1
+            self.acquires += 1
+        return got
+
+    def release(self):
+        """Release the lock (see `threading.Lock.release`).
+        """
+        self.depth -= 1
+        if self.depth <= 0:
+            self.depth = 0
+            self.owner = None
+        self.lock.release()
+
+    def locked(self):
+        "Return whether the lock is held."
+        return self.lock.locked()
+
+    # A threading.Condition uses the next three methods if its lock has
+    # them (otherwise it probes with acquire(False) which succeeds for a
+    # re-entrant lock already held). We delegate to the wrapped lock if
+    # it has them (e.g., an RLock) and keep owner and depth in step.
+
+    def _is_owned(self):
+        return self.owner == threading.get_ident()
+
+    def _release_save(self):
+        depth = self.depth
+        self.depth, self.owner = 0, None
+        release_save = getattr(self.lock, '_release_save', None)
+        if release_save is None:
+            self.lock.release()
+            return depth, None
+        return depth, release_save()
+
+    def _acquire_restore(self, saved):
+        depth, inner = saved
+        ident = threading.get_ident()
+        WAITING[ident] = self
+        try:
+            if inner is None:
+                self.lock.acquire()
+            else:
+                self.lock._acquire_restore(inner)  # pylint: disable=W0212
+        finally:
+            WAITING.pop(ident, None)
+        self.owner, self.depth = ident, depth
+
+    __enter__ = acquire
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def describe(self):
+        "Return string to show for this lock in reports."
+        return self.name or 'TrackedLock(%s) at 0x%x' % (
+            type(self.lock).__name__, id(self))
+
+
+def track(obj, attr, name=None):
+    """Replace the lock in attribute attr of obj with a TrackedLock.
+
+    :param obj:       Object with a lock attribute (e.g., a cache).
+
+    :param attr:      Name of the attribute holding the lock.
+
+    :param name=None: Name for reports (default is '<type>.<attr>').
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  The TrackedLock now in obj.attr.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    PURPOSE:  Do this before other threads use the lock (and before
+              it is passed to anything like a Condition which keeps its
+              own reference).
+
+    """
+    current = getattr(obj, attr)
+    if isinstance(current, TrackedLock):
+        return current
+    result = TrackedLock(current, name or '%s.%s' % (
+        type(obj).__name__, attr))
+    setattr(obj, attr, result)
+    return result
+
+
+def _path_before(instructions, index):
+    """Return path for the name and attribute loads ending before index.
+
+    For `self._lock` this is (('local', 'self'), '_lock') and it is None
+    if the instructions before index are not such a chain.
+    """
+    attrs = []
+    index -= 1
+    while index >= 0 and instructions[index].opname in ATTR_LOADS:
+        attrs.insert(0, instructions[index].argval)
+        index -= 1
+    if index < 0 or instructions[index].opname not in BASE_LOADS:
+        return None
+    inst = instructions[index]
+    return ((BASE_LOADS[inst.opname], inst.argval),) + tuple(attrs)
+
+
+@functools.lru_cache(maxsize=4096)
+def wait_site(code, lasti):
+    """Describe the call or with statement at offset lasti of code.
+
+    :param code:    Code object.
+
+    :param lasti:   Offset from `frame.f_lasti` (for a frame calling a
+                    python function, this can be past the call).
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  None if the instruction is not a call or with statement
+              or the pair (kind, path) where kind is the name of the
+              function called (e.g., 'acquire' or 'get') or 'with' and
+              path is the expression for the object whose method is
+              called (or the context manager) as returned by
+              `_path_before` (None if we cannot tell).
+
+    """
+    instructions = list(dis.get_instructions(code))
+    index = None
+    for num, inst in enumerate(instructions):
+        if inst.offset > lasti:
+            break
+        index = num
+    if index is None:
+        return None
+    inst = instructions[index]
+    if inst.opname in WITH_OPS:
+        return 'with', _path_before(instructions, index)
+    if inst.opname not in CALL_NAMES:
+        return None
+    where = getattr(inst, 'positions', None)
+    if where is None or where.col_offset is None:
+        return None
+    best, callee = None, None
+    for num in range(index):
+        pos = instructions[num].positions
+        if instructions[num].opname in ATTR_LOADS or instructions[
+                num].opname in BASE_LOADS:
+            end = (pos.end_lineno or 0, pos.end_col_offset or 0)
+            if (pos.lineno, pos.col_offset) == (
+                    where.lineno, where.col_offset) and (
+                        best is None or end > best):
+                best, callee = end, num
+    if callee is None:
+        return None
+    if instructions[callee].opname in ATTR_LOADS:
+        return instructions[callee].argval, _path_before(
+            instructions, callee)
+    return instructions[callee].argval, None
+
+
+def render(path):
+    "Return source text for a path from `wait_site`."
+    return '.'.join([path[0][1]] + list(path[1:]))
+
+
+def find_wait(frame):
+    """Return (site, description, kind) if frame is blocked on a lock.
+
+    :param frame:     Top frame of a thread's stack (or a tuple of frames
+                      starting from the top as saved by SignalLauncher).
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  None if the thread is not blocked acquiring a lock or a
+              tuple where site is a hashable key for where the code
+              outside the threading and queue modules waits (e.g., the
+              caller of `Queue.get`), description is text to show for
+              it and kind is how it waits (e.g., 'with', 'acquire',
+              'get' or 'wait').
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    PURPOSE:  This runs in the sampling thread on frames of other
+              threads so we only read code objects and offsets.
+
+    """
+    if isinstance(frame, tuple):
+        frame = frame[0]
+    site = wait_site(frame.f_code, frame.f_lasti)
+    if site is None or site[0] not in ACQUIRE_CALLS and site[0] != 'with':
+        return None
+    inner, user = None, frame
+    while user.f_code.co_filename in SYNC_FILES and user.f_back is not None:
+        inner, user = user, user.f_back
+        if user.f_code in THREAD_CODES:  # e.g., Queue.get as thread target
+            site = (None, None)
+            break
+    else:
+        if inner is not None:
+            site = wait_site(user.f_code, user.f_lasti) or (None, None)
+    kind, path = site
+    kind = kind or (inner.f_code.co_name if inner is not None else 'acquire')
+    if path:
+        description = '%s in %s' % (render(path), user.f_code.co_name)
+    elif inner is not None:  # fall back to the object of the inner wait
+        description = 'self in %s' % getattr(
+            inner.f_code, 'co_qualname', inner.f_code.co_name)
+    else:
+        return None
+    return (user.f_code, user.f_lasti, inner.f_code if inner is not None
+            else None, path), description, kind
+
+
+class _LockStats(object):
+    """Contention statistics for one lock.
+    """
+
+    def __init__(self, description, kind, tracked):
+        self.description = description
+        self.kind = kind
+        self.tracked = tracked
+        self.samples = 0
+        self.wait = 0.0
+        self.waiters = collections.Counter()
+        self.holders = collections.Counter()
+
+    def to_dict(self, limit):
+        "Return dict for `ContentionProfiler.report`."
+        tracked = self.tracked
+        return {
+            'lock': self.description, 'kind': self.kind,
+            'samples': self.samples, 'wait': self.wait,
+            'waiters': self.waiters.most_common(limit),
+            'holders': self.holders.most_common(limit),
+            'tracked': None if tracked is None else {
+                'acquires': tracked.acquires,
+                'contended': tracked.contended, 'wait': tracked.wait}}
+
+
+class ContentionProfiler(object):
+    """Group samples blocked on locks by lock (see module docstring).
+    """
+
+    def __init__(self, max_locks=200, max_stacks=100):
+        """Initializer.
+
+        :param max_locks=200:   Maximum number of distinct locks to track.
+
+        :param max_stacks=100:  Maximum waiting (or holding) stacks to
+                                track per lock.
+
+        """
+        self.max_locks = max_locks
+        self.max_stacks = max_stacks
+        self.lock = threading.Lock()
+        self.last_time = None
+        self.reset()
+
+    def reset(self):
+        """Reset statistics (but keep the previous sample time).
+        """
+        with self.lock:
+            self.locks = {}  # wait site or TrackedLock.key -> _LockStats
+            self.observations = 0
+            self.blocked = 0
+            self.wall = 0.0
+
+    def observe(self, frames, measure_tool=None, now=None):
+        """Look for threads blocked on locks in frames.
+
+        :param frames:     Dict of thread id to top stack frame (e.g., from
+                           `sys._current_frames`).
+
+        :param measure_tool=None:  Callable taking a frame and returning an
+                                   object with a name for the stack (e.g.,
+                                   `metrics.Measurement`) to name waiting
+                                   and holding stacks.
+
+        :param now=None:   Current time (default is time.perf_counter()).
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Waits on a TrackedLock (found in WAITING) are grouped
+                  by its key and other waits by their site (see
+                  `find_wait`). We never group by id(lock) since a new
+                  lock can get the id of one which was collected.
+
+        """
+        now = time.perf_counter() if now is None else now
+        elapsed = now - self.last_time if self.last_time is not None else 0
+        me = threading.get_ident()
+        found = []
+        for thread_id, frame in frames.items():
+            if thread_id == me:
+                continue
+            try:
+                wait = find_wait(frame)
+            except (AttributeError, RuntimeError, ValueError):
+                continue  # stack changed under us (free-threaded build)
+            if wait is None:
+                continue
+            key, description, kind = wait
+            tracked = WAITING.get(thread_id)
+            if tracked is not None:
+                key, description = tracked.key, tracked.describe()
+            waiter = holder = None
+            if measure_tool is not None:
+                waiter = measure_tool(frame).name
+                owner = tracked.owner if tracked is not None else None
+                if owner is not None and owner in frames:
+                    holder = measure_tool(frames[owner]).name
+            found.append((key, description, kind, tracked, waiter, holder))
+        with self.lock:
+            self.last_time = now
+            if elapsed <= 0:
+                return
+            self.observations += 1
+            self.wall += elapsed
+            for key, description, kind, tracked, waiter, holder in found:
+                stats = self.locks.get(key)
+                if stats is None:
+                    if len(self.locks) >= self.max_locks:
+                        continue
+                    stats = self.locks[key] = _LockStats(
+                        description, kind, tracked)
+                self.blocked += 1
+                stats.samples += 1
+                stats.wait += elapsed
+                for counter, name in [(stats.waiters, waiter),
+                                      (stats.holders, holder)]:
+                    if name is not None and (name in counter or len(
+                            counter) < self.max_stacks):
+                        counter[name] += 1
+
+    def report(self, limit=10):
+        """Return dict describing the most contended locks.
+
+        :param limit=10:   Maximum number of locks and of stacks per lock.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  Dict with the number of 'observations', 'wall' seconds
+                  observed, 'blocked' samples and 'locks' as a list of
+                  dicts sorted by estimated 'wait' seconds. Each has the
+                  'lock' description, 'kind' of wait, 'samples', the
+                  most common 'waiters' and 'holders' stacks and, for a
+                  TrackedLock, the exact 'tracked' counts. Tracked locks
+                  with contended acquires are included even if no waiter
+                  was sampled.
+
+        """
+        with self.lock:
+            stats = list(self.locks.values())
+            result = {'observations': self.observations, 'wall': self.wall,
+                      'blocked': self.blocked}
+        seen = set(item.tracked.key for item in stats
+                   if item.tracked is not None)
+        stats.extend(_LockStats(lock.describe(), 'acquire', lock)
+                     for lock in list(TRACKED)
+                     if lock.contended and lock.key not in seen)
+        stats.sort(key=lambda item: (item.wait, item.tracked.wait if (
+            item.tracked is not None) else 0), reverse=True)
+        result['locks'] = [item.to_dict(limit) for item in stats[:limit]]
+        return result
+
+
+if __name__ == '__main__':
+    # Run doctest if file executed as a script
+    doctest.testmod()
+    print('Finished Tests')
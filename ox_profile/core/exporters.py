@@ -0,0 +1,307 @@
+"""Export recorded stacks to the pprof, speedscope and callgrind formats.
+
+Besides the folded stacks written by `CountingRecorder.save`, many
+tools understand the pprof format (a gzipped `profile.proto` protocol
+buffer used by `go tool pprof` and many continuous profiling services)
+the speedscope JSON format (https://www.speedscope.app) and the
+callgrind format read by KCachegrind and QCachegrind. The
+functions in this module generate each format in chunks directly
+from the (stack name, hits) pairs of a recorder so a large profile is
+never built in memory as a whole. We encode the protocol buffer
+ourselves so no extra packages are needed.
+
+>>> import io, json
+>>> from ox_profile.core import exporters, recording
+>>> recorder = recording.CountingRecorder()
+>>> dummy = recorder.load(io.StringIO('main(m);work(m) 3\\nmain(m) 1\\n'))
+>>> my_fd = io.StringIO()
+>>> exporters.export(recorder, 'speedscope', my_fd)
+>>> data = json.loads(my_fd.getvalue())
+>>> [f['name'] for f in data['shared']['frames']]
+['main(m)', 'work(m)']
+>>> data['profiles'][0]['samples'], data['profiles'][0]['weights']
+([[0, 1], [0]], [3, 1])
+>>> my_fd = io.BytesIO()
+>>> exporters.export(recorder, 'pprof', my_fd, {'interval': .001})
+>>> my_fd.getvalue()[:2] == b'\\x1f\\x8b'  # gzip magic number
+True
+"""
+
+import doctest
+import json
+import zlib
+
+from ox_profile.core import callgraph
+
+
+def _varint(value):
+    """Return bytes for value encoded as a protocol buffer varint.
+    """
+    result = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            result.append(byte | 0x80)
+        else:
+            result.append(byte)
+            return bytes(result)
+
+
+def _field_varint(field, value):
+    "Return bytes for a varint field (omitted if value is 0)."
+    if not value:
+        return b''
+    return _varint(field << 3) + _varint(value)
+
+
+def _field_bytes(field, data):
+    "Return bytes for a length-delimited field."
+    if isinstance(data, str):
+        data = data.encode('utf8')
+    return _varint((field << 3) | 2) + _varint(len(data)) + data
+
+
+def _field_packed(field, values):
+    "Return bytes for a packed repeated varint field."
+    return _field_bytes(field, b''.join(_varint(item) for item in values))
+
+
+class _PprofEncoder(object):
+    """Encode a profile.proto Profile message incrementally.
+
+    Repeated fields can appear in any order in a protocol buffer so we
+    emit each string, function and location the first time we see it
+    and each sample as we go.
+    """
+
+    # Field numbers from profile.proto
+    SAMPLE_TYPE, SAMPLE, LOCATION, FUNCTION, STRING_TABLE = 1, 2, 4, 5, 6
+    TIME_NANOS, PERIOD_TYPE, PERIOD, COMMENT = 9, 11, 12, 13
+
+    def __init__(self):
+        self.strings = {}
+        self.functions = {}  # label -> function id (also the location id)
+
+    def string(self, text, out):
+        "Return string table index for text (appending to out if new)."
+        index = self.strings.get(text)
+        if index is None:
+            index = len(self.strings)
+            self.strings[text] = index
+            out.append(_field_bytes(self.STRING_TABLE, text))
+        return index
+
+    def value_type(self, field, type_name, unit, out):
+        "Append ValueType message to out."
+        message = _field_varint(1, self.string(type_name, out)) + (
+            _field_varint(2, self.string(unit, out)))
+        out.append(_field_bytes(field, message))
+
+    def location(self, label, out):
+        "Return location id for label (appending to out if new)."
+        func_id = self.functions.get(label)
+        if func_id is None:
+            func_id = len(self.functions) + 1
+            self.functions[label] = func_id
+            name_index = self.string(label, out)
+            module = label[label.rfind('(') + 1:-1] if label.endswith(
+                ')') else ''
+            out.append(_field_bytes(self.FUNCTION, (
+                _field_varint(1, func_id) + _field_varint(2, name_index)
+                + _field_varint(3, name_index)
+                + _field_varint(4, self.string(module, out)))))
+            line = _field_varint(1, func_id)
+            out.append(_field_bytes(self.LOCATION, (
+                _field_varint(1, func_id) + _field_bytes(4, line))))
+        return func_id
+
+    def sample(self, name, values, out):
+        "Append sample for stack name with given values to out."
+        location_ids = [self.location(label, out)
+                        for label in reversed(name.split(';'))]
+        out.append(_field_bytes(self.SAMPLE, _field_packed(
+            1, location_ids) + _field_packed(2, values)))
+
+
+def iter_pprof(stacks, metadata=None, chunk_size=65536):
+    """Generate a gzipped pprof profile in chunks.
+
+    :param stacks:    Iterable of (stack name, hits) pairs (e.g., from
+                      `CountingRecorder.stacks`).
+
+    :param metadata=None:  Optional dict of metadata. If it has an
+                           'interval' (seconds between samples), we add
+                           a time value to each sample. If it has a 'time'
+                           (seconds since the epoch), we use it for
+                           the profile time. Everything is also included
+                           as 'key: value' comments.
+
+    :param chunk_size=65536:  Approximate bytes to encode before
+                              compressing and yielding a chunk.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Generator of bytes which together make a gzip file.
+
+    """
+    metadata = dict(metadata or {})
+    encoder = _PprofEncoder()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 means gzip
+    out = []
+    encoder.string('', out)  # string_table[0] must be ''
+    encoder.value_type(encoder.SAMPLE_TYPE, 'samples', 'count', out)
+    period = int(float(metadata.get('interval', 0)) * 1e9)
+    if period:
+        encoder.value_type(encoder.SAMPLE_TYPE, 'time', 'nanoseconds', out)
+        encoder.value_type(encoder.PERIOD_TYPE, 'time', 'nanoseconds', out)
+        out.append(_field_varint(encoder.PERIOD, period))
+    if 'time' in metadata:
+        out.append(_field_varint(encoder.TIME_NANOS, int(
+            float(metadata['time']) * 1e9)))
+    for key, value in sorted(metadata.items()):
+        out.append(_field_varint(encoder.COMMENT, encoder.string(
+            '%s: %s' % (key, value), out)))
+    size = 0
+    for name, hits in stacks:
+        start = len(out)
+        encoder.sample(name, [hits, hits * period] if period else [hits], out)
+        size += sum(len(item) for item in out[start:])
+        if size >= chunk_size:
+            chunk = compressor.compress(b''.join(out))
+            out, size = [], 0
+            if chunk:
+                yield chunk
+    yield compressor.compress(b''.join(out)) + compressor.flush()
+
+
+def iter_speedscope(stacks, metadata=None):
+    """Generate a speedscope "sampled" profile as JSON text in chunks.
+
+    :param stacks:    Sequence of (stack name, hits) pairs (e.g., from
+                      `CountingRecorder.stacks`). We go through it twice.
+
+    :param metadata=None:  Optional dict of metadata. We use 'command'
+                           (if present) for the profile name.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Generator of strings which together make the JSON file.
+
+    """
+    metadata = dict(metadata or {})
+    frames = {}
+    total = 0
+    name = json.dumps(str(metadata.get('command', 'ox_profile')))
+    yield ('{"$schema": "https://www.speedscope.app/file-format-schema.json",'
+           ' "exporter": "ox_profile", "name": %s, "activeProfileIndex": 0,'
+           ' "profiles": [{"type": "sampled", "name": %s, "unit": "none",'
+           ' "startValue": 0, "samples": [' % (name, name))
+    for index, (stack, hits) in enumerate(stacks):
+        ids = []
+        for label in stack.split(';'):
+            frame_id = frames.get(label)
+            if frame_id is None:
+                frame_id = len(frames)
+                frames[label] = frame_id
+            ids.append(frame_id)
+        total += hits
+        yield '%s[%s]' % (', ' if index else '', ', '.join(map(str, ids)))
+    yield '], "weights": ['
+    for index, (stack, hits) in enumerate(stacks):
+        yield '%s%i' % (', ' if index else '', hits)
+    yield '], "endValue": %i}], "shared": {"frames": [' % total
+    for index, label in enumerate(frames):
+        yield '%s{"name": %s}' % (', ' if index else '', json.dumps(label))
+    yield ']}}\n'
+
+
+def _split_label(label):
+    "Return (function, module) for a label like 'func(module)'."
+    if label.endswith(')') and '(' in label:
+        start = label.rfind('(')
+        return label[:start], label[start + 1:-1]
+    return label, ''
+
+
+def iter_callgrind(stacks, metadata=None):
+    """Generate a callgrind profile (for KCachegrind) as text in chunks.
+
+    :param stacks:    Iterable of (stack name, hits) pairs (e.g., from
+                      `CountingRecorder.stacks`).
+
+    :param metadata=None:  Optional dict of metadata. We use 'command'
+                           (if present) for the command line.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Generator of strings which together make the file. Each
+              function gets its self samples as cost and each call its
+              inclusive samples as both call count and inclusive cost
+              (sampling cannot tell how many calls there were).
+
+    """
+    metadata = dict(metadata or {})
+    graph = callgraph.CallGraph()
+    for name, hits in stacks:
+        graph.add(name.split(';'), hits)
+    files, functions = {}, {}
+
+    def compress(table, text):
+        "Return callgrind name compression reference for text."
+        index = table.get(text)
+        if index is not None:
+            return '(%i)' % index
+        index = len(table) + 1
+        table[text] = index
+        return '(%i) %s' % (index, text)
+
+    yield ('# callgrind format\nversion: 1\ncreator: ox_profile\n'
+           'cmd: %s\npositions: line\nevents: Samples\nsummary: %i\n\n' % (
+               metadata.get('command', 'ox_profile'), graph.total))
+    for name in sorted(graph.inclusive):
+        module = _split_label(name)[1]
+        lines = ['fl=%s' % compress(files, module or '???'),
+                 'fn=%s' % compress(functions, name),
+                 '0 %i' % graph.self_hits.get(name, 0)]
+        for edge in graph.callees(name):
+            callee_module = _split_label(edge.name)[1] or '???'
+            lines.append('cfl=%s' % compress(files, callee_module))
+            lines.append('cfn=%s' % compress(functions, edge.name))
+            lines.append('calls=%i 0' % edge.inclusive)
+            lines.append('0 %i' % edge.inclusive)
+        yield '\n'.join(lines) + '\n\n'
+
+
+#: Dictionary of format name to (generator, binary, mimetype, extension).
+EXPORTERS = {
+    'pprof': (iter_pprof, True, 'application/octet-stream', 'pb.gz'),
+    'speedscope': (iter_speedscope, False, 'application/json',
+                   'speedscope.json'),
+    'callgrind': (iter_callgrind, False, 'text/plain', 'callgrind'),
+    }
+
+
+def export(recorder, fmt, my_fd, metadata=None):
+    """Write stacks from recorder to my_fd in the given format.
+
+    :param recorder:  A CountingRecorder (or anything with a `stacks`
+                      method).
+
+    :param fmt:       Name of a format in EXPORTERS.
+
+    :param my_fd:     File-like object to write to (open in binary mode
+                      if EXPORTERS[fmt][1] is True and text mode otherwise).
+
+    :param metadata=None:  Optional dict of metadata (see `iter_pprof`).
+
+    """
+    generator = EXPORTERS[fmt][0]
+    for chunk in generator(recorder.stacks(), metadata):
+        my_fd.write(chunk)
+
+
+if __name__ == '__main__':
+    # Run doctest if file executed as a script
+    doctest.testmod()
+    print('Finished Tests')
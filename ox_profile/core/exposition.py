@@ -0,0 +1,202 @@
+"""Expose profiling data in the OpenMetrics (Prometheus) text format.
+
+This module is independent of any web framework. You collect metric
+families (e.g., via `collect_profile_families`) and call `render` to get
+text you can serve with the `CONTENT_TYPE` content type. Everything here
+is generated from aggregates which are maintained incrementally so a
+scrape costs time proportional to the number of series and not a full
+`query` of the recorder.
+
+>>> from ox_profile.core import exposition, histograms
+>>> hist = histograms.Histogram(bounds=[.1, 1])
+>>> hist.add(.05)
+>>> hist.add(.5)
+>>> fam = exposition.histogram_family(
+...     'demo_duration_seconds', 'Demo durations.', [({'route': 'a'}, hist)],
+...     unit='seconds')
+>>> print(exposition.render([fam]).strip())
+# TYPE demo_duration_seconds histogram
+# UNIT demo_duration_seconds seconds
+# HELP demo_duration_seconds Demo durations.
+demo_duration_seconds_bucket{route="a",le="0.1"} 1
+demo_duration_seconds_bucket{route="a",le="1.0"} 2
+demo_duration_seconds_bucket{route="a",le="+Inf"} 2
+demo_duration_seconds_count{route="a"} 2
+demo_duration_seconds_sum{route="a"} 0.55
+# EOF
+"""
+
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def escape_label(value):
+    """Escape a label value for the OpenMetrics text format.
+    """
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace(
+        '"', r'\"')
+
+
+def format_value(value):
+    """Format a number for the OpenMetrics text format.
+    """
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    return repr(float(value))
+
+
+class MetricFamily(object):
+    """A metric family (a name, type, help text and samples).
+    """
+
+    def __init__(self, name, kind, help_text, unit=None):
+        """Initializer.
+
+        :param name:       Name of the family (e.g., 'ox_profile_samples').
+
+        :param kind:       One of 'counter', 'gauge', 'histogram'.
+
+        :param help_text:  Text for the HELP line.
+
+        :param unit=None:  Optional unit (name should end with it).
+
+        """
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.unit = unit
+        self.samples = []
+
+    def add(self, value, suffix='', labels=None):
+        """Add a sample to the family.
+
+        :param value:      Numeric value of the sample.
+
+        :param suffix='':  Suffix for the sample name (e.g., '_total').
+
+        :param labels=None:  Optional dict or sequence of (name, value)
+                             pairs for the labels of the sample.
+
+        """
+        labels = list(labels.items()) if isinstance(labels, dict) else list(
+            labels or [])
+        self.samples.append((suffix, labels, value))
+        return self
+
+    def to_lines(self):
+        """Return list of lines for this family in the text format.
+        """
+        lines = ['# TYPE %s %s' % (self.name, self.kind)]
+        if self.unit:
+            lines.append('# UNIT %s %s' % (self.name, self.unit))
+        lines.append('# HELP %s %s' % (self.name, escape_label(
+            self.help_text)))
+        for suffix, labels, value in self.samples:
+            label_text = ','.join('%s="%s"' % (key, escape_label(val))
+                                  for key, val in labels)
+            lines.append('%s%s%s %s' % (
+                self.name, suffix, ('{%s}' % label_text) if label_text else '',
+                format_value(value)))
+        return lines
+
+
+def render(families):
+    """Render the given sequence of MetricFamily instances as text.
+    """
+    lines = []
+    for family in families:
+        lines.extend(family.to_lines())
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def histogram_family(name, help_text, series, unit=None):
+    """Make a histogram MetricFamily.
+
+    :param name:      Name of the family.
+
+    :param help_text: Text for the HELP line.
+
+    :param series:    Sequence of (labels, hist) pairs where labels is a
+                      dict of label values and hist is an instance of
+                      `ox_profile.core.histograms.Histogram`.
+
+    :param unit=None: Optional unit (e.g., 'seconds').
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  A MetricFamily instance.
+
+    """
+    family = MetricFamily(name, 'histogram', help_text, unit)
+    for labels, hist in series:
+        labels = list(labels.items())
+        for bound, running in hist.cumulative():
+            family.add(running, '_bucket', labels + [('le', format_value(
+                bound if bound == float('inf') else float('%g' % bound)))])
+        family.add(hist.count, '_count', labels)
+        family.add(hist.total, '_sum', labels)
+    return family
+
+
+def collect_profile_families(launcher, top_n=20):
+    """Collect metric families describing a launcher and its recorder.
+
+    :param launcher:    A `SimpleLauncher` (or similar) instance.
+
+    :param top_n=20:    How many of the top functions to export.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  List of MetricFamily instances with the sample counts for
+              the top functions and the profiler's own overhead.
+
+    """
+    tracker = launcher.tracker
+    recorder = launcher.sampler.my_db
+    families = [
+        MetricFamily('ox_profile_paused', 'gauge',
+                     'Whether the profiler is paused.').add(
+                         launcher.is_paused()),
+        MetricFamily('ox_profile_sampling_interval_seconds', 'gauge',
+                     'Requested interval between samples.',
+                     'seconds').add(launcher.interval),
+        MetricFamily('ox_profile_frames_walked', 'counter',
+                     'Stack frames walked while sampling.').add(
+                         tracker.frames, '_total'),
+        histogram_family('ox_profile_capture_seconds',
+                         'Time taken to capture and record a sample.',
+                         [({}, tracker.capture_hist)], 'seconds'),
+        histogram_family('ox_profile_lock_wait_seconds',
+                         'Time spent waiting for the recorder lock.',
+                         [({}, tracker.lock_wait_hist)], 'seconds'),
+        ]
+    if hasattr(recorder, 'function_totals'):
+        inclusive = MetricFamily(
+            'ox_profile_function_samples', 'counter',
+            'Samples with function anywhere in the stack (top functions).')
+        self_hits = MetricFamily(
+            'ox_profile_function_self_samples', 'counter',
+            'Samples with function at the top of the stack.')
+        for name, hits, self_count in recorder.function_totals(top_n):
+            inclusive.add(hits, '_total', [('function', name)])
+            self_hits.add(self_count, '_total', [('function', name)])
+        families.extend([
+            MetricFamily('ox_profile_recorder_stacks', 'gauge',
+                         'Distinct stacks held by the recorder.').add(
+                             len(recorder.my_db)),
+            inclusive, self_hits])
+    return families
+
+
+if __name__ == '__main__':
+    # Run doctest if file executed as a script
+    import doctest
+    doctest.testmod()
+    print('Finished Tests')
@@ -0,0 +1,232 @@
+"""Estimate how busy and how contended the GIL is from samples.
+
+In a threaded python program, only the thread holding the global
+interpreter lock (GIL) runs python code. To tell whether a program is
+GIL-bound, a `GILEstimator` looks at consecutive samples of every
+thread (it is fed by `Sampler.run` once you call
+`Sampler.enable_gil_estimation`). For each thread and each interval
+between samples it checks:
+
+  - whether the thread used CPU time (via `time.pthread_getcpuclockid`
+    where available), and
+  - whether the top frame moved (a different frame or `f_lasti`).
+
+A thread which did either *ran*. A thread which did neither is either
+*native* (its top frame is at a call instruction so it is inside a C
+function, e.g., blocked on I/O or sleeping, which usually releases the
+GIL) or *stalled* (it is in the middle of python bytecode so it was
+runnable but did not get the GIL). From these we report:
+
+  - gil_utilization: CPU seconds used by the sampled threads per wall
+    second (capped at 1), or if CPU clocks are not available, the
+    fraction of intervals in which some thread ran,
+  - contention: stalled / (running + stalled) thread intervals; i.e.,
+    how often a runnable thread was waiting instead of running,
+  - waiting_stacks: the stacks most often seen stalled.
+
+High utilization with high contention means more threads will not help
+and more processes might. These are estimates: a thread which just
+returned from a C call and is waiting to re-acquire the GIL looks
+native, and C code which releases the GIL still uses CPU time.
+
+>>> from ox_profile.core.gil import GILEstimator
+>>> estimator = GILEstimator(cpu_clocks=False)
+>>> estimator.report()['intervals']
+0
+"""
+
+import collections
+import dis
+import doctest
+import sys
+import threading
+import time
+
+
+#: Opcodes for instructions which call a function.
+CALL_OPCODES = frozenset(dis.opmap[name] for name in [
+    'CALL', 'PRECALL', 'CALL_FUNCTION', 'CALL_FUNCTION_KW',
+    'CALL_FUNCTION_EX', 'CALL_METHOD', 'CALL_KW'] if name in dis.opmap)
+
+
+def is_enabled():
+    """Return whether the GIL is enabled (False on free-threaded builds).
+    """
+    check = getattr(sys, '_is_gil_enabled', None)
+    return True if check is None else check()
+
+
+def at_call(frame):
+    """Return whether frame is at an instruction which calls a function.
+
+    For the top frame of a thread, this means the thread is running a
+    function implemented in C (since a python callee would be the top
+    frame instead).
+    """
+    lasti = frame.f_lasti
+    if lasti < 0:
+        return False
+    code = frame.f_code.co_code
+    return lasti < len(code) and code[lasti] in CALL_OPCODES
+
+
+def _make_cpu_clock(thread_id):
+    """Return clock id for the CPU time of thread_id (or None).
+
+    Only call this while the thread is known to be alive (e.g., right
+    after seeing it in `sys._current_frames`).
+    """
+    try:
+        return time.pthread_getcpuclockid(thread_id)
+    except (AttributeError, OSError, OverflowError):
+        return None
+
+
+class GILEstimator(object):
+    """Estimate GIL utilization and contention (see module docstring).
+    """
+
+    def __init__(self, cpu_clocks=True, max_stacks=1000, min_cpu=.1):
+        """Initializer.
+
+        :param cpu_clocks=True:  Whether to try using per thread CPU clocks.
+
+        :param max_stacks=1000:  Maximum distinct waiting stacks to track.
+
+        :param min_cpu=.1:  Fraction of an interval a thread must use in CPU
+                            time to count as running based on CPU time
+                            alone (threads waiting for the GIL wake up
+                            briefly now and then).
+
+        """
+        self.cpu_clocks = cpu_clocks and hasattr(time, 'pthread_getcpuclockid')
+        self.min_cpu = min_cpu
+        self.max_stacks = max_stacks
+        self.lock = threading.Lock()
+        self.previous = {}  # thread_id -> (code, f_lasti, id(frame), cpu)
+        self.clocks = {}  # thread_id -> cpu clock id (or None)
+        self.last_time = None
+        self.reset()
+
+    def reset(self):
+        """Reset statistics (but keep the previous sample as a baseline).
+        """
+        with self.lock:
+            self.intervals = 0
+            self.busy_intervals = 0  # intervals where some thread ran
+            self.wall = 0.0
+            self.cpu = 0.0
+            self.states = collections.Counter()
+            self.waiting = collections.Counter()
+
+    def cpu_time(self, thread_id):
+        """Return CPU seconds used by thread_id (or None if unknown).
+        """
+        if not self.cpu_clocks:
+            return None
+        if thread_id not in self.clocks:
+            self.clocks[thread_id] = _make_cpu_clock(thread_id)
+        clock = self.clocks[thread_id]
+        if clock is None:
+            return None
+        try:
+            return time.clock_gettime(clock)
+        except OSError:  # thread went away
+            return None
+
+    def observe(self, frames, measure_tool=None, now=None):
+        """Compare frames for each thread to those from the previous call.
+
+        :param frames:     Dict of thread id to top stack frame (e.g., from
+                           `sys._current_frames`).
+
+        :param measure_tool=None:  Callable taking a frame and returning an
+                                   object with a name for the stack (e.g.,
+                                   `metrics.Measurement`). Used to name the
+                                   stacks of stalled threads.
+
+        :param now=None:   Current time (default is time.perf_counter()).
+
+        """
+        now = time.perf_counter() if now is None else now
+        me = threading.get_ident()
+        elapsed = now - self.last_time if self.last_time is not None else 0
+        current = {}
+        running = stalled = native = 0
+        cpu_used = 0.0
+        have_cpu = False
+        waiting = []
+        for thread_id, frame in frames.items():
+            if thread_id == me:
+                continue
+            cpu = self.cpu_time(thread_id)
+            key = (frame.f_code, frame.f_lasti, id(frame), cpu)
+            current[thread_id] = key
+            prev = self.previous.get(thread_id)
+            if prev is None or self.last_time is None:
+                continue
+            cpu_delta = 0.0
+            if cpu is not None and prev[3] is not None:
+                cpu_delta = max(0.0, cpu - prev[3])
+                cpu_used += cpu_delta
+                have_cpu = True
+            if cpu_delta > self.min_cpu * elapsed or key[:3] != prev[:3]:
+                running += 1
+            elif at_call(frame):
+                native += 1
+            else:
+                stalled += 1
+                if measure_tool is not None:
+                    waiting.append(measure_tool(frame).name)
+        for thread_id in set(self.clocks) - set(current):
+            del self.clocks[thread_id]
+        with self.lock:
+            if elapsed > 0:
+                self.intervals += 1
+                self.busy_intervals += 1 if running else 0
+                self.wall += elapsed
+                if have_cpu:
+                    self.cpu += min(cpu_used, elapsed)
+                self.states.update(running=running, stalled=stalled,
+                                   native=native)
+                for name in waiting:
+                    if name in self.waiting or len(self.waiting) < (
+                            self.max_stacks):
+                        self.waiting[name] += 1
+            self.previous = current
+            self.last_time = now
+
+    def report(self, limit=10):
+        """Return dict describing GIL utilization and contention.
+
+        :param limit=10:   Maximum number of waiting stacks to include.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  Dict with 'intervals', 'wall' and 'cpu' seconds,
+                  'gil_utilization', 'contention', the 'thread_states'
+                  counts and 'waiting_stacks' as a list of (name, count).
+                  See the module docstring for details.
+
+        """
+        with self.lock:
+            runnable = self.states['running'] + self.states['stalled']
+            if self.cpu_clocks and self.cpu:
+                utilization = min(1.0, self.cpu / self.wall)
+            else:
+                utilization = self.busy_intervals / float(
+                    max(self.intervals, 1))
+            return {
+                'intervals': self.intervals, 'wall': self.wall,
+                'cpu': self.cpu if self.cpu_clocks else None,
+                'gil_utilization': utilization,
+                'contention': self.states['stalled'] / float(runnable) if (
+                    runnable) else 0.0,
+                'thread_states': dict(self.states),
+                'waiting_stacks': self.waiting.most_common(limit)}
+
+
+if __name__ == '__main__':
+    # Run doctest if file executed as a script
+    doctest.testmod()
+    print('Finished Tests')
@@ -0,0 +1,122 @@
+"""Simple fixed-bucket histograms for tracking durations.
+
+These are used to track things like how long each sample takes so that
+we can report the overhead of profiling without keeping every value.
+
+>>> from ox_profile.core.histograms import Histogram
+>>> hist = Histogram()
+>>> for value in [1e-6, 2e-6, 3e-6, 1e-3, 0.5]:
+...     hist.add(value)
+...
+>>> hist.count
+5
+>>> '%.6f' % hist.total
+'0.501006'
+>>> hist.quantile(.5) <= 4.1e-6
+True
+>>> sorted(hist.summary())
+['count', 'max', 'mean', 'p50', 'p90', 'p99']
+"""
+
+import bisect
+
+
+def make_bounds(smallest=1e-6, factor=2.0, num_buckets=25):
+    """Return list of geometrically increasing bucket upper bounds.
+
+    The defaults cover 1 microsecond to about 16 seconds which is
+    reasonable for timing samples and requests.
+    """
+    return [smallest * factor**i for i in range(num_buckets)]
+
+
+DEFAULT_BOUNDS = make_bounds()
+
+
+class Histogram(object):
+    """Histogram with fixed bucket upper bounds.
+
+    Values larger than the largest bound go into an overflow bucket. The
+    count, total and max are tracked exactly while quantiles are estimated
+    from the buckets.
+    """
+
+    def __init__(self, bounds=None):
+        """Initializer.
+
+        :param bounds=None:   Sorted list of bucket upper bounds. If None,
+                              we use DEFAULT_BOUNDS.
+
+        """
+        self.bounds = list(bounds if bounds is not None else DEFAULT_BOUNDS)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def reset(self):
+        """Reset everything in the histogram."""
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value, weight=1):
+        """Add value to the histogram (weight times).
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += weight
+        self.count += weight
+        self.total += value * weight
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the contents of other histogram (with the same bounds) to self.
+        """
+        assert self.bounds == other.bounds
+        for index, value in enumerate(other.counts):
+            self.counts[index] += value
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def cumulative(self):
+        """Return list of (upper_bound, cumulative_count) pairs.
+
+        The last pair has an upper bound of float('inf').
+        """
+        result = []
+        running = 0
+        for bound, value in zip(self.bounds + [float('inf')], self.counts):
+            running += value
+            result.append((bound, running))
+        return result
+
+    def quantile(self, fraction):
+        """Estimate the given quantile (e.g., .5 for median).
+
+        Returns the upper bound of the bucket containing the quantile (or
+        self.max for the overflow bucket) and 0.0 if there is no data.
+        """
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        for bound, running in self.cumulative():
+            if running >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        """Return dict with count, mean, max and estimated quantiles.
+        """
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max, 'p50': self.quantile(.5),
+                'p90': self.quantile(.9), 'p99': self.quantile(.99)}
+
+
+if __name__ == '__main__':
+    # Run doctest if file executed as a script
+    import doctest
+    doctest.testmod()
+    print('Finished Tests')
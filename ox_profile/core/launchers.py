@@ -1,13 +1,16 @@
 """Module containing profiling launchers.
 """
 
+import collections
 import doctest
+import os
 import time
 import logging
+import signal
 import threading
 
 
-from ox_profile.core import sampling, recording
+from ox_profile.core import sampling, recording, histograms
 
 
 class SamplingTracker:
@@ -20,18 +23,31 @@ class SamplingTracker:
 
     Usually you do not need to worry much about this and can just use
     the SimpleLauncher which has an instance of a SamplingTracker.
+
+    Besides the time between samples, the tracker also keeps histograms
+    of how long each sample took to capture and how long it waited for
+    the recorder's lock along with how many frames were walked. See the
+    `metrics` method for a summary of this profiling overhead.
     """
 
     def __init__(self):
         self.calls = 0
         self.wait = 0.0
         self.wait_sq = 0.0
+        self.capture_hist = histograms.Histogram()
+        self.lock_wait_hist = histograms.Histogram()
+        self.frames = 0
+        self.threads = 0
 
     def reset(self):
         """ Reset everything in the tracker."""
         self.calls = 0
         self.wait = 0.0
         self.wait_sq = 0.0
+        self.capture_hist.reset()
+        self.lock_wait_hist.reset()
+        self.frames = 0
+        self.threads = 0
 
     def snap(self, prev):
         """Snap a sample remember how far it was since the previous snap.
@@ -44,6 +60,33 @@ class SamplingTracker:
         self.wait += my_wait
         self.wait_sq += my_wait**2
 
+    def snap_many(self, count, elapsed):
+        """Record count samples taken evenly over elapsed seconds.
+
+        This is useful for engines which do not see each sample as it is
+        taken (e.g., the SignalLauncher) and only know how many samples
+        arrived since the last time they checked.
+        """
+        if count <= 0:
+            return
+        self.calls += count
+        self.wait += elapsed
+        self.wait_sq += elapsed**2 / count
+
+    def snap_run(self, info):
+        """Record the cost of a sample.
+
+        :param info:    A `sampling.SampleInfo` as returned by running a
+                        Sampler (or None if the sampler did not return one).
+
+        """
+        if info is None:
+            return
+        self.capture_hist.add(info.capture_time)
+        self.lock_wait_hist.add(info.lock_wait)
+        self.frames += info.frames
+        self.threads += info.threads
+
     def stats(self):
         """Return dictionary of stats related to snap interval."""
         if self.calls == 0:
@@ -51,7 +94,40 @@ class SamplingTracker:
 
         mean = self.wait/self.calls
         return {'mean': mean,
-                'stdev': (self.wait_sq/self.calls - mean**2)**0.5}
+                'stdev': max(0.0, self.wait_sq/self.calls - mean**2)**0.5}
+
+    def metrics(self, recorder=None):
+        """Return dictionary of metrics about profiling overhead.
+
+        :param recorder=None:   Optional recorder with a `size_info` method
+                                (e.g., a CountingRecorder) whose size we
+                                should include.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  Dictionary of plain python types (so it can be converted
+                  to JSON) describing the sampling interval, the time
+                  taken to capture samples, time waiting for the recorder
+                  lock, frames walked and recorder size.
+
+        """
+        captures = self.capture_hist.count
+        result = {
+            'samples': self.calls,
+            'interval': self.stats() if self.calls else None,
+            'capture_time': self.capture_hist.summary(),
+            'total_capture_time': self.capture_hist.total,
+            'lock_wait': self.lock_wait_hist.summary(),
+            'total_lock_wait': self.lock_wait_hist.total,
+            'frames_walked': self.frames,
+            'frames_per_capture': (
+                self.frames / float(captures) if captures else 0.0),
+            'threads_per_capture': (
+                self.threads / float(captures) if captures else 0.0),
+            }
+        if recorder is not None and hasattr(recorder, 'size_info'):
+            result['recorder'] = recorder.size_info()
+        return result
 
 
 class SimpleLauncher(threading.Thread):
@@ -117,7 +193,7 @@ Items:
         """
         self.tracker = SamplingTracker()
         self.sampler = sampler if sampler else sampling.Sampler(
-            recording.CountingRecorder())
+            recording.make_recorder())
         self.interval = interval
         self.stop_flag = stop_flag if stop_flag else threading.Event()
         self.stop_flag.clear()
@@ -151,6 +227,33 @@ Items:
         """
         return self.sampler.query(*args, **kwargs)
 
+    def metrics(self):
+        """Return dictionary of metrics about profiling overhead.
+
+        See `SamplingTracker.metrics` for details. If the sampler has a
+        stack cache, we also include its size and hit/miss counts, if the
+        GIL is disabled, the number of 'torn_stacks' skipped because they
+        changed while we walked them, if it is estimating GIL
+        contention, we include the 'gil' report and if it is profiling
+        lock contention, the 'contention' report.
+        """
+        result = self.tracker.metrics(self.sampler.my_db)
+        cache = getattr(self.sampler, 'stack_cache', None)
+        if cache is not None:
+            result['stack_cache'] = {'frames': len(cache.frames),
+                                     'prefixes': len(cache.parents),
+                                     'hits': cache.hits,
+                                     'misses': cache.misses}
+        if getattr(self.sampler, 'tolerate_torn', False):
+            result['torn_stacks'] = self.sampler.torn_stacks
+        estimator = getattr(self.sampler, 'gil_estimator', None)
+        if estimator is not None:
+            result['gil'] = estimator.report()
+        profiler = getattr(self.sampler, 'contention', None)
+        if profiler is not None:
+            result['contention'] = profiler.report()
+        return result
+
     def set_interval(self, new_interval):
         """Set the interval for how often we take a sample.
 
@@ -194,7 +297,7 @@ Items:
             self.tracker.snap(prev)
             self.unpaused.wait()
             prev = time.time()
-            self.sampler()
+            self.tracker.snap_run(self.sampler())
 
         logging.info('Stopping Launcher')
 
@@ -208,6 +311,441 @@ Items:
         self.stop_flag.set()
 
 
+#: What `SignalLauncher` saves for each frame of a sampled stack. This has
+#: the attributes of a frame which measurements need (so it can be passed
+#: to `sampling.Sampler.record_frames` in a tuple like frames) without
+#: keeping the frame and its local variables alive.
+FrameSnapshot = collections.namedtuple('FrameSnapshot', [
+    'f_code', 'f_globals', 'f_lasti'])
+
+
+class SignalLauncher(SimpleLauncher):
+    """Profiling launcher driven by a `signal.setitimer` profiling timer.
+
+The `SimpleLauncher` relies on a thread waking from `time.sleep`. That
+thread has to acquire the GIL before it can sample so samples are biased
+towards points where the main thread releases the GIL. The
+`SignalLauncher` instead uses `signal.setitimer(signal.ITIMER_PROF, ...)`
+so the operating system sends `SIGPROF` after every `interval` seconds
+of CPU time. The signal handler runs in the main thread and just stores
+the code, globals and instruction offset of each frame on the current
+stack into a preallocated ring buffer. The launcher thread then
+periodically drains that buffer into the usual `Sampler` and recorder
+so the expensive work happens off the hot path.
+
+Note that this only samples the *main* thread and is only available on
+platforms providing `signal.setitimer` (e.g., LINUX). The timer counts
+the CPU time of the whole process, so CPU used by other threads (e.g.,
+workers) is charged to whatever the main thread happens to be running
+(which may be idle). You must call `start` from the main thread since
+that is where python signal handlers get installed; the timer is not
+armed until then even if you call `unpause` first.
+
+>>> import math
+>>> from ox_profile.core import launchers
+>>> launcher = launchers.SignalLauncher(interval=.001)
+>>> def example_func(x):
+...     return sum(math.atanh(i/(x+1.0)) for i in range(x))
+...
+>>> launcher.start()
+>>> launcher.unpause()
+>>> dummy = [example_func(i) for i in range(3000)]
+>>> launcher.pause()
+>>> launcher.drain() >= 0
+True
+>>> query, total_records = launcher.query(max_records=None)
+>>> print([i.name for i in query if i.name.startswith('example_func')])
+['example_func(ox_profile.core.launchers)']
+>>> launcher.cancel()
+
+    """
+
+    def __init__(self, sampler=None, stop_flag=None, interval=.001,
+                 buffer_size=4096, drain_interval=.1, *args, **kwargs):
+        """Initializer.
+
+        :param sampler=None:   As for SimpleLauncher.
+
+        :param stop_flag=None: As for SimpleLauncher.
+
+        :param interval=.001:  How much CPU time (in seconds) between samples.
+
+        :param buffer_size=4096:  Number of frames the ring buffer can hold
+                                  before the launcher thread drains it. If
+                                  the buffer fills up, we drop samples and
+                                  count them in self.dropped.
+
+        :param drain_interval=.1: How often (in seconds) to drain the buffer.
+
+        :param *args, **kwargs:  Passed to SimpleLauncher.__init__.
+
+        """
+        if not hasattr(signal, 'setitimer'):
+            raise NotImplementedError(
+                'SignalLauncher requires signal.setitimer (not available'
+                ' on this platform); use SimpleLauncher instead.')
+        self.buffer_size = buffer_size
+        self.buffer = [None] * buffer_size
+        self.write_count = 0
+        self.read_count = 0
+        self.dropped = 0
+        self.drain_interval = drain_interval
+        self._armed = False
+        self._installed = False  # whether start installed our handler
+        self._prev_handler = None
+        self._last_drain = time.time()
+        SimpleLauncher.__init__(self, sampler, stop_flag, interval,
+                                *args, **kwargs)
+        self.name = "ox_profiler_SignalLauncher_Thread"
+
+    def _handle_signal(self, signum, frame):
+        """Signal handler to save stack in buffer (keep this very cheap).
+
+        We walk up to the root here instead of saving just the current
+        frame because by the time we drain the buffer, a suspended
+        generator frame no longer knows its `f_back`. We save the parts
+        of each frame that `drain` turns into a FrameSnapshot instead of
+        the frame itself so buffered samples do not keep local variables
+        alive after their functions return.
+        """
+        count = self.write_count
+        if count - self.read_count >= self.buffer_size:
+            self.dropped += 1
+        else:
+            chain = []
+            while frame is not None:
+                chain.append((frame.f_code, frame.f_globals, frame.f_lasti))
+                frame = frame.f_back
+            self.buffer[count % self.buffer_size] = tuple(chain)
+            self.write_count = count + 1
+
+    def _arm(self):
+        """Start the profiling timer.
+
+        Without our handler, SIGPROF would kill the process so we refuse
+        to arm the timer before `start` installs the handler.
+        """
+        if not self._installed:
+            raise RuntimeError('Call start before arming the timer.')
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self._armed = True
+
+    def _disarm(self):
+        "Stop the profiling timer."
+        if self._armed:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            self._armed = False
+
+    def start(self):
+        """Install signal handler and start the thread which drains buffer.
+
+        *IMPORTANT*:  Must be called from the main thread.
+        """
+        self._prev_handler = signal.signal(signal.SIGPROF, self._handle_signal)
+        signal.siginterrupt(signal.SIGPROF, False)
+        self._installed = True
+        SimpleLauncher.start(self)
+        if not self.is_paused():  # unpause was called before start
+            self._arm()
+
+    def set_interval(self, new_interval):
+        """Set the interval for how often we take a sample.
+
+        :arg new_interval:  Float between 0 and 10 for how much CPU time
+                            to wait between samples.
+        """
+        SimpleLauncher.set_interval(self, new_interval)
+        if self._armed:
+            self._arm()
+
+    def pause(self):
+        """Pause profiling until self.unpause() is called.
+        """
+        SimpleLauncher.pause(self)
+        self._disarm()
+
+    def unpause(self):
+        """Un-pause profiling if paused.
+
+        If `start` has not been called yet, the timer is armed by `start`.
+        """
+        SimpleLauncher.unpause(self)
+        if self._installed and not self.stop_flag.is_set():
+            self._arm()
+
+    def drain(self):
+        """Record any frames in the buffer using self.sampler.
+
+        :return:  Number of frames drained.
+
+        Note that the capture time tracked by self.tracker is the time to
+        drain and record a batch of frames (the signal handler itself is
+        too hot a path to time).
+        """
+        write_count = self.write_count
+        frames = []
+        for i in range(self.read_count, write_count):
+            index = i % self.buffer_size
+            frames.append(tuple(FrameSnapshot._make(item)
+                                for item in self.buffer[index]))
+            self.buffer[index] = None
+        self.read_count = write_count
+        now = time.time()
+        if frames:
+            self.tracker.snap_run(self.sampler.record_frames(frames))
+            self.tracker.snap_many(len(frames), now - self._last_drain)
+        self._last_drain = now
+        return len(frames)
+
+    def run(self):
+        """Drain the buffer periodically until cancelled.
+
+        *IMPORTANT*:  This is a *thread* so you should call `self.start()`
+                      *NOT* `self.run()`. Do *NOT* call self.run directly.
+        """
+        logging.info('Starting SignalLauncher')
+        while not self.stop_flag.is_set():
+            self.stop_flag.wait(self.drain_interval)
+            self.drain()
+
+        logging.info('Stopping SignalLauncher')
+
+    def cancel(self):
+        """Cancel the running profiler and restore previous signal handler.
+        """
+        self._disarm()
+        SimpleLauncher.cancel(self)
+        if self._prev_handler is not None and (
+                threading.current_thread() is threading.main_thread()):
+            signal.signal(signal.SIGPROF, self._prev_handler)
+            self._installed = False
+            self._prev_handler = None
+
+
+SpikeCapture = collections.namedtuple('SpikeCapture', [
+    'start_time', 'end_time', 'cpu', 'samples', 'path', 'recorder'])
+
+
+def process_cpu_time():
+    """Return user plus system CPU seconds used by this process so far.
+
+    This uses `os.times` which is a single cheap system call.
+    """
+    times = os.times()
+    return times.user + times.system
+
+
+class WatchdogLauncher(SimpleLauncher):
+    """Launcher which samples at a high rate while the process is busy.
+
+A 1 ms sampling interval is too expensive to leave on all the time but
+we want detailed profiles exactly when a worker pegs a core. The
+`WatchdogLauncher` samples at the usual low base rate into
+`self.sampler` and checks process CPU usage (via `process_cpu_time`)
+every `check_interval` seconds. Once usage stays at or above
+`threshold` (in cores) for `sustain` seconds, it samples every
+`capture_interval` seconds into a separate recorder for
+`capture_seconds` seconds. It then keeps the capture in
+`self.captures` (and saves it in the folded stacks format if
+`directory` was given) and waits `cooldown` seconds before another
+capture can start so a process which is always busy does not pay for
+high rate sampling all the time.
+
+>>> import math, time
+>>> from ox_profile.core import launchers
+>>> launcher = launchers.WatchdogLauncher(
+...     interval=.05, threshold=.5, sustain=.1, check_interval=.05,
+...     capture_interval=.001, capture_seconds=.3)
+>>> def busy_loop(seconds):
+...     end = time.time() + seconds
+...     while time.time() < end:
+...         math.sqrt(end)
+...
+>>> launcher.start()
+>>> launcher.unpause()
+>>> busy_loop(1)
+>>> launcher.cancel()
+>>> launcher.join(5)
+>>> capture = launcher.captures[0]
+>>> capture.cpu >= .5, capture.samples > 10, len(launcher.captures)
+(True, True, 1)
+>>> query, total = capture.recorder.query(re_filter='busy_loop')
+>>> [i.name for i in query]
+['busy_loop(ox_profile.core.launchers)']
+
+    """
+
+    def __init__(self, sampler=None, stop_flag=None, interval=.05,
+                 threshold=.9, sustain=2.0, check_interval=.5,
+                 capture_interval=.001, capture_seconds=10.0,
+                 cooldown=60.0, directory=None, max_kept=10,
+                 *args, **kwargs):
+        """Initializer.
+
+        :param sampler=None, stop_flag=None:  As for SimpleLauncher.
+
+        :param interval=.05:   Base sampling interval (in seconds).
+
+        :param threshold=.9:   CPU usage (in cores so 1.0 means one core
+                               fully busy) which triggers a capture.
+
+        :param sustain=2.0:    Seconds usage must stay above threshold.
+
+        :param check_interval=.5:  How often (in seconds) to check usage.
+
+        :param capture_interval=.001:  Sampling interval during a capture.
+
+        :param capture_seconds=10.0:   How long each capture lasts.
+
+        :param cooldown=60.0:  Seconds after a capture before another.
+
+        :param directory=None: Optional directory to save captures in as
+                               'ox_profile.<pid>.spike.<time>.folded'.
+
+        :param max_kept=10:    How many recent captures to keep in memory.
+
+        :param *args, **kwargs:  Passed to SimpleLauncher.__init__.
+
+        """
+        self.threshold = threshold
+        self.sustain = sustain
+        self.check_interval = check_interval
+        self.capture_interval = capture_interval
+        self.capture_seconds = capture_seconds
+        self.cooldown = cooldown
+        self.directory = directory
+        self.captures = collections.deque(maxlen=max_kept)
+        self.cpu = 0.0  # usage over the most recent check
+        self.capture_sampler = None  # sampler for capture in progress
+        self._cpu_prev = (process_cpu_time(), time.monotonic())
+        self._next_check = 0.0
+        self._above_since = None
+        self._quiet_until = 0.0
+        self._capture_info = None  # (monotonic, time, cpu) at capture start
+        self._capture_samples = 0
+        SimpleLauncher.__init__(self, sampler, stop_flag, interval,
+                                *args, **kwargs)
+        self.name = "ox_profiler_WatchdogLauncher_Thread"
+
+    def check_cpu(self, now=None):
+        """Measure CPU usage since the last check and start/end captures.
+
+        :param now=None:  Optional time.monotonic() value for now.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  CPU usage (in cores) since the previous check.
+
+        """
+        now = time.monotonic() if now is None else now
+        cpu_time = process_cpu_time()
+        prev_cpu_time, prev_now = self._cpu_prev
+        self._cpu_prev = (cpu_time, now)
+        self._next_check = now + self.check_interval
+        if now <= prev_now:
+            return self.cpu
+        self.cpu = (cpu_time - prev_cpu_time) / (now - prev_now)
+        if self.capture_sampler is not None:
+            if now - self._capture_info[0] >= self.capture_seconds:
+                self.end_capture(now)
+        elif self.cpu >= self.threshold and now >= self._quiet_until:
+            if self._above_since is None:
+                self._above_since = prev_now
+            if now - self._above_since >= self.sustain:
+                self.begin_capture(now)
+        else:
+            self._above_since = None
+        return self.cpu
+
+    def begin_capture(self, now=None):
+        """Start sampling at capture_interval into a new recorder.
+
+        The capture sampler uses the same thread and frame filters as
+        self.sampler.
+        """
+        self._capture_info = (time.monotonic() if now is None else now,
+                              time.time(), self.cpu)
+        self._capture_samples = 0
+        self.capture_sampler = sampling.Sampler(
+            recording.make_recorder(),
+            thread_filter=self.sampler.thread_filter,
+            frame_filter=self.sampler.frame_filter)
+        logging.info('CPU usage %.2f >= %.2f; capturing for %s seconds',
+                     self.cpu, self.threshold, self.capture_seconds)
+
+    def end_capture(self, now=None):
+        """Stop the capture in progress, keep it and maybe save it.
+
+        :return:  The SpikeCapture (also appended to self.captures) or
+                  None if no capture was in progress.
+
+        """
+        capture_sampler, self.capture_sampler = self.capture_sampler, None
+        if capture_sampler is None:
+            return None
+        now = time.monotonic() if now is None else now
+        self._quiet_until = now + self.cooldown
+        self._above_since = None
+        start, start_time, cpu = self._capture_info
+        recorder = capture_sampler.my_db
+        path = self.save_capture(recorder, start_time, cpu) if (
+            self.directory) else None
+        capture = SpikeCapture(start_time, start_time + now - start, cpu,
+                               self._capture_samples, path, recorder)
+        self.captures.append(capture)
+        return capture
+
+    def save_capture(self, recorder, start_time, cpu):
+        """Save recorder in self.directory and return the path.
+
+        We write to a temporary file first and then rename it so readers
+        never see a partially written profile. Returns None (after
+        logging the problem) if we could not write the file.
+        """
+        path = os.path.join(self.directory, 'ox_profile.%i.spike.%i.folded' % (
+            os.getpid(), int(start_time)))
+        tmp_path = '%s.tmp' % path
+        try:
+            with open(tmp_path, 'w') as my_fd:
+                recorder.save(my_fd, metadata={
+                    'trigger': 'cpu', 'cpu': '%.3f' % cpu,
+                    'interval': self.capture_interval, 'time': start_time})
+            os.replace(tmp_path, path)
+        except OSError as problem:
+            logging.error('Could not save spike capture to %s: %s',
+                          path, problem)
+            return None
+        logging.info('Saved spike capture to %s', path)
+        return path
+
+    def run(self):
+        """Sample at the base rate (or capture rate) until cancelled.
+
+        *IMPORTANT*:  This is a *thread* so you should call `self.start()`
+                      *NOT* `self.run()`. Do *NOT* call self.run directly.
+        """
+        logging.info('Starting WatchdogLauncher')
+        prev = time.time()
+        while not self.stop_flag.is_set():
+            capture_sampler = self.capture_sampler
+            time.sleep(self.interval if capture_sampler is None else (
+                self.capture_interval))
+            self.unpaused.wait()
+            if time.monotonic() >= self._next_check:
+                self.check_cpu()
+                capture_sampler = self.capture_sampler
+            if capture_sampler is None:
+                self.tracker.snap(prev)
+                self.tracker.snap_run(self.sampler())
+            else:
+                capture_sampler()
+                self._capture_samples += 1
+            prev = time.time()
+
+        self.end_capture()
+        logging.info('Stopping WatchdogLauncher')
+
+
 if __name__ == '__main__':
     # Run doctest if file executed as a script
     doctest.testmod()
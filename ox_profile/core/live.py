@@ -0,0 +1,184 @@
+"""Stream live top-N function deltas (e.g., via Server-Sent Events).
+
+Reloading a status page runs a full `query` of the recorder every time.
+The `LiveTop` class in this module instead has a single producer thread
+which, every few seconds, takes the per function hits recorded since
+the previous push (see `CountingRecorder.take_function_deltas`) and
+sends the top N to every subscriber. Adding more viewers adds a queue
+put per push and not more work for the recorder.
+
+>>> from ox_profile.core import live, recording
+>>> class FakeMeasurement(object):
+...     def __init__(self, name):
+...         self.name = name
+...
+>>> recorder = recording.CountingRecorder()
+>>> top = live.LiveTop(recorder, top_n=2)
+>>> dummy = top.make_event()  # first event starts tracking deltas
+>>> lock_wait = recorder.record_many([FakeMeasurement('main;work')] * 3 + [
+...     FakeMeasurement('main;idle')])
+>>> event = top.make_event()
+>>> event['samples'], event['inclusive'], event['self']
+(4, [['main', 4], ['work', 3]], [['work', 3], ['idle', 1]])
+>>> print(live.format_sse(event['self'], event='top', event_id=7).strip())
+id: 7
+event: top
+data: [["work", 3], ["idle", 1]]
+"""
+
+import doctest
+import heapq
+import json
+import logging
+import queue
+import threading
+import time
+
+
+def format_sse(data, event=None, event_id=None):
+    """Format data as a Server-Sent Event.
+
+    :param data:            Data to encode as JSON.
+
+    :param event=None:      Optional event type.
+
+    :param event_id=None:   Optional event id.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  String for the event (ending with a blank line).
+
+    """
+    lines = []
+    if event_id is not None:
+        lines.append('id: %s' % event_id)
+    if event is not None:
+        lines.append('event: %s' % event)
+    lines.append('data: %s' % json.dumps(data))
+    return '\n'.join(lines) + '\n\n'
+
+
+#: Comment sent to keep connections open when there is nothing new.
+SSE_KEEPALIVE = ': keepalive\n\n'
+
+
+class LiveTop(object):
+    """Push top-N per function deltas from a recorder to subscribers.
+    """
+
+    def __init__(self, recorder, interval=2.0, top_n=20, max_queued=10):
+        """Initializer.
+
+        :param recorder:      A CountingRecorder (or anything with
+                              `take_function_deltas` and
+                              `drop_function_deltas` methods).
+
+        :param interval=2.0:  Seconds between pushes.
+
+        :param top_n=20:      How many functions to include in each push.
+
+        :param max_queued=10: Events to queue for a subscriber before we
+                              start dropping events for it (so a stuck
+                              viewer cannot use unbounded memory).
+
+        """
+        self.recorder = recorder
+        self.interval = interval
+        self.top_n = top_n
+        self.max_queued = max_queued
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.producer = None
+        self.event_id = 0
+        self.consumer = 'live_top_%x' % id(self)  # key for recorder deltas
+
+    def make_event(self):
+        """Take deltas from the recorder and return dict describing them.
+
+        The result has the 'inclusive' and 'self' top-N lists of
+        [name, hits] since the last event, the number of 'samples' (stacks)
+        in that period, the event 'id' and the 'time'.
+        """
+        inclusive, self_hits = self.recorder.take_function_deltas(
+            self.consumer)
+        self.event_id += 1
+        return {
+            'id': self.event_id, 'time': time.time(),
+            'interval': self.interval, 'samples': sum(self_hits.values()),
+            'inclusive': [[name, hits] for name, hits in heapq.nlargest(
+                self.top_n, inclusive.items(), key=lambda item: item[1])],
+            'self': [[name, hits] for name, hits in heapq.nlargest(
+                self.top_n, self_hits.items(), key=lambda item: item[1])]}
+
+    def subscribe(self):
+        """Return a queue which will get each event (starting the producer).
+        """
+        my_queue = queue.Queue(maxsize=self.max_queued)
+        with self.lock:
+            self.subscribers.append(my_queue)
+            if self.producer is None:
+                self.producer = threading.Thread(
+                    target=self.produce, name='ox_profiler_LiveTop_Thread',
+                    daemon=True)
+                self.producer.start()
+        return my_queue
+
+    def unsubscribe(self, my_queue):
+        """Stop sending events to my_queue (from `subscribe`).
+        """
+        with self.lock:
+            if my_queue in self.subscribers:
+                self.subscribers.remove(my_queue)
+
+    def produce(self):
+        """Main loop for the producer thread (started by `subscribe`).
+
+        The thread exits once there are no subscribers left (and tells
+        the recorder to stop tracking deltas for us).
+        """
+        self.make_event()  # discard changes from before anyone was watching
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.subscribers:
+                    self.producer = None
+                    self.recorder.drop_function_deltas(self.consumer)
+                    return
+                subscribers = list(self.subscribers)
+            event = self.make_event()
+            for my_queue in subscribers:
+                try:
+                    my_queue.put_nowait(event)
+                except queue.Full:
+                    logging.debug('Dropping live event for slow subscriber')
+
+    def stream(self, timeout=None):
+        """Generate Server-Sent Event strings for a new subscriber.
+
+        :param timeout=None:  Seconds to wait for an event before sending
+                              SSE_KEEPALIVE (default 2*self.interval).
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  Generator of strings. The subscription ends when the
+                  generator is closed (e.g., when the client disconnects).
+
+        """
+        timeout = 2 * self.interval if timeout is None else timeout
+        my_queue = self.subscribe()
+        try:
+            while True:
+                try:
+                    event = my_queue.get(timeout=timeout)
+                except queue.Empty:
+                    yield SSE_KEEPALIVE
+                    continue
+                yield format_sse(event, event='top', event_id=event['id'])
+        finally:
+            self.unsubscribe(my_queue)
+
+
+if __name__ == '__main__':
+    # Run doctest if file executed as a script
+    doctest.testmod()
+    print('Finished Tests')
@@ -1,6 +1,283 @@
 """Module for handling measurement and sampling of data.
 """
 
+import re
+
+
+#: Prefix of the label used for a run of collapsed frames from one package.
+COLLAPSED_PREFIX = '...('
+
+
+class FrameFilter(object):
+    """Rules applied to frames at capture time.
+
+    Deep stacks are often mostly frames from libraries you do not own
+    (e.g., Flask, werkzeug, SQLAlchemy). A FrameFilter lets a Measurement
+    drop or collapse such frames while it captures a stack. That reduces
+    both the work per sample and the number of distinct stacks in the
+    recorder and makes `query` results focus on your own code.
+
+    The rules are:
+
+      - max_depth: walk at most this many frames back from the current
+        frame (the frames closest to the root are left out).
+      - drop_modules: regular expressions; frames whose module name
+        matches any of them are dropped.
+      - collapse_packages: top-level package names; a run of consecutive
+        frames from the same such package becomes one '...(package)' node.
+      - collapse_site_packages: if True, also collapse runs of frames from
+        any package installed in site-packages or dist-packages.
+
+    >>> import sys
+    >>> from ox_profile.core.metrics import Measurement, FrameFilter
+    >>> def outer():
+    ...     return inner()
+    ...
+    >>> def inner():
+    ...     return Measurement(sys._getframe(), frame_filter=FrameFilter(
+    ...         collapse_packages=[__name__.split('.')[0]]))
+    ...
+    >>> outer().name.endswith(';...(%s)' % __name__.split('.')[0])
+    True
+    """
+
+    def __init__(self, max_depth=None, drop_modules=None,
+                 collapse_packages=None, collapse_site_packages=False):
+        self.max_depth = max_depth
+        self.drop_modules = list(drop_modules or [])
+        self.drop_re = re.compile('|'.join(
+            '(?:%s)' % item for item in self.drop_modules)) if (
+                self.drop_modules) else None
+        self.collapse_packages = set(collapse_packages or [])
+        self.collapse_site_packages = collapse_site_packages
+
+    def label(self, frame):
+        """Return label for frame (or None if frame should be dropped).
+
+        Labels for collapsed frames start with COLLAPSED_PREFIX and
+        consecutive frames with the same collapsed label get merged.
+        """
+        module = frame.f_globals.get('__name__')
+        module_name = str(module)
+        if self.drop_re is not None and self.drop_re.search(module_name):
+            return None
+        package = module_name.split('.', 1)[0]
+        if package in self.collapse_packages or (
+                self.collapse_site_packages and self.is_site_package(
+                    frame.f_code.co_filename)):
+            return '%s%s)' % (COLLAPSED_PREFIX, package)
+        return '%s(%s)' % (frame.f_code.co_name, module)
+
+    @staticmethod
+    def is_site_package(filename):
+        "Return whether filename looks like it is for an installed package."
+        return 'site-packages' in filename or 'dist-packages' in filename
+
+
+def merge_label(labels, label):
+    """Append label to list of labels (applying FrameFilter collapsing).
+    """
+    if label is None:
+        return
+    if labels and label == labels[-1] and label.startswith(COLLAPSED_PREFIX):
+        return
+    labels.append(label)
+
+
+class StackCache(object):
+    """Cache of interned stack prefixes keyed on frame identity.
+
+    Most of a deep stack (server loop, WSGI, framework dispatch) is the
+    same from one sample to the next. Instead of walking `f_back` to the
+    root for every thread on every sample, a `Measurement` given a
+    StackCache stops at the first ancestor frame it already knows and
+    reuses the interned prefix id for that frame. That makes the cost of
+    a sample proportional to the part of the stack which changed.
+
+    Prefixes are interned as nodes in a tree where each node id stands
+    for a parent node plus one formatted function name. The full string
+    name is only built (and then remembered) for nodes which end up
+    being measured.
+
+    Frames do not support weak references so we key on `id(frame)`.
+    Since ids are reused once frames are freed, a new frame with the same
+    code, `f_lasti` and even parent id (e.g., a recursive caller at a
+    different depth) could look like a cached one. So each entry also
+    keeps the code of the frames between it and the nearest stored
+    ancestor (its anchor) along with the id and prefix of that anchor. A
+    hit must match all of those and the anchor's entry must match the
+    same way, and so on back to the root. Thus a hit means every frame on
+    the stack has the cached code (so the cached prefix is right even if
+    frames were reused). That check only compares code objects so it is
+    much cheaper than formatting and interning the stack. To keep the
+    cache small, we only remember the top two frames of a stack and
+    frames whose depth is a multiple of stride (so a walk goes at most
+    stride frames past the part of the stack which changed). The cache is bounded: when it holds max_size
+    frames we forget all frames and when it holds more than 4*max_size
+    prefixes we start over.
+
+    >>> import sys
+    >>> from ox_profile.core.metrics import Measurement, StackCache
+    >>> cache = StackCache()
+    >>> def measure(use_cache):
+    ...     return Measurement(sys._getframe(), cache=cache if use_cache
+    ...                        else None)
+    ...
+    >>> def outer():
+    ...     return [measure(True), measure(True), measure(False)]
+    ...
+    >>> first, second, uncached = outer()
+    >>> first.name == second.name == uncached.name
+    True
+    >>> second.depth < first.depth == uncached.depth
+    True
+    >>> second.depth <= cache.stride
+    True
+    """
+
+    def __init__(self, max_size=20000, stride=8):
+        self.max_size = max_size
+        self.stride = stride
+        self.frames = {}  # id(frame) -> tuple (see store)
+        self.nodes = {}  # (parent node, label) -> node id
+        self.parents = []  # node id -> (parent node, label)
+        self.depths = []  # node id -> depth of node in the stack
+        self.names = {}  # node id -> full formatted stack
+        self.labels = {}  # code object -> formatted function name
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """Remove everything from the cache."""
+        self.frames.clear()
+        self.nodes.clear()
+        self.parents = []
+        self.depths = []
+        self.names.clear()
+        self.labels.clear()
+
+    def lookup(self, frame):
+        """Return cached prefix node id for frame (or None if not known).
+        """
+        entry = self.frames.get(id(frame))
+        if entry is not None and self.is_valid(frame, entry):
+            self.hits += 1
+            return entry[5]
+        self.misses += 1
+        return None
+
+    def is_valid(self, frame, entry):
+        """Return whether cached entry from `store` still describes frame.
+
+        We check frame and the frames back to the entry's anchor and then
+        the anchor's entry in the same way until we reach the root.
+        """
+        frames = self.frames
+        while True:
+            code, lasti, path, anchor_id, anchor_node, dummy_node = entry
+            if code is not frame.f_code or lasti != frame.f_lasti:
+                return False
+            current = frame.f_back
+            for code in path:
+                if current is None or current.f_code is not code:
+                    return False
+                current = current.f_back
+            if anchor_id is None:
+                return current is None
+            if current is None or id(current) != anchor_id:
+                return False
+            entry = frames.get(anchor_id)
+            if entry is None or entry[5] != anchor_node:
+                return False
+            frame = current
+
+    def store(self, frame, node, anchor=None, anchor_node=None, path=(),
+              force=False):
+        """Remember that node is the prefix id for the stack ending at frame.
+
+        :param frame:     Frame to remember.
+
+        :param node:      Prefix node id for the stack ending at frame.
+
+        :param anchor=None:  Nearest ancestor of frame which is in the
+                             cache (None if there is none).
+
+        :param anchor_node=None:  Prefix node id cached for anchor.
+
+        :param path=():   Sequence of code objects for the frames from
+                          frame.f_back up to (but not including) anchor.
+
+        :param force=False:  Unless force is True, we skip nodes whose depth
+                             is not a multiple of self.stride.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  Whether frame was stored.
+
+        """
+        if self.depths[node] % self.stride and not force:
+            return False
+        if len(self.frames) >= self.max_size:
+            self.frames.clear()
+        self.frames[id(frame)] = (
+            frame.f_code, frame.f_lasti, tuple(path),
+            None if anchor is None else id(anchor), anchor_node, node)
+        return True
+
+    def intern(self, parent, label):
+        """Return node id for the prefix parent (node id or None) plus label.
+        """
+        key = (parent, label)
+        node = self.nodes.get(key)
+        if node is None:
+            node = len(self.parents)
+            self.nodes[key] = node
+            self.parents.append(key)
+            self.depths.append(1 if parent is None else (
+                self.depths[parent] + 1))
+        return node
+
+    def name(self, node):
+        """Return full semi-colon separated stack name for node id.
+        """
+        result = self.names.get(node)
+        if result is None:
+            labels = []
+            current = node
+            while current is not None:
+                current, label = self.parents[current]
+                labels.append(label)
+            result = ';'.join(reversed(labels))
+            self.names[node] = result
+        return result
+
+    def label(self, frame, frame_filter=None):
+        """Return formatted function name for frame.
+
+        If frame_filter is provided, we use its label method (which may
+        return None to drop the frame). The cache should only be used with
+        one frame_filter (see `clear`).
+        """
+        code = frame.f_code
+        result = self.labels.get(code, self)
+        if result is self:
+            if frame_filter is None:
+                result = '%s(%s)' % (code.co_name, frame.f_globals.get(
+                    '__name__'))
+            else:
+                result = frame_filter.label(frame)
+            self.labels[code] = result
+        return result
+
+    def check_size(self):
+        """Start over if we have interned too many prefixes.
+
+        This is called by Measurement before walking a stack (never in the
+        middle of a walk since that would invalidate node ids in use).
+        """
+        if len(self.parents) > 4 * self.max_size:
+            self.clear()
+
 
 class Measurement(object):
     """Measurement of profiling information.
@@ -19,12 +296,20 @@ class Measurement(object):
     records a hit for each of those. See the `query` method for details.
     """
 
-    def __init__(self, frame):
+    def __init__(self, frame, cache=None, frame_filter=None):
         """Initializer.
 
         :param frame:    Stack frame to measure.
 
+        :param cache=None:  Optional StackCache to reuse formatted stack
+                            prefixes from previous measurements.
+
+        :param frame_filter=None:  Optional FrameFilter to apply.
+
         """
+        self.depth = 0  # number of frames walked (set by snap)
+        self.cache = cache
+        self.frame_filter = frame_filter
         self.name = self.snap(frame)
 
     def get_path(self):
@@ -32,10 +317,34 @@ class Measurement(object):
         """
         return self.name.split(';')
 
+    @staticmethod
+    def walk(frame, max_depth=None):
+        """Return iterable of frames from frame back to the root of the stack.
+
+        :param frame:     Stack frame or a tuple of frames which was already
+                          walked (starting from the most recent frame). The
+                          tuple form is useful for engines which capture a
+                          stack and measure it later since the `f_back` of a
+                          suspended generator frame is no longer available.
+
+        :param max_depth=None:  Optional maximum number of frames to return.
+
+        """
+        if isinstance(frame, tuple):
+            return frame[:max_depth]
+        frames = []
+        while frame is not None:
+            frames.append(frame)
+            if len(frames) == max_depth:
+                break
+            frame = frame.f_back
+        return frames
+
     def snap(self, frame):
         """Snap a measurement for the given stack frame (called by __init__).
 
-        :param frame:     Stack frame to take a measurement about.
+        :param frame:     Stack frame (or tuple of frames as described in
+                          the `walk` method) to take a measurement about.
 
         ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
 
@@ -50,14 +359,71 @@ class Measurement(object):
                    backtrace as the name.
 
         """
-        stack = []
-        self.name = '%s(%s)' % (frame.f_code.co_name,
-                                frame.f_globals.get('__name__'))
+        frame_filter = self.frame_filter
+        max_depth = frame_filter.max_depth if frame_filter else None
+        if self.cache is not None and max_depth is None and not isinstance(
+                frame, tuple):
+            return self.snap_cached(frame, self.cache)
+        frames = self.walk(frame, max_depth)
+        self.depth = len(frames)
+        if frame_filter is None:
+            stack = ['%s(%s)' % (item.f_code.co_name, item.f_globals.get(
+                '__name__')) for item in reversed(frames)]
+        else:
+            stack = []
+            for item in reversed(frames):
+                merge_label(stack, frame_filter.label(item))
+            if not stack:  # everything was dropped so just show the top
+                stack = ['%s(%s)' % (frame.f_code.co_name,
+                                     frame.f_globals.get('__name__'))]
+
+        formatted_stack = ';'.join(stack)
+        return formatted_stack
+
+    def snap_cached(self, frame, cache):
+        """Like snap but reuse prefixes from cache (called by snap).
+
+        :param frame:     Stack frame to take a measurement about.
+
+        :param cache:     StackCache to lookup and store prefixes.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:   Same string as snap would return without a cache.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:   Walk back from frame only until we find an ancestor whose
+                   prefix is in the cache and then intern just the new
+                   frames (remembering their prefixes for next time).
+
+        """
+        cache.check_size()
+        new_frames = []
+        node = None
         while frame is not None:
-            formatted_frame = '%s(%s)' % (frame.f_code.co_name,
-                                          frame.f_globals.get('__name__'))
-            stack.append(formatted_frame)
+            node = cache.lookup(frame)
+            if node is not None:
+                break
+            new_frames.append(frame)
             frame = frame.f_back
+        self.depth = len(new_frames)
+        frame_filter = self.frame_filter
+        anchor, anchor_node, path = frame, node, []
+        for index in range(len(new_frames) - 1, -1, -1):
+            frame = new_frames[index]
+            label = cache.label(frame, frame_filter)
+            if label is not None and not (
+                    node is not None and label == cache.parents[node][1]
+                    and label.startswith(COLLAPSED_PREFIX)):
+                node = cache.intern(node, label)
+            if node is not None and cache.store(
+                    frame, node, anchor, anchor_node, path, force=index < 2):
+                anchor, anchor_node, path = frame, node, []
+            else:
+                path.insert(0, frame.f_code)
 
-        formatted_stack = ';'.join(reversed(stack))
-        return formatted_stack
+        if node is None:  # everything was dropped so just show the top
+            return '%s(%s)' % (new_frames[0].f_code.co_name,
+                               new_frames[0].f_globals.get('__name__'))
+        return cache.name(node)
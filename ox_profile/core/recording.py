@@ -1,9 +1,17 @@
 """Module for recording and saving measurements.
 """
 
+import heapq
+import itertools
+import os
 import re
+import sys
 import threading
+import time
 from collections import defaultdict, Counter
+from collections.abc import Mapping
+
+from ox_profile.core import callgraph, columnar, gil, states, timeseries
 
 
 RE_FILTER_ALL_CHARACTERS = '.*'
@@ -36,12 +44,74 @@ class ProfileRecord(object):
 
 class CountingRecorder(object):
     """Recorder which just counts how many times something is called.
+
+    Besides the count for each stack in self.my_db, we can keep per
+    function totals which are updated incrementally from the stacks
+    recorded since they were last needed (see `function_totals`). That
+    way things like a metrics endpoint which are polled frequently cost
+    time proportional to new data instead of a full `query`. We only
+    start tracking the stacks needed for that once something first asks
+    for function totals so recording costs nothing extra otherwise.
+
+    Results of `query` are cached in the same spirit. Each change to
+    self.my_db increments self.generation and (once `query` has been
+    called) appends the stack name to a journal. A cached result for a
+    given filter is brought up to date from just the journal entries
+    since the generation it was computed at.
+
+    Measurements with a `state` attribute (see
+    `Sampler.enable_state_labels`) are also counted in self.state_db so
+    that `query_states` can split hits by state while self.my_db (and
+    so everything computed from it) only has real frames.
+
+    >>> from ox_profile.core.recording import CountingRecorder
+    >>> class FakeMeasurement(object):
+    ...     def __init__(self, name):
+    ...         self.name = name
+    ...
+    >>> recorder = CountingRecorder()
+    >>> recorder.record(FakeMeasurement('main;work'))
+    >>> recorder.query()
+    ([ProfileRecord(name=main, hits=1), ProfileRecord(name=work, hits=1)], 1)
+    >>> lock_wait = recorder.record_many([FakeMeasurement('main;idle')] * 2)
+    >>> recorder.query(re_filter='^[iw]')
+    ([ProfileRecord(name=idle, hits=2), ProfileRecord(name=work, hits=1)], 2)
+    >>> recorder.generation, len(recorder.query_cache)
+    (3, 2)
     """
 
+    #: Maximum journal entries to keep before cached queries start over.
+    max_journal = 100000
+
+    #: Maximum number of distinct filters to cache query results for.
+    max_cached_filters = 32
+
+    #: Maximum number of consumers to track function deltas for (see
+    #: `take_function_deltas`).
+    max_delta_consumers = 16
+
+    #: If numpy is installed, compute query results from scratch with a
+    #: columnar.ColumnarProfile when we have at least this many stacks.
+    columnar_threshold = 50000
+
     def __init__(self):
         self.db_lock = threading.Lock()
         with self.db_lock:
             self.my_db = defaultdict(lambda: 0)
+            self.state_db = defaultdict(int)  # (name, state) -> hits
+            self.pending = None  # hits not yet in function_hits (if tracked)
+            self.function_hits = Counter()  # hits for each function in stack
+            self.self_hits = Counter()  # hits where function is at the top
+            self.graph = callgraph.CallGraph()  # caller -> callee edges
+            self.total_hits = 0
+            self.deltas = {}  # consumer -> (function_hits, self_hits) changes
+            self.generation = 0  # incremented by each change to my_db
+            self.journal = None  # stack names recorded since journal_start
+            self.journal_start = 0  # generation of self.journal[0]
+            self.query_cache = {}  # re_filter -> _FilterTally
+            self.columnar = None  # (generation, columnar.ColumnarProfile)
+            self.series = None  # see enable_time_series
+            self.series_due = 0  # time when series needs _fold_pending
 
     def record(self, measurement):
         """Record a measurement.
@@ -56,7 +126,345 @@ class CountingRecorder(object):
 
         """
         with self.db_lock:
+            if self.series is not None and time.time() >= self.series_due:
+                self._fold_pending()  # pending hits are from an earlier second
             self.my_db[measurement.name] += 1
+            if self.pending is not None:
+                self.pending[measurement.name] += 1
+            state = getattr(measurement, 'state', None)
+            if state is not None:
+                self.state_db[(measurement.name, state)] += 1
+            self.generation += 1
+            if self.journal is not None:
+                self.journal.append(measurement.name)
+                if len(self.journal) > self.max_journal:
+                    self.journal = None  # cached queries will start over
+
+    def record_many(self, measurements):
+        """Record a sequence of measurements while holding the lock once.
+
+        :param measurements:    Sequence of measurements as for `record`.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  Time in seconds spent waiting to acquire self.db_lock.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Used by the Sampler to record all the threads in a sample
+                  at once and to track how much lock contention there is.
+
+        """
+        start = time.perf_counter()
+        with self.db_lock:
+            lock_wait = time.perf_counter() - start
+            if self.series is not None and time.time() >= self.series_due:
+                self._fold_pending()  # pending hits are from an earlier second
+            my_db, pending = self.my_db, self.pending
+            for measurement in measurements:
+                my_db[measurement.name] += 1
+                if pending is not None:
+                    pending[measurement.name] += 1
+                state = getattr(measurement, 'state', None)
+                if state is not None:
+                    self.state_db[(measurement.name, state)] += 1
+            if self.journal is not None:
+                size = len(self.journal)
+                self.journal.extend(m.name for m in measurements)
+                self.generation += len(self.journal) - size
+                if len(self.journal) > self.max_journal:
+                    self.journal = None  # cached queries will start over
+            else:
+                self.generation += len(measurements)
+        return lock_wait
+
+    def _reset_journal(self):
+        """Start the journal over at the current generation.
+
+        *IMPORTANT*:  Caller must hold self.db_lock.
+
+        Cached queries computed before now will be recomputed in full.
+        """
+        self.journal = []
+        self.journal_start = self.generation
+
+    def _get_tally(self, re_filter):
+        """Return up to date _FilterTally for re_filter.
+
+        *IMPORTANT*:  Caller must hold self.db_lock.
+
+        Recording drops the journal once it has more than self.max_journal
+        entries (so memory stays bounded if nobody queries) and then we
+        start a new one here.
+        """
+        if self.journal is None:
+            self._reset_journal()
+        tally = self.query_cache.get(re_filter)
+        if tally is None or tally.generation < self.journal_start:
+            if tally is None and len(self.query_cache) >= (
+                    self.max_cached_filters):
+                self.query_cache.pop(next(iter(self.query_cache)))
+            tally = _FilterTally(re_filter)
+            # Use explicit list in case dict changes during iteration
+            items = list(self.my_db.items())
+            if len(items) >= self.columnar_threshold and (
+                    columnar.get_numpy() is not None):
+                tally.add_columnar(self._get_columnar(items))
+            else:
+                tally.add(items)
+            self.query_cache[re_filter] = tally
+        elif tally.generation < self.generation:
+            tally.add((name, 1) for name in self.journal[
+                tally.generation - self.journal_start:])
+        tally.generation = self.generation
+        return tally
+
+    def _get_columnar(self, items):
+        """Return ColumnarProfile for items (from self.my_db) reusing if able.
+
+        *IMPORTANT*:  Caller must hold self.db_lock.
+
+        We keep the profile for the current generation so querying with
+        several filters only builds it once.
+        """
+        if self.columnar is None or self.columnar[0] != self.generation:
+            self.columnar = (self.generation,
+                             columnar.ColumnarProfile.from_stacks(items))
+        return self.columnar[1]
+
+    def to_columnar(self, use_numpy=None):
+        """Return a columnar.ColumnarProfile of the current stacks.
+
+        :param use_numpy=None:  Whether to use numpy (default is to use it
+                                if it is installed).
+
+        """
+        return columnar.ColumnarProfile.from_stacks(self.stacks(), use_numpy)
+
+    def _fold_pending(self):
+        """Fold self.pending into per function totals and self.graph.
+
+        *IMPORTANT*:  Caller must hold self.db_lock.
+
+        The first call starts tracking self.pending and folds in all of
+        self.my_db. If time series are enabled, pending hits were all
+        recorded in the second before self.series_due (recording in a
+        later second folds first) so that is the bucket they go in.
+        """
+        pending = self.my_db if self.pending is None else self.pending
+        self.pending = defaultdict(int)
+        fold_hits, fold_self, fold_total = Counter(), Counter(), 0
+        graph = self.graph
+        for name, hits in pending.items():
+            name_list = name.split(';')
+            graph.add(name_list, hits)
+            for fname in name_list:
+                fold_hits[fname] += hits
+            fold_self[name_list[-1]] += hits
+            fold_total += hits
+        self.function_hits.update(fold_hits)
+        self.self_hits.update(fold_self)
+        self.total_hits += fold_total
+        for delta_hits, delta_self in self.deltas.values():
+            delta_hits.update(fold_hits)
+            delta_self.update(fold_self)
+        if self.series is not None:
+            if fold_total:
+                self.series.add(self.series_due - 1, fold_hits, fold_total)
+            self.series_due = max(self.series_due, int(time.time()) + 1)
+
+    def enable_time_series(self, levels=None, max_functions=200):
+        """Start keeping a time series of hits for active functions.
+
+        :param levels=None, max_functions=200:  As for
+                                     `timeseries.FunctionSeries`.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  The `timeseries.FunctionSeries` in self.series. If time
+                  series were already enabled, we return the existing one.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Once enabled, recording a measurement in a new second
+                  first folds pending hits into the bucket for the second
+                  they were recorded in so each second gets the hits
+                  recorded during it (and quiet seconds stay empty).
+
+        """
+        with self.db_lock:
+            if self.series is None:
+                self._fold_pending()  # so older hits are not in the series
+                self.series = timeseries.FunctionSeries(
+                    levels=levels, max_functions=max_functions)
+                self.series_due = int(time.time()) + 1
+            return self.series
+
+    def reset(self):
+        """Forget all recorded stacks (e.g., to start a fresh profile).
+
+        Settings such as the time series (and its history) are kept.
+        """
+        with self.db_lock:
+            self.my_db = defaultdict(lambda: 0)
+            self.state_db = defaultdict(int)
+            if self.pending is not None:
+                self.pending = defaultdict(int)
+            self.function_hits = Counter()
+            self.self_hits = Counter()
+            self.graph = callgraph.CallGraph()
+            self.total_hits = 0
+            self.deltas = dict((consumer, (Counter(), Counter()))
+                               for consumer in self.deltas)
+            self.generation += 1
+            if self.journal is not None:
+                self._reset_journal()
+            self.query_cache = {}
+            self.columnar = None
+
+    def take_function_deltas(self, consumer=None):
+        """Return and reset per function hits since the last call.
+
+        :param consumer=None:  Key for the consumer (e.g., a name) so
+                               several consumers can each see changes
+                               since their own previous call.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  The pair (function_hits, self_hits) of Counter instances
+                  with the change in the values from `function_totals`
+                  since the previous call by consumer. The first call
+                  starts tracking changes (and returns empty counters).
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Let consumers (e.g., `live.LiveTop`) see what changed
+                  without diffing all the totals. Tracking deltas costs a
+                  little extra in `_fold_pending` for each consumer so we
+                  only do it once a consumer has asked for them and keep
+                  at most self.max_delta_consumers (forgetting the oldest
+                  first). Call `drop_function_deltas` once a consumer is
+                  done.
+
+        """
+        with self.db_lock:
+            self._fold_pending()
+            if consumer not in self.deltas and len(self.deltas) >= (
+                    self.max_delta_consumers):
+                self.deltas.pop(next(iter(self.deltas)))
+            result = self.deltas.pop(consumer, None)
+            self.deltas[consumer] = (Counter(), Counter())
+            return result if result is not None else (Counter(), Counter())
+
+    def drop_function_deltas(self, consumer=None):
+        """Stop tracking deltas for consumer (see `take_function_deltas`).
+        """
+        with self.db_lock:
+            self.deltas.pop(consumer, None)
+
+    def function_totals(self, limit=None):
+        """Return per function hit totals maintained incrementally.
+
+        :param limit=None:     Optional maximum number of functions to return.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  List of (name, hits, self_hits) tuples sorted by hits
+                  where hits counts each appearance of the function in a
+                  stack (as in `query` with no filter) and self_hits counts
+                  how often the function was at the top of the stack.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Unlike `query`, this only processes the stacks recorded
+                  since the last call so it is cheap to call frequently.
+                  The first call processes all stacks and starts tracking
+                  new ones.
+
+        """
+        with self.db_lock:
+            self._fold_pending()
+            if limit is None:
+                top = self.function_hits.most_common()
+            else:
+                top = heapq.nlargest(limit, self.function_hits.items(),
+                                     key=lambda item: item[1])
+            return [(name, hits, self.self_hits.get(name, 0))
+                    for name, hits in top]
+
+    def callees(self, name, limit=None):
+        """Return functions called by name as a list of callgraph.CallEdge.
+
+        :param name:        Function name as in `query` results (e.g.,
+                            'render(app.views)').
+
+        :param limit=None:  Optional maximum number of edges to return.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  List of CallEdge(name, inclusive, self_hits) sorted by
+                  inclusive hits (see `callgraph.CallGraph.callees`).
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Show where time goes beneath a function. The call graph
+                  is updated from stacks recorded since it was last needed
+                  and the lookup only looks at the edges of name.
+
+        """
+        with self.db_lock:
+            self._fold_pending()
+            return self.graph.callees(name, limit)
+
+    def callers(self, name, limit=None):
+        """Return functions calling name as a list of callgraph.CallEdge.
+
+        See `callees` for details.
+        """
+        with self.db_lock:
+            self._fold_pending()
+            return self.graph.callers(name, limit)
+
+    def series_report(self, resolution=60, limit=20, now=None):
+        """Return dict describing time series from `enable_time_series`.
+
+        :param resolution=60:  Resolution (in seconds) of one of the
+                               levels of self.series.
+
+        :param limit=20:       Maximum number of functions to include.
+
+        :param now=None:       Time of the last bucket (default is now).
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  None if time series are not enabled and otherwise a dict
+                  with 'resolution', 'now', 'total' (list of (bucket start,
+                  samples)), 'functions' (list of (name, list of (bucket
+                  start, hits)) pairs for the most active functions) and
+                  'anomalies' (see `timeseries.FunctionSeries.anomalies`).
+
+        """
+        now = time.time() if now is None else now
+        with self.db_lock:
+            if self.series is None:
+                return None
+            self._fold_pending()
+            return self.series.report(resolution, now, limit)
+
+    def size_info(self):
+        """Return dict describing how much data is in the recorder.
+
+        The 'approx_bytes' entry is an estimate of the memory used by the
+        keys and values in the database. This is O(number of records) so
+        only call it when you need it (e.g., when showing status).
+        """
+        with self.db_lock:
+            items = list(self.my_db.items())
+        approx_bytes = sys.getsizeof(self.my_db) + sum(
+            sys.getsizeof(name) + sys.getsizeof(hits) for name, hits in items)
+        return {'distinct_stacks': len(items),
+                'hits': sum(hits for dummy_name, hits in items),
+                'approx_bytes': approx_bytes}
 
     def query(self, re_filter=RE_FILTER_ALL_CHARACTERS, max_records=10):
         """Query the database of measurements.
@@ -83,25 +491,21 @@ class CountingRecorder(object):
                    we take apart the name into the backtrace and record
                    a hit for everything in the backtrace.
 
+                   Results are cached per re_filter and updated
+                   incrementally from the stacks recorded since the
+                   previous query (see the class docstring) so calling
+                   query repeatedly is cheap.
+
         """
-        if re_filter in (None, RE_FILTER_ALL_CHARACTERS):
-            regexp = None
-        else:
-            regexp = re.compile(re_filter)
-        calls_counter = Counter()
+        if re_filter is None:
+            re_filter = RE_FILTER_ALL_CHARACTERS
         # Lock so we don't mess with db during query.
         # *IMPORTANT: be careful in code below to not do anything to
         # call self.record or anything else which would try to acquire
         # self.db_lock otherwise you will deadlock
         with self.db_lock:
             num_records = len(self.my_db)
-            # Use explicit list in case dict changes during iteration
-            for name, item in list(self.my_db.items()):
-                name_list = name.split(';')
-                for fname in name_list:
-                    if not regexp or regexp.search(fname):
-                        calls_counter[fname] += item
-            my_hits = calls_counter.most_common(max_records)
+            my_hits = self._get_tally(re_filter).top(max_records)
             result = [ProfileRecord(name, hits) for name, hits in my_hits]
             return result, num_records
 
@@ -153,3 +557,451 @@ class CountingRecorder(object):
                                                   for i in query]) + line_sep
 
         return text
+
+    def query_states(self, re_filter=RE_FILTER_ALL_CHARACTERS,
+                     max_records=10):
+        """Return hits of functions matching re_filter split by state.
+
+        :param re_filter, max_records:  As for `query`.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  The pair (records, totals) from `states.breakdown`
+                  where records are `states.StateRecord` tuples with
+                  hits interpreting python, calling native code or
+                  blocked. Unless `Sampler.enable_state_labels` was
+                  called, every sample counts as python.
+
+        """
+        return states.breakdown(self.state_stacks(), re_filter, max_records)
+
+    def show_states(self, limit=10, re_filter=RE_FILTER_ALL_CHARACTERS):
+        """Return string showing the output of `query_states`.
+        """
+        return states.show_breakdown(*self.query_states(re_filter, limit))
+
+    def stacks(self):
+        """Return list of (stack name, hits) pairs from self.my_db.
+
+        The list is a shallow copy taken while holding the lock so you
+        can process it (e.g., to export a profile) while recording goes on.
+        """
+        with self.db_lock:
+            return list(self.my_db.items())
+
+    def state_stacks(self):
+        """Return list of (stack name, hits) pairs labelled by state.
+
+        Hits of a stack in a state other than python (see self.state_db)
+        get the pseudo-frame for the state (e.g., '[blocked]') at the
+        top as expected by `states.breakdown`. Only `query_states` uses
+        these; other results never see pseudo-frames.
+        """
+        with self.db_lock:
+            python_hits = dict(self.my_db)
+            labelled = list(self.state_db.items())
+        result = []
+        for (name, state), hits in labelled:
+            python_hits[name] -= hits
+            result.append(('%s;%s' % (name, states.STATE_FRAMES[state]), hits))
+        result.extend(item for item in python_hits.items() if item[1])
+        return result
+
+    def save(self, my_fd, metadata=None):
+        """Save the database to a file in the "folded stacks" format.
+
+        :param my_fd:          File-like object open for writing text.
+
+        :param metadata=None:  Optional dict of metadata (e.g., host or
+                               release) to write as header comments.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  Number of stacks written.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Persist a profile. Each line is the semi-colon separated
+                  stack (as in self.my_db) followed by a space and the hit
+                  count, which is the format used by flame graph tools.
+                  Header lines look like '# key: value'. Use `load` to
+                  read the file back.
+
+        """
+        items = self.stacks()
+        my_fd.write('%s\n' % FOLDED_HEADER)
+        for key, value in sorted((metadata or {}).items()):
+            my_fd.write('# %s: %s\n' % (key, value))
+        for name, hits in items:
+            my_fd.write('%s %i\n' % (name, hits))
+        return len(items)
+
+    def load(self, my_fd):
+        """Load (and add to self) data saved with the `save` method.
+
+        :param my_fd:      File-like object open for reading text.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  Dict of metadata from the header.
+
+        """
+        metadata = {}
+        self.add_stacks(parse_folded(my_fd, metadata))
+        return metadata
+
+    def add_stacks(self, stacks):
+        """Add hits from an iterable of (stack name, hits) pairs.
+        """
+        for name, hits in stacks:
+            with self.db_lock:
+                self.my_db[name] += hits
+                if self.pending is not None:
+                    self.pending[name] += hits
+                self.generation += 1
+                if self.journal is not None:
+                    self._reset_journal()
+
+
+class _FilterTally(object):
+    """Per function hits matching one regular expression (see query).
+    """
+
+    def __init__(self, re_filter):
+        self.re_filter = re_filter
+        self.regexp = None if re_filter == RE_FILTER_ALL_CHARACTERS else (
+            re.compile(re_filter))
+        self.matches = {}  # function name -> whether regexp matches it
+        self.counter = Counter()
+        self.generation = 0  # recorder generation counter is current as of
+        self.top_hits = None  # (generation, max_records, top hits)
+
+    def add(self, items):
+        """Add hits from iterable of (stack name, hits) pairs.
+        """
+        regexp, matches, counter = self.regexp, self.matches, self.counter
+        for name, hits in items:
+            for fname in name.split(';'):
+                if regexp is not None:
+                    matched = matches.get(fname)
+                    if matched is None:
+                        matched = regexp.search(fname) is not None
+                        matches[fname] = matched
+                    if not matched:
+                        continue
+                counter[fname] += hits
+
+    def add_columnar(self, profile):
+        """Add hits from a columnar.ColumnarProfile.
+        """
+        for name, hits in profile.top(profile.inclusive_totals(), None,
+                                      profile.match(self.re_filter)):
+            self.counter[name] += hits
+
+    def top(self, max_records):
+        """Return counter.most_common(max_records) (cached per generation).
+
+        We only keep the latest result (max_records comes from callers
+        such as web requests so caching each would not be bounded) and
+        slice it for smaller max_records in the same generation.
+        """
+        cached = self.top_hits
+        if cached is not None and cached[0] == self.generation and (
+                cached[1] is None or max_records is not None and (
+                    max_records <= cached[1])):
+            return cached[2][:max_records]
+        result = self.counter.most_common(max_records)
+        self.top_hits = (self.generation, max_records, result)
+        return result
+
+
+class _SharedSeries(object):
+    """A timeseries.FunctionSeries which the shards of a ShardedRecorder
+    fold into (each while holding only its own lock).
+    """
+
+    def __init__(self, series):
+        self.series = series
+        self.levels = series.levels
+        self.lock = threading.Lock()
+
+    def add(self, when, function_hits, total_hits):
+        "Add hits to self.series while holding self.lock."
+        with self.lock:
+            self.series.add(when, function_hits, total_hits)
+
+
+class _ShardedView(Mapping):
+    """Read only dict-like view of the stacks in all shards.
+    """
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def __getitem__(self, name):
+        shard = self.recorder.shard_for(name)
+        with shard.db_lock:
+            hits = shard.my_db.get(name)
+        if hits is None:
+            raise KeyError(name)
+        return hits
+
+    def __iter__(self):
+        return (name for name, dummy in self.recorder.stacks())
+
+    def __len__(self):
+        return sum(len(shard.my_db) for shard in self.recorder.shards)
+
+
+class ShardedRecorder(object):
+    """Recorder which spreads stacks over shards with one lock each.
+
+    A `CountingRecorder` has a single lock which every sample and every
+    reader takes. On a free-threaded (no GIL) python, samplers and readers
+    really do run at the same time so that lock serializes them. Here each
+    stack name is hashed to one of several CountingRecorder shards so
+    writers to different shards do not contend, and readers such as
+    `query` lock one shard at a time and merge per function totals (not
+    stacks) from each shard's incrementally cached results.
+
+    It has the same interface as CountingRecorder so it can be used
+    anywhere that one can (see also `make_recorder`).
+
+    >>> from ox_profile.core.recording import ShardedRecorder
+    >>> class FakeMeasurement(object):
+    ...     def __init__(self, name):
+    ...         self.name = name
+    ...
+    >>> recorder = ShardedRecorder(shards=4)
+    >>> lock_wait = recorder.record_many([FakeMeasurement('main;work')] * 3
+    ...                                  + [FakeMeasurement('main;idle')])
+    >>> recorder.query()
+    ([ProfileRecord(name=main, hits=4), ProfileRecord(name=work, hits=3), \
+ProfileRecord(name=idle, hits=1)], 2)
+    >>> len(recorder.my_db), recorder.my_db['main;work']
+    (2, 3)
+    """
+
+    def __init__(self, shards=None):
+        """Initializer.
+
+        :param shards=None:  Number of shards. Default is twice the number
+                             of CPUs (at least 4 and at most 64).
+
+        """
+        if shards is None:
+            shards = min(64, max(4, 2 * (os.cpu_count() or 1)))
+        self.shards = [CountingRecorder() for dummy in range(shards)]
+        self.my_db = _ShardedView(self)
+        self.series = None  # see enable_time_series
+
+    def shard_for(self, name):
+        "Return the shard which holds stack name."
+        return self.shards[hash(name) % len(self.shards)]
+
+    def record(self, measurement):
+        """Record a measurement (see `CountingRecorder.record`).
+        """
+        self.shard_for(measurement.name).record(measurement)
+
+    def record_many(self, measurements):
+        """Record a sequence of measurements (see CountingRecorder).
+
+        :return:  Total time in seconds spent waiting for shard locks.
+
+        """
+        groups = defaultdict(list)
+        num_shards = len(self.shards)
+        for measurement in measurements:
+            groups[hash(measurement.name) % num_shards].append(measurement)
+        return sum(self.shards[index].record_many(group)
+                   for index, group in groups.items())
+
+    def query(self, re_filter=RE_FILTER_ALL_CHARACTERS, max_records=10):
+        """Query the measurements (see `CountingRecorder.query`).
+
+        Each shard keeps its own incrementally updated totals for
+        re_filter; we add up the per function totals of the shards.
+        """
+        if re_filter is None:
+            re_filter = RE_FILTER_ALL_CHARACTERS
+        total, num_records = Counter(), 0
+        for shard in self.shards:
+            with shard.db_lock:
+                num_records += len(shard.my_db)
+                total.update(shard._get_tally(  # pylint: disable=protected-access
+                    re_filter).counter)
+        return [ProfileRecord(name, hits) for name, hits in total.most_common(
+            max_records)], num_records
+
+    def function_totals(self, limit=None):
+        """Return per function totals (see CountingRecorder.function_totals).
+        """
+        hits, self_hits = Counter(), Counter()
+        for shard in self.shards:
+            with shard.db_lock:
+                shard._fold_pending()  # pylint: disable=protected-access
+                hits.update(shard.function_hits)
+                self_hits.update(shard.self_hits)
+        if limit is None:
+            top = hits.most_common()
+        else:
+            top = heapq.nlargest(limit, hits.items(), key=lambda item: item[1])
+        return [(name, count, self_hits[name]) for name, count in top]
+
+    def _merge_edges(self, method, name, limit):
+        "Add up CallEdge lists from method of each shard."
+        totals = defaultdict(lambda: [0, 0])
+        for shard in self.shards:
+            for edge in getattr(shard, method)(name):
+                totals[edge.name][0] += edge.inclusive
+                totals[edge.name][1] += edge.self_hits
+        edges = sorted((callgraph.CallEdge(other, inclusive, self_hits)
+                        for other, (inclusive, self_hits) in totals.items()),
+                       key=lambda edge: edge.inclusive, reverse=True)
+        return edges if limit is None else edges[:limit]
+
+    def callees(self, name, limit=None):
+        """Return functions called by name (see CountingRecorder.callees).
+        """
+        return self._merge_edges('callees', name, limit)
+
+    def callers(self, name, limit=None):
+        """Return functions calling name (see CountingRecorder.callers).
+        """
+        return self._merge_edges('callers', name, limit)
+
+    def take_function_deltas(self, consumer=None):
+        """Return per function changes (see CountingRecorder).
+        """
+        hits, self_hits = Counter(), Counter()
+        for shard in self.shards:
+            shard_hits, shard_self = shard.take_function_deltas(consumer)
+            hits.update(shard_hits)
+            self_hits.update(shard_self)
+        return hits, self_hits
+
+    def drop_function_deltas(self, consumer=None):
+        """Stop tracking deltas for consumer (see CountingRecorder).
+        """
+        for shard in self.shards:
+            shard.drop_function_deltas(consumer)
+
+    def enable_time_series(self, levels=None, max_functions=200):
+        """Start keeping time series of function hits for all shards.
+
+        :return:  The `timeseries.FunctionSeries` in self.series.
+
+        """
+        if self.series is None:
+            shared = _SharedSeries(timeseries.FunctionSeries(
+                levels=levels, max_functions=max_functions))
+            for shard in self.shards:
+                with shard.db_lock:
+                    shard._fold_pending()  # pylint: disable=protected-access
+                    shard.series = shared
+                    shard.series_due = int(time.time()) + 1
+            self.series = shared.series
+        return self.series
+
+    def series_report(self, resolution=60, limit=20, now=None):
+        """Return time series report (see CountingRecorder.series_report).
+        """
+        now = time.time() if now is None else now
+        if self.series is None:
+            return None
+        for shard in self.shards:
+            with shard.db_lock:
+                shard._fold_pending()  # pylint: disable=protected-access
+        shared = self.shards[0].series
+        with shared.lock:
+            return self.series.report(resolution, now, limit)
+
+    def size_info(self):
+        """Return dict describing how much data is in the recorder.
+        """
+        result = {'distinct_stacks': 0, 'hits': 0, 'approx_bytes': 0}
+        for shard in self.shards:
+            for key, value in shard.size_info().items():
+                result[key] += value
+        result['shards'] = len(self.shards)
+        return result
+
+    def stacks(self):
+        """Return list of (stack name, hits) pairs from all shards.
+        """
+        return list(itertools.chain.from_iterable(
+            shard.stacks() for shard in self.shards))
+
+    def state_stacks(self):
+        """Return stacks labelled by state (see CountingRecorder).
+        """
+        return list(itertools.chain.from_iterable(
+            shard.state_stacks() for shard in self.shards))
+
+    def to_columnar(self, use_numpy=None):
+        """Return a columnar.ColumnarProfile of the current stacks.
+        """
+        return columnar.ColumnarProfile.from_stacks(self.stacks(), use_numpy)
+
+    def add_stacks(self, stacks):
+        """Add hits from an iterable of (stack name, hits) pairs.
+        """
+        groups = defaultdict(list)
+        for name, hits in stacks:
+            groups[hash(name) % len(self.shards)].append((name, hits))
+        for index, items in groups.items():
+            self.shards[index].add_stacks(items)
+
+    def reset(self):
+        """Forget all recorded stacks (see CountingRecorder.reset).
+        """
+        for shard in self.shards:
+            shard.reset()
+
+    # These only use the methods above so we share them.
+    show = CountingRecorder.show
+    query_states = CountingRecorder.query_states
+    show_states = CountingRecorder.show_states
+    save = CountingRecorder.save
+    load = CountingRecorder.load
+
+
+def make_recorder():
+    """Return a recorder suited to the running python.
+
+    This is a ShardedRecorder if the GIL is disabled (a free-threaded
+    build) and a CountingRecorder otherwise.
+    """
+    if gil.is_enabled():
+        return CountingRecorder()
+    return ShardedRecorder()
+
+
+FOLDED_HEADER = '# ox_profile folded stacks'
+
+
+def parse_folded(my_fd, metadata=None):
+    """Generate (name, hits) pairs from a file in the folded stacks format.
+
+    :param my_fd:          File-like object open for reading text.
+
+    :param metadata=None:  Optional dict to update with header metadata.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Generator of (name, hits) pairs so large files can be
+              processed without reading everything into memory.
+
+    """
+    for line in my_fd:
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        if line.startswith('#'):
+            if metadata is not None and ': ' in line:
+                key, value = line[1:].split(': ', 1)
+                metadata[key.strip()] = value
+            continue
+        name, hits = line.rsplit(' ', 1)
+        yield name, int(hits)
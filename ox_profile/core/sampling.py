@@ -1,11 +1,21 @@
 """Tools to sample running programs.
 """
 
+import collections
 import doctest
+import functools
+import itertools
 import logging
+import re
 import sys
+import threading
+import time
 
-from ox_profile.core import metrics
+from ox_profile.core import contention, gil, metrics, states
+
+
+SampleInfo = collections.namedtuple('SampleInfo', [
+    'capture_time', 'lock_wait', 'frames', 'threads'])
 
 
 class Freezer(object):
@@ -40,6 +50,55 @@ class Freezer(object):
         logging.debug(self._log_msg_template, self._stored_interval_value)
 
 
+class NullFreezer(object):
+    """Freezer which does nothing.
+
+    On free-threaded builds (where `gil.is_enabled()` is False) other
+    threads keep running no matter what the switch interval is, so
+    there is no point in changing it. The `Sampler` instead walks each
+    stack right after capturing it and skips stacks which change in a
+    way that breaks the walk.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+def make_freezer():
+    "Return a Freezer or a NullFreezer if the GIL is disabled."
+    return Freezer() if gil.is_enabled() else NullFreezer()
+
+
+class ThreadNameFilter(object):
+    """Thread filter for a Sampler which matches thread names to a regexp.
+
+    >>> import threading
+    >>> from ox_profile.core.sampling import ThreadNameFilter
+    >>> my_filter = ThreadNameFilter('^MainThread$')
+    >>> my_filter(threading.main_thread().ident)
+    True
+
+    Thread names are looked up (via `threading.enumerate`) only when we
+    see a thread id we do not know about, so calling this is cheap.
+    """
+
+    def __init__(self, re_filter):
+        self.regexp = re.compile(re_filter)
+        self.known = {}
+
+    def __call__(self, thread_id):
+        result = self.known.get(thread_id)
+        if result is None:
+            self.known = {
+                t.ident: bool(self.regexp.search(t.name))
+                for t in threading.enumerate()}
+            result = self.known.setdefault(thread_id, False)
+        return result
+
+
 class Sampler(object):
     """Basic class to sample program for statistical profiling.
 
@@ -83,9 +142,113 @@ of this class.
 
     """
 
-    def __init__(self, my_db, freezer=None):
+    def __init__(self, my_db, freezer=None, thread_filter=None,
+                 cache_size=20000, frame_filter=None):
+        """Initializer.
+
+        :param my_db:     Recorder (e.g., a `recording.CountingRecorder`)
+                          to record measurements in.
+
+        :param freezer=None:  Optional Freezer (if None, we use
+                              `make_freezer`).
+
+        :param thread_filter=None:  Optional callable taking a thread id
+                                    and returning whether to sample that
+                                    thread (see `ThreadNameFilter`). If
+                                    None, we sample all threads.
+
+        :param cache_size=20000:    Maximum size of the `metrics.StackCache`
+                                    used to avoid re-walking unchanged
+                                    stack prefixes (0 to disable).
+
+        :param frame_filter=None:   Optional `metrics.FrameFilter` to drop
+                                    or collapse frames at capture time.
+
+        """
         self.my_db = my_db
-        self.freezer = freezer or Freezer()
+        self.freezer = freezer or make_freezer()
+        self.thread_filter = thread_filter
+        self.stack_cache = metrics.StackCache(cache_size) if (
+            cache_size) else None
+        self.frame_filter = frame_filter
+        self.gil_estimator = None  # see enable_gil_estimation
+        self.contention = None  # see enable_contention
+        self.thread_tags = None  # see enable_thread_tags
+        self.label_states = False  # see enable_state_labels
+        self.tolerate_torn = not gil.is_enabled()  # see record_frames
+        self.torn_stacks = 0  # stacks skipped since they changed mid-walk
+
+    def enable_gil_estimation(self, **kwargs):
+        """Start estimating GIL utilization and contention in `run`.
+
+        :param **kwargs:  Passed to `gil.GILEstimator`.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  The `gil.GILEstimator` in self.gil_estimator (the
+                  existing one if estimation was already enabled). Call
+                  its `report` method to see results.
+
+        """
+        if self.gil_estimator is None:
+            self.gil_estimator = gil.GILEstimator(**kwargs)
+        return self.gil_estimator
+
+    def enable_contention(self, **kwargs):
+        """Start grouping samples blocked on locks by lock in `run`.
+
+        :param **kwargs:  Passed to `contention.ContentionProfiler`.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  The `contention.ContentionProfiler` in self.contention
+                  (the existing one if contention profiling was already
+                  enabled). Call its `report` method to see results.
+
+        """
+        if self.contention is None:
+            self.contention = contention.ContentionProfiler(**kwargs)
+        return self.contention
+
+    def enable_thread_tags(self):
+        """Start prefixing stacks of tagged threads with their tag in `run`.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  The dict in self.thread_tags (the existing one if tags
+                  were already enabled). Put thread_id -> tag in it (e.g.,
+                  as `ox_profile.middleware.WSGIMiddleware` does for the
+                  request a thread is serving) and remove it when done.
+                  Stacks sampled from that thread are then recorded as
+                  'tag;main;...' so you can query or filter by tag.
+
+        """
+        if self.thread_tags is None:
+            self.thread_tags = {}
+        return self.thread_tags
+
+    def enable_state_labels(self):
+        """Start recording the state of each sample.
+
+        Samples whose top frame is calling a native function are
+        recorded as native and those calling a known blocking function
+        as blocked (see `states.classify`). The recorder keeps these
+        apart from the stacks so profiles are unchanged. Use
+        `CountingRecorder.query_states` to see the breakdown.
+        """
+        self.label_states = True
+
+    def set_frame_filter(self, frame_filter):
+        """Set the `metrics.FrameFilter` to use (or None for no filtering).
+
+        Since cached stack prefixes depend on the filter, this also replaces
+        self.stack_cache with a new one (we do not clear the old one in case
+        another thread is using it).
+        """
+        self.frame_filter = frame_filter
+        if self.stack_cache is not None:
+            self.stack_cache = metrics.StackCache(self.stack_cache.max_size,
+                                                  self.stack_cache.stride)
 
     def show(self, *args, **kwargs):
         """Syntactic sugar self.my_db.show(*args, **kwargs) to show results.
@@ -112,21 +275,107 @@ of this class.
 
         PURPOSE:  This method provides the "measurement tool" we are going
                   to use in profiling. Sub-classes could override this to
-                  take different kinds of measurements.
+                  take different kinds of measurements. By default, we
+                  use a Measurement which shares self.stack_cache.
 
         """
-        return metrics.Measurement
+        if self.stack_cache is None and self.frame_filter is None:
+            return metrics.Measurement
+        return functools.partial(metrics.Measurement, cache=self.stack_cache,
+                                 frame_filter=self.frame_filter)
+
+    def record_frames(self, frames, tags=None):
+        """Measure each of the given stack frames and record it in self.my_db.
+
+        :param frames:    Iterable of stack frames to measure.
+
+        :param tags=None: Optional sequence with a tag (or None) for each
+                          frame. Tags are prepended to the stack name.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  A SampleInfo instance describing the cost of measuring
+                  and recording the frames.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Shared by `run` and by engines which capture frames some
+                  other way (e.g., in a signal handler) and want to record
+                  them later using the usual measurement tool and recorder.
+                  If the GIL is disabled, other threads keep running while
+                  we walk their stacks so a stack may change under us; we
+                  skip (and count in self.torn_stacks) any stack whose
+                  walk fails instead of failing the whole sample. We use
+                  the record_many method of the recorder if it has one
+                  and otherwise call record for each measurement (so a
+                  custom recorder only needs record).
 
-    def run(self):
-        """Run the sampler to make a measurement of the current stack frames.
         """
+        start = time.perf_counter()
         measure_tool = self.get_measure_tool()
+        if self.label_states:
+            frames = list(frames)
+            labels = [states.classify(frame) for frame in frames]
+        else:
+            labels = None
+        if self.tolerate_torn:
+            measurements = []
+            for frame, tag, label in zip(frames, tags or itertools.repeat(
+                    None), labels or itertools.repeat(None)):
+                try:
+                    measurement = measure_tool(frame)
+                except (AttributeError, RuntimeError, ValueError):
+                    self.torn_stacks += 1  # thread changed stack under us
+                    continue
+                if tag is not None:
+                    measurement.name = '%s;%s' % (tag, measurement.name)
+                if label is not None and label != states.PYTHON:
+                    measurement.state = label  # see CountingRecorder.state_db
+                measurements.append(measurement)
+        else:
+            measurements = [measure_tool(frame) for frame in frames]
+            if tags is not None:
+                for measurement, tag in zip(measurements, tags):
+                    if tag is not None:
+                        measurement.name = '%s;%s' % (tag, measurement.name)
+            if labels is not None:
+                for measurement, label in zip(measurements, labels):
+                    if label != states.PYTHON:
+                        measurement.state = label
+        record_many = getattr(self.my_db, 'record_many', None)
+        if record_many is not None:
+            lock_wait = record_many(measurements)
+        else:  # custom recorder which only has record
+            for measurement in measurements:
+                self.my_db.record(measurement)
+            lock_wait = 0.0
+        return SampleInfo(
+            time.perf_counter() - start, lock_wait,
+            sum(getattr(m, 'depth', 0) for m in measurements),
+            len(measurements))
 
+    def run(self):
+        """Run the sampler to make a measurement of the current stack frames.
+
+        Returns a SampleInfo instance describing how long the sample took
+        (including any time spent waiting for the recorder's lock).
+        """
+        start = time.perf_counter()
+        thread_filter = self.thread_filter
         with self.freezer:
-            for dummy_frame_id, frame in (
-                    sys._current_frames(  # pylint: disable=protected-access
-                        ).items()):
-                self.my_db.record(measure_tool(frame))
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            if thread_filter is not None:
+                frames = dict((thread_id, frame) for thread_id, frame in (
+                    frames.items()) if thread_filter(thread_id))
+            if self.gil_estimator is not None:
+                self.gil_estimator.observe(frames, self.get_measure_tool())
+            if self.contention is not None:
+                self.contention.observe(frames, self.get_measure_tool())
+            thread_tags = self.thread_tags
+            tags = [thread_tags.get(thread_id) for thread_id in frames] if (
+                thread_tags) else None
+            info = self.record_frames(frames.values(), tags)
+        return info._replace(capture_time=time.perf_counter() - start)
 
     def __call__(self, *args, **kwargs):
         """Syntactic sugar to call `self.run(*args, **kwargs)`."""
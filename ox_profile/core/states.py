@@ -0,0 +1,203 @@
+"""Classify samples as running python, calling native code or blocked.
+
+A sample only shows the python functions on the stack so a hotspot in
+`json.loads`, a regular expression or `socket.recv` looks like time
+spent in the python caller. Yet "optimise the python" (e.g., vectorise
+or cache) and "the C call is slow" or "we are waiting on I/O" (e.g.,
+add concurrency) call for different fixes. We classify the top frame
+of each sampled stack from the instruction at its `f_lasti`:
+
+  - NATIVE: at a call instruction (so the thread is inside a function
+    implemented in C since a python callee would be the top frame),
+  - BLOCKED: at a call to a known blocking function (e.g., `sleep`,
+    `recv`, `select`, `acquire`; see BLOCKING_CALLS),
+  - PYTHON: anything else (interpreting bytecode).
+
+We find the name of the called function from the positions of the
+instructions (python 3.11+) so on older versions every native call is
+NATIVE. Names are matched without their module so this is a heuristic
+(e.g., `file.read` and `sock.recv` both count as blocked even though
+reading a cached file rarely blocks).
+
+If you call `Sampler.enable_state_labels`, the recorder also counts
+native and blocked samples of each stack (see
+`CountingRecorder.state_db`) without changing the stacks themselves.
+Use `CountingRecorder.query_states` to see how the hits of each
+function split by state; it passes `breakdown` stacks with a
+'[native]' or '[blocked]' pseudo-frame at the top as below.
+
+>>> from ox_profile.core import states
+>>> records, totals = states.breakdown([
+...     ('main;parse;[native]', 3), ('main;parse', 1),
+...     ('main;fetch;[blocked]', 5)])
+>>> records[0]
+StateRecord(name='main', hits=9, python=1, native=3, blocked=5)
+>>> records[1]
+StateRecord(name='fetch', hits=5, python=0, native=0, blocked=5)
+>>> totals == {'python': 1, 'native': 3, 'blocked': 5}
+True
+"""
+
+import collections
+import dis
+import doctest
+import functools
+import heapq
+import re
+
+from ox_profile.core import gil
+
+
+PYTHON = 'python'
+NATIVE = 'native'
+BLOCKED = 'blocked'
+STATES = (PYTHON, NATIVE, BLOCKED)
+
+#: Pseudo-frames added to the top of stacks by state (none for PYTHON).
+STATE_FRAMES = {NATIVE: '[native]', BLOCKED: '[blocked]'}
+FRAME_STATES = dict((frame, state) for state, frame in STATE_FRAMES.items())
+
+#: Names of functions which usually block on I/O, timers or locks.
+BLOCKING_CALLS = frozenset([
+    'sleep', 'select', 'poll', 'epoll', 'control', 'wait', 'waitpid',
+    'acquire', 'accept', 'connect', 'connect_ex', 'recv', 'recv_into',
+    'recvfrom', 'recvfrom_into', 'recvmsg', 'send', 'sendall', 'sendto',
+    'sendmsg', 'sendfile', 'read', 'readinto', 'readline', 'readlines',
+    'write', 'flush', 'fsync', 'fdatasync', 'flock', 'lockf',
+    'getaddrinfo', 'gethostbyname', 'communicate', 'urlopen'])
+
+StateRecord = collections.namedtuple('StateRecord', [
+    'name', 'hits', PYTHON, NATIVE, BLOCKED])
+
+
+@functools.lru_cache(maxsize=4096)
+def callee_name(code, lasti):
+    """Return name of the function called at offset lasti of code.
+
+    :param code:    Code object.
+
+    :param lasti:   Offset of a call instruction (e.g., `frame.f_lasti`).
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  The name (e.g., 'recv' for `sock.recv(10)`) or None if we
+              cannot tell.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    PURPOSE:  The call and the instruction loading the callee start at
+              the same source position (arguments start later) so the
+              callee is the load starting there which ends last. This
+              is cached since the sampler sees the same few calls over
+              and over.
+
+    """
+    loads = []
+    for inst in dis.get_instructions(code):
+        if inst.offset == lasti:
+            where = getattr(inst, 'positions', None)
+            if where is None or where.col_offset is None:
+                return None
+            best, name = None, None
+            for load in loads:
+                pos = load.positions
+                end = (pos.end_lineno or 0, pos.end_col_offset or 0)
+                if (pos.lineno, pos.col_offset) == (
+                        where.lineno, where.col_offset) and (
+                            best is None or end > best):
+                    best, name = end, load.argval
+            return name
+        if inst.opname.startswith('LOAD_') and inst.opname != 'LOAD_CONST' and (
+                isinstance(inst.argval, str)) and getattr(
+                    inst, 'positions', None) is not None:
+            loads.append(inst)
+    return None
+
+
+def classify(frame):
+    """Return PYTHON, NATIVE or BLOCKED for the top frame of a stack.
+
+    The frame can also be a tuple of frames starting from the top (as
+    saved by `launchers.SignalLauncher`).
+    """
+    if isinstance(frame, tuple):
+        frame = frame[0]
+    if not gil.at_call(frame):
+        return PYTHON
+    if callee_name(frame.f_code, frame.f_lasti) in BLOCKING_CALLS:
+        return BLOCKED
+    return NATIVE
+
+
+def split_state(name):
+    """Split stack name into (name without state frame, state).
+    """
+    head, dummy, top = name.rpartition(';')
+    state = FRAME_STATES.get(top)
+    if state is None:
+        return name, PYTHON
+    return head, state
+
+
+def breakdown(stacks, re_filter='.*', max_records=10):
+    """Split the hits of each function by state.
+
+    :param stacks:      Iterable of (stack name, hits) pairs (e.g., from
+                        `CountingRecorder.stacks`).
+
+    :param re_filter='.*':  Regular expression functions must match.
+
+    :param max_records=10:  Maximum number of records (None for all).
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  The pair (records, totals) where records is a list of
+              StateRecord sorted by hits and totals is a dict of hits
+              for each state over all stacks. A function counts once per
+              stack (so recursion does not count a sample twice) with
+              the state of the sample.
+
+    """
+    regexp = re.compile(re_filter)
+    counts = collections.defaultdict(collections.Counter)
+    totals = collections.Counter(dict.fromkeys(STATES, 0))
+    matches = {}
+    for name, hits in stacks:
+        name, state = split_state(name)
+        totals[state] += hits
+        for fname in set(name.split(';')):
+            keep = matches.get(fname)
+            if keep is None:
+                keep = matches[fname] = regexp.search(fname) is not None
+            if keep:
+                counts[fname][state] += hits
+    records = (StateRecord(fname, sum(by_state.values()), *[
+        by_state[state] for state in STATES]) for fname, by_state in (
+            counts.items()))
+    if max_records is None:
+        records = sorted(records, key=lambda item: item.hits, reverse=True)
+    else:
+        records = heapq.nlargest(max_records, records,
+                                 key=lambda item: item.hits)
+    return records, dict(totals)
+
+
+def show_breakdown(records, totals, width=40):
+    """Return string table of records and totals from `breakdown`.
+    """
+    fmt = '{:%i} {:>8} {:>7} {:>7} {:>8}' % width
+    lines = [fmt.format('Function', 'Hits', '%python', '%native',
+                        '%blocked')]
+    overall = StateRecord('(all samples)', sum(totals.values()), *[
+        totals.get(state, 0) for state in STATES])
+    for item in [overall] + list(records):
+        lines.append(fmt.format(item.name[:width], item.hits, *[
+            '%.1f' % (100.0 * getattr(item, state) / item.hits) if (
+                item.hits) else '-' for state in STATES]))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    # Run doctest if file executed as a script
+    doctest.testmod()
+    print('Finished Tests')
@@ -0,0 +1,241 @@
+"""Compact time series of per function hit counts.
+
+Totals from `query` tell you which functions are hot but not when they
+got hot. A `FunctionSeries` keeps, for the most active functions, hit
+counts over time in fixed-size ring buffers at a few resolutions (by
+default 2 minutes at 1 second, 2 hours at 1 minute and 1 day at 10
+minutes). Each hit is added to the current bucket of every resolution
+so coarser resolutions are roll-ups of finer ones and memory use does
+not grow with how long you run.
+
+You usually get one via `CountingRecorder.enable_time_series` which
+feeds it from the recorder as samples come in.
+
+>>> from ox_profile.core.timeseries import FunctionSeries
+>>> series = FunctionSeries(levels=[(1, 5), (10, 6)])
+>>> for second in range(100, 160):
+...     hot = 1 if second < 150 else 9  # 'slow' gets hot at time 150
+...     series.add(second, {'main': 10, 'slow': hot}, 10)
+...
+>>> series.values('slow', 1, now=159)
+[(155, 9), (156, 9), (157, 9), (158, 9), (159, 9)]
+>>> series.values('slow', 10, now=159)[-3:]
+[(130, 10), (140, 10), (150, 90)]
+>>> for item in series.anomalies(10, now=160):
+...     print('%s: %.2f -> %.2f' % (item.name, item.baseline_share,
+...                                 item.recent_share))
+slow: 0.10 -> 0.90
+"""
+
+import array
+import collections
+import doctest
+
+
+#: Default (resolution in seconds, number of buckets) for each level.
+DEFAULT_LEVELS = [(1, 120), (60, 120), (600, 144)]
+
+Anomaly = collections.namedtuple('Anomaly', [
+    'name', 'recent_share', 'baseline_share', 'recent_hits'])
+
+
+class _Ring(object):
+    """Fixed-size ring buffer of counts per time bucket.
+    """
+
+    def __init__(self, resolution, size):
+        self.resolution = resolution
+        self.size = size
+        self.counts = array.array('q', [0] * size)
+        self.last = None  # index of most recent bucket (time // resolution)
+
+    def add(self, when, hits):
+        "Add hits to the bucket for time when."
+        bucket = int(when // self.resolution)
+        last = self.last
+        if last is None:
+            self.last = bucket
+        elif bucket > last:
+            for index in range(last + 1, min(bucket, last + self.size) + 1):
+                self.counts[index % self.size] = 0
+            self.last = bucket
+        elif bucket <= last - self.size:
+            return  # too old to keep
+        self.counts[bucket % self.size] += hits
+
+    def values(self, now):
+        """Return list of (bucket start time, hits) ending with bucket of now.
+        """
+        end = int(now // self.resolution)
+        result = []
+        for bucket in range(end - self.size + 1, end + 1):
+            hits = 0
+            if self.last is not None and self.last - self.size < bucket <= (
+                    self.last):
+                hits = self.counts[bucket % self.size]
+            result.append((bucket * self.resolution, hits))
+        return result
+
+    def recent_sum(self):
+        "Return sum of all counts in the buffer."
+        return sum(self.counts)
+
+
+class FunctionSeries(object):
+    """Time series of hits at several resolutions for active functions.
+    """
+
+    def __init__(self, levels=None, max_functions=200):
+        """Initializer.
+
+        :param levels=None:   List of (resolution in seconds, number of
+                              buckets) pairs. Default is DEFAULT_LEVELS.
+
+        :param max_functions=200:  Approximate number of functions to keep
+                                   series for. When we have 25% more than
+                                   this, we drop the least active ones.
+
+        """
+        self.levels = list(levels or DEFAULT_LEVELS)
+        self.max_functions = max_functions
+        self.total = self._make_rings()
+        self.functions = {}  # function name -> list of _Ring (one per level)
+
+    def _make_rings(self):
+        return [_Ring(resolution, size) for resolution, size in self.levels]
+
+    def add(self, when, function_hits, total_hits):
+        """Add hits at the given time.
+
+        :param when:           Time in seconds since the epoch.
+
+        :param function_hits:  Dict of function name to hits.
+
+        :param total_hits:     Total samples (stacks) these hits came from.
+
+        """
+        for ring in self.total:
+            ring.add(when, total_hits)
+        functions = self.functions
+        for name, hits in function_hits.items():
+            rings = functions.get(name)
+            if rings is None:
+                rings = self._make_rings()
+                functions[name] = rings
+            for ring in rings:
+                ring.add(when, hits)
+        if len(functions) > self.max_functions * 5 // 4:
+            self.prune()
+
+    def prune(self):
+        """Drop the series for the least active functions.
+
+        We rank functions by hits in the coarsest level and keep the top
+        self.max_functions.
+        """
+        ranked = sorted(self.functions.items(),
+                        key=lambda item: item[1][-1].recent_sum())
+        for name, dummy_rings in ranked[:len(ranked) - self.max_functions]:
+            del self.functions[name]
+
+    def _level(self, resolution):
+        for index, (level_resolution, dummy_size) in enumerate(self.levels):
+            if level_resolution == resolution:
+                return index
+        raise ValueError('No level with resolution %s in %s' % (
+            resolution, self.levels))
+
+    def values(self, name, resolution, now):
+        """Return list of (bucket start time, hits) for function name.
+
+        :param name:        Function name (or None for total samples).
+
+        :param resolution:  Resolution (in seconds) of one of self.levels.
+
+        :param now:         Time in seconds since the epoch for the last
+                            bucket to return.
+
+        """
+        rings = self.total if name is None else self.functions.get(name)
+        if rings is None:
+            return [(start, 0) for start, dummy in self.total[self._level(
+                resolution)].values(now)]
+        return rings[self._level(resolution)].values(now)
+
+    def top(self, resolution, now, limit=20):
+        """Return up to limit names with the most hits at resolution.
+        """
+        level = self._level(resolution)
+        ranked = sorted(((sum(hits for dummy, hits in rings[level].values(
+            now)), name) for name, rings in self.functions.items()),
+                        reverse=True)
+        return [name for hits, name in ranked[:limit] if hits]
+
+    def report(self, resolution, now, limit=20):
+        """Return dict with 'resolution', 'now', 'total', 'functions' and
+        'anomalies' for the most active functions (see
+        `CountingRecorder.series_report`).
+        """
+        return {
+            'resolution': resolution, 'now': now,
+            'total': self.values(None, resolution, now),
+            'functions': [(name, self.values(name, resolution, now))
+                          for name in self.top(resolution, now, limit)],
+            'anomalies': self.anomalies(resolution, now)}
+
+    def anomalies(self, resolution, now, recent=1, min_ratio=2.0,
+                  min_hits=10):
+        """Return functions whose share of samples jumped recently.
+
+        :param resolution:  Resolution (in seconds) of one of self.levels.
+
+        :param now:         Time in seconds since the epoch. The bucket
+                            containing now is considered incomplete and
+                            ignored.
+
+        :param recent=1:    Number of the latest complete buckets to
+                            compare against the rest of the buckets (the
+                            trailing baseline).
+
+        :param min_ratio=2.0:  Minimum ratio of recent share to baseline
+                               share to report.
+
+        :param min_hits=10:    Ignore functions with fewer recent hits.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  List of Anomaly tuples sorted with largest jump first.
+                  The share of a function is its hits divided by the total
+                  samples in the same buckets.
+
+        """
+        level = self._level(resolution)
+        before = now - resolution
+
+        def split(ring):
+            "Return (baseline hits, recent hits) for ring."
+            counts = [hits for dummy, hits in ring.values(before)]
+            return sum(counts[:-recent]), sum(counts[-recent:])
+
+        base_total, recent_total = split(self.total[level])
+        if not (base_total and recent_total):
+            return []
+        result = []
+        for name, rings in self.functions.items():
+            base_hits, recent_hits = split(rings[level])
+            if recent_hits < min_hits:
+                continue
+            recent_share = recent_hits / float(recent_total)
+            base_share = base_hits / float(base_total)
+            if recent_share >= min_ratio * base_share:
+                result.append(Anomaly(name, recent_share, base_share,
+                                      recent_hits))
+        result.sort(key=lambda item: (item.recent_share - item.baseline_share),
+                    reverse=True)
+        return result
+
+
+if __name__ == '__main__':
+    # Run doctest if file executed as a script
+    doctest.testmod()
+    print('Finished Tests')
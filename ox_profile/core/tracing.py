@@ -0,0 +1,305 @@
+"""Bounded deterministic tracing of one function.
+
+Sampling tells us `foo` is hot but not whether that means 10 slow calls
+or 10 million fast ones. A `FunctionTracer` hooks only the calls and
+returns of the target function for a bounded window (a number of
+seconds and/or a number of calls), keeps the exact call count and a
+histogram of per-call latency and then removes its hook by itself.
+
+On python 3.12 and later we use `sys.monitoring` with local events on
+the code object of the target so other functions pay nothing. On older
+versions we fall back to `sys.setprofile` which is called for every
+function (we ignore all but the target). Python only lets us set that
+hook for the current thread and for threads started later so the
+fallback does not see calls in other threads that already exist (the
+'threads' entry of `FunctionTracer.report` says what was covered).
+Pass this_thread=False to leave the current thread alone (e.g., when a
+web request starts the trace, so the worker serving it is not slowed
+for the whole trace).
+
+>>> import time
+>>> from ox_profile.core.tracing import FunctionTracer
+>>> def work(delay):
+...     time.sleep(delay)
+...
+>>> tracer = FunctionTracer(work, max_calls=3, max_seconds=10).start()
+>>> for delay in [0, .001, .002, .003]:
+...     work(delay)
+...
+>>> tracer.calls, tracer.active
+(3, False)
+>>> tracer.hist.max >= .002
+True
+>>> FunctionTracer('work(%s)' % __name__).codes == {work.__code__}
+True
+"""
+
+import doctest
+import gc
+import inspect
+import re
+import sys
+import threading
+import time
+import types
+
+from ox_profile.core import histograms
+
+
+# Calls to traced functions can be much faster than a microsecond so
+# go down to 100 ns (the top bucket is still over a minute).
+TRACE_BOUNDS = histograms.make_bounds(smallest=1e-7, factor=2.0,
+                                      num_buckets=30)
+
+LABEL_RE = re.compile(r'^(?P<name>[^()]+)\((?P<module>[^()]*)\)$')
+
+UNSUPPORTED_FLAGS = (inspect.CO_GENERATOR | inspect.CO_COROUTINE |
+                     inspect.CO_ASYNC_GENERATOR)
+
+
+def find_code(target):
+    """Return set of code objects to trace for target.
+
+    :param target:    A function, method, code object or a label of
+                      the form 'name(module)' as shown in profiles.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Set of code objects. A label can match more than one
+              (e.g., methods with the same name in different classes)
+              and we trace all of them since the profile lumps them
+              together as well.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    PURPOSE:  For a label we search all live functions with gc so
+              this is slow-ish but only done once per trace.
+
+    """
+    if isinstance(target, types.CodeType):
+        codes = {target}
+    elif isinstance(target, str):
+        match = LABEL_RE.match(target.strip())
+        name, module = (match.group('name'), match.group('module')) if (
+            match) else (target.strip(), None)
+        codes = set(
+            item.__code__ for item in gc.get_objects()
+            if isinstance(item, types.FunctionType)
+            and item.__code__.co_name == name and (
+                module is None or item.__globals__.get('__name__') == module))
+        if not codes:
+            raise ValueError('No function matches %s.' % target)
+    else:
+        code = getattr(getattr(target, '__func__', target), '__code__', None)
+        if code is None:
+            raise ValueError('Cannot trace %r (not a python function).' % (
+                target,))
+        codes = {code}
+    for code in codes:
+        if code.co_flags & UNSUPPORTED_FLAGS:
+            raise ValueError('Cannot trace generator or coroutine %s.' % (
+                code.co_name))
+    return codes
+
+
+class FunctionTracer(object):
+    """Count calls and time each call of one function for a bounded window.
+    """
+
+    tool_name = 'ox_profile'
+
+    def __init__(self, target, max_calls=100000, max_seconds=10.0,
+                 bounds=None, use_monitoring=None, this_thread=True):
+        """Initializer.
+
+        :param target:    Function to trace (see `find_code`).
+
+        :param max_calls=100000:  Stop after this many calls complete
+                                  (None for no limit).
+
+        :param max_seconds=10.0:  Stop after this many seconds (None for
+                                  no limit; then you must call stop).
+
+        :param bounds=None:       Histogram bounds for call latency in
+                                  seconds (default is TRACE_BOUNDS).
+
+        :param use_monitoring=None:  Whether to use sys.monitoring instead
+                                     of sys.setprofile (default is to use
+                                     it if available).
+
+        :param this_thread=True:  Whether the sys.setprofile fallback
+                                  also hooks the thread calling start
+                                  (it always hooks threads started
+                                  later and never other existing ones).
+
+        """
+        if max_calls is None and max_seconds is None:
+            raise ValueError('Need max_calls or max_seconds to bound trace.')
+        self.codes = find_code(target)
+        self.label = target if isinstance(target, str) else '%s(%s)' % (
+            target.co_name if isinstance(target, types.CodeType) else (
+                target.__name__), getattr(target, '__module__', None))
+        self.max_calls = max_calls
+        self.max_seconds = max_seconds
+        self.hist = histograms.Histogram(
+            bounds if bounds is not None else TRACE_BOUNDS)
+        self.calls = 0
+        self.use_monitoring = hasattr(sys, 'monitoring') if (
+            use_monitoring is None) else use_monitoring
+        self.this_thread = this_thread
+        self.active = False
+        self.start_time = None
+        self.end_time = None
+        self.finished = threading.Event()
+        self._starts = {}  # thread id -> stack of start times
+        self._lock = threading.Lock()  # protects start/stop
+        self._stats_lock = threading.Lock()  # protects hist and calls
+        self._timer = None
+
+    def start(self):
+        """Install the hook and return self.
+        """
+        with self._lock:
+            if self.start_time is not None:
+                raise RuntimeError('Tracer already started.')
+            self.start_time = time.time()
+            self.active = True  # before installing so the hook stays
+            try:
+                if self.use_monitoring:
+                    self._install_monitoring()
+                else:
+                    self._install_profile()
+            except Exception:
+                self.active, self.start_time = False, None
+                raise
+            if self.max_seconds is not None:
+                self._timer = threading.Timer(self.max_seconds, self.stop)
+                self._timer.daemon = True
+                self._timer.start()
+        return self
+
+    def stop(self):
+        """Remove the hook (if still installed) and return self.
+        """
+        with self._lock:
+            if not self.active:
+                return self
+            self.active = False
+            if self.use_monitoring:
+                self._remove_monitoring()
+            else:
+                self._remove_profile()
+            self.end_time = time.time()
+            timer, self._timer = self._timer, None
+        if timer is not None and timer is not threading.current_thread():
+            timer.cancel()
+        self.finished.set()
+        return self
+
+    def wait(self, timeout=None):
+        """Wait until the trace stops; return True if it has stopped.
+        """
+        return self.finished.wait(timeout)
+
+    def _enter(self):
+        self._starts.setdefault(threading.get_ident(), []).append(
+            time.perf_counter())
+
+    def _exit(self):
+        end = time.perf_counter()
+        stack = self._starts.get(threading.get_ident())
+        if not stack:  # call started before we did
+            return
+        duration = end - stack.pop()
+        with self._stats_lock:
+            if not self.active:
+                return
+            self.hist.add(duration)
+            self.calls += 1
+            done = self.max_calls is not None and self.calls >= self.max_calls
+        if done:
+            self.stop()
+
+    def _install_monitoring(self):
+        monitoring = sys.monitoring  # pylint: disable=no-member
+        tool_id = monitoring.PROFILER_ID
+        monitoring.use_tool_id(tool_id, self.tool_name)  # raises if in use
+        events = monitoring.events
+        monitoring.register_callback(
+            tool_id, events.PY_START, lambda code, offset: self._enter())
+        monitoring.register_callback(
+            tool_id, events.PY_RETURN, lambda code, off, val: self._exit())
+        # PY_UNWIND can only be a global event so filter by code object.
+        monitoring.register_callback(
+            tool_id, events.PY_UNWIND, lambda code, off, exc: (
+                self._exit() if code in self.codes else None))
+        for code in self.codes:
+            monitoring.set_local_events(
+                tool_id, code, events.PY_START | events.PY_RETURN)
+        monitoring.set_events(tool_id, events.PY_UNWIND)
+
+    def _remove_monitoring(self):
+        monitoring = sys.monitoring  # pylint: disable=no-member
+        tool_id = monitoring.PROFILER_ID
+        events = monitoring.events
+        monitoring.set_events(tool_id, events.NO_EVENTS)
+        for code in self.codes:
+            monitoring.set_local_events(tool_id, code, events.NO_EVENTS)
+        for event in [events.PY_START, events.PY_RETURN, events.PY_UNWIND]:
+            monitoring.register_callback(tool_id, event, None)
+        monitoring.free_tool_id(tool_id)
+
+    def _profile(self, frame, event, dummy_arg):
+        if not self.active:  # thread still has hook after stop
+            sys.setprofile(None)
+        elif frame.f_code in self.codes:
+            if event == 'call':
+                self._enter()
+            elif event == 'return':  # also sent when an exception unwinds
+                self._exit()
+
+    def _install_profile(self):
+        for hook in [sys.getprofile(), threading.getprofile()]:
+            owner = getattr(hook, '__self__', None)
+            if hook is not None and not (  # hooks of stopped tracers are ok
+                    isinstance(owner, FunctionTracer) and not owner.active):
+                raise RuntimeError('Another profiler is already active.')
+        threading.setprofile(self._profile)
+        if self.this_thread:
+            sys.setprofile(self._profile)
+
+    def _remove_profile(self):
+        threading.setprofile(None)
+        if sys.getprofile() == self._profile:
+            sys.setprofile(None)
+
+    def report(self):
+        """Return dict summarizing the trace.
+
+        Includes the exact number of calls, calls per second, total
+        seconds spent in the function, which threads we saw (see the
+        module docstring) and the latency summary from
+        `histograms.Histogram.summary`.
+        """
+        with self._stats_lock:
+            summary = self.hist.summary()
+            calls, total = self.calls, self.hist.total
+        elapsed = ((self.end_time or time.time()) - self.start_time) if (
+            self.start_time is not None) else 0.0
+        summary.update({
+            'function': self.label, 'calls': calls, 'total': total,
+            'active': self.active, 'elapsed': elapsed,
+            'calls_per_second': calls / elapsed if elapsed else 0.0,
+            'max_calls': self.max_calls, 'max_seconds': self.max_seconds,
+            'method': 'sys.monitoring' if self.use_monitoring else (
+                'sys.setprofile'),
+            'threads': 'all' if self.use_monitoring else (
+                'this thread and new threads' if self.this_thread else (
+                    'new threads only'))})
+        return summary
+
+
+if __name__ == '__main__':
+    # Run doctest if file executed as a script
+    doctest.testmod()
+    print('Finished Tests')
@@ -0,0 +1,231 @@
+"""Merge many saved profiles into one (or one per group).
+
+Profiles saved in the folded stacks format (e.g., by the command line
+runner or `CountingRecorder.save`) from many processes and hosts can be
+combined with something like
+
+    python -m ox_profile.merge -o merged.folded profiles/*.folded
+    python -m ox_profile.merge --group-by host,release \\
+        -o 'merged.%(host)s.%(release)s.folded' profiles/*.folded
+
+The result can be read with `CountingRecorder.load` to use `query` or
+`show` as usual.
+
+To handle more data than fits in memory, we do an external merge sort.
+A process pool reads the input files and writes each one as one or
+more runs sorted by stack (each run holds at most run_size distinct
+stacks). We then stream a k-way merge of the sorted runs for each group
+and add up the hits for identical stacks as they go by.
+"""
+
+import argparse
+import heapq
+import itertools
+import logging
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from ox_profile.core import recording
+
+
+def sort_file(path, tmp_dir, run_size=100000):
+    """Read a folded profile and write it as sorted runs.
+
+    :param path:        Path to a profile in the folded stacks format.
+
+    :param tmp_dir:     Directory to write runs to.
+
+    :param run_size=100000:   Maximum distinct stacks to hold in memory
+                              (and so to put in one run).
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  The tuple (metadata, run_paths, total_hits). This is a
+              module level function so it can run in a process pool.
+
+    """
+    metadata, runs, total_hits = {}, [], 0
+    counts = {}
+
+    def write_run():
+        "Write counts as a sorted run and clear it."
+        run_fd = tempfile.NamedTemporaryFile(
+            'w', dir=tmp_dir, suffix='.run', delete=False)
+        with run_fd:
+            for name in sorted(counts):
+                run_fd.write('%s %i\n' % (name, counts[name]))
+        runs.append(run_fd.name)
+        counts.clear()
+
+    with open(path) as my_fd:
+        for name, hits in recording.parse_folded(my_fd, metadata):
+            counts[name] = counts.get(name, 0) + hits
+            total_hits += hits
+            if len(counts) >= run_size:
+                write_run()
+    if counts:
+        write_run()
+    return metadata, runs, total_hits
+
+
+def merge_runs(run_paths):
+    """Generate (name, hits) pairs summed across sorted run files.
+
+    :param run_paths:   Paths of files in the folded format sorted by stack.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Generator of (name, hits) sorted by name with each name
+              appearing once.
+
+    """
+    handles = [open(path) for path in run_paths]
+    try:
+        merged = heapq.merge(*[recording.parse_folded(my_fd)
+                               for my_fd in handles])
+        for name, group in itertools.groupby(merged, key=lambda x: x[0]):
+            yield name, sum(hits for dummy, hits in group)
+    finally:
+        for my_fd in handles:
+            my_fd.close()
+
+
+def reduce_runs(run_paths, tmp_dir, fan_in=64):
+    """Merge runs in batches until there are at most fan_in of them.
+
+    This keeps the number of files open at once bounded.
+    """
+    while len(run_paths) > fan_in:
+        new_paths = []
+        for start in range(0, len(run_paths), fan_in):
+            batch = run_paths[start:start + fan_in]
+            run_fd = tempfile.NamedTemporaryFile(
+                'w', dir=tmp_dir, suffix='.run', delete=False)
+            with run_fd:
+                for name, hits in merge_runs(batch):
+                    run_fd.write('%s %i\n' % (name, hits))
+            for path in batch:
+                os.remove(path)
+            new_paths.append(run_fd.name)
+        run_paths = new_paths
+    return run_paths
+
+
+def merge_profiles(paths, output, group_by=(), jobs=None, run_size=100000,
+                   fan_in=64, tmp_dir=None):
+    """Merge the profiles in paths and write the result(s).
+
+    :param paths:       Sequence of paths to profiles in the folded format.
+
+    :param output:      Path to write to. If group_by is given, this is
+                        formatted with the group's metadata (e.g.,
+                        'merged.%(host)s.folded').
+
+    :param group_by=():  Sequence of metadata keys to group inputs by.
+                         Files without a key are put in group 'unknown'.
+
+    :param jobs=None:   Number of processes to read inputs with (default
+                        is the number of CPUs). Use 1 to stay in process.
+
+    :param run_size=100000:  Maximum distinct stacks per sorted run.
+
+    :param fan_in=64:   Maximum number of runs to merge at once.
+
+    :param tmp_dir=None:  Directory for sorted runs (default is a new
+                          temporary directory which we remove at the end).
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Dict mapping output path to metadata written to it.
+
+    """
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as work_dir:
+        if jobs == 1:
+            results = [sort_file(path, work_dir, run_size) for path in paths]
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                results = list(pool.map(sort_file, paths, itertools.repeat(
+                    work_dir), itertools.repeat(run_size)))
+        groups = {}
+        for metadata, runs, total_hits in results:
+            key = tuple(metadata.get(name, 'unknown') for name in group_by)
+            groups.setdefault(key, []).append((metadata, runs, total_hits))
+        written = {}
+        for key, members in sorted(groups.items()):
+            group_info = dict(zip(group_by, key))
+            path = output % group_info if group_by else output
+            if path in written:
+                raise ValueError('Output %s used for more than one group;'
+                                 ' include the group_by keys in it.' % path)
+            written[path] = write_group(path, members, group_info,
+                                        work_dir, fan_in)
+    return written
+
+
+def write_group(path, members, group_info, work_dir, fan_in):
+    """Merge runs from members of a group and write them to path.
+
+    :return:  Metadata written in the header. This has the group_info,
+              the metadata values shared by all members, the number of
+              merged files and the total hits.
+
+    """
+    shared = dict(members[0][0])
+    for metadata, dummy_runs, dummy_hits in members[1:]:
+        shared = dict((k, v) for k, v in shared.items()
+                      if metadata.get(k) == v)
+    shared.update(group_info)
+    shared['merged_files'] = len(members)
+    shared['total_hits'] = sum(hits for dummy, dummy, hits in members)
+    run_paths = reduce_runs([run for dummy, runs, dummy in members
+                             for run in runs], work_dir, fan_in)
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as my_fd:
+        my_fd.write('%s\n' % recording.FOLDED_HEADER)
+        for key, value in sorted(shared.items()):
+            my_fd.write('# %s: %s\n' % (key, value))
+        for name, hits in merge_runs(run_paths):
+            my_fd.write('%s %i\n' % (name, hits))
+    os.replace(tmp_path, path)
+    logging.info('Wrote %s merged from %i files', path, len(members))
+    return shared
+
+
+def make_parser():
+    "Make command line parser."
+    parser = argparse.ArgumentParser(
+        prog='python -m ox_profile.merge', description=(
+            'Merge profiles saved in the folded stacks format.'))
+    parser.add_argument('-o', '--output', required=True, help=(
+        'Path to write merged profile to. With --group-by, use python'
+        ' %%-style keys such as merged.%%(host)s.folded.'))
+    parser.add_argument('-g', '--group-by', default='', help=(
+        'Comma separated metadata keys (e.g., host,release) to merge'
+        ' separately.'))
+    parser.add_argument('-j', '--jobs', type=int, help=(
+        'Number of processes to read inputs with (default is CPU count).'))
+    parser.add_argument('--run-size', type=int, default=100000, help=(
+        'Maximum distinct stacks to hold in memory per process.'))
+    parser.add_argument('--tmp-dir', help='Directory for temporary files.')
+    parser.add_argument('paths', nargs='+', help='Profiles to merge.')
+    return parser
+
+
+def main(argv=None):
+    """Main entry point for the merge tool.
+    """
+    args = make_parser().parse_args(argv)
+    group_by = [item for item in args.group_by.split(',') if item]
+    written = merge_profiles(
+        args.paths, args.output, group_by=group_by, jobs=args.jobs,
+        run_size=args.run_size, tmp_dir=args.tmp_dir)
+    for path, metadata in sorted(written.items()):
+        sys.stderr.write('ox_profile.merge: wrote %s (%s files, %s hits)\n' % (
+            path, metadata['merged_files'], metadata['total_hits']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
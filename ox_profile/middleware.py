@@ -0,0 +1,495 @@
+"""Framework agnostic WSGI and ASGI middleware to time requests.
+
+The flask blueprint in `ox_profile.ui.flask` times each request through
+flask hooks. The middleware here does the same for any WSGI or ASGI
+application (Django, Pyramid, Starlette, FastAPI, etc.) without flask
+installed. Wrap your application with something like
+
+    from ox_profile.middleware import WSGIMiddleware
+    application = WSGIMiddleware(application)
+
+or for an ASGI application
+
+    from ox_profile.middleware import ASGIMiddleware
+    app = ASGIMiddleware(app)
+
+Each request is timed with `time.perf_counter_ns` and added to a
+`RequestStats` instance which keeps streaming aggregates per endpoint
+(count, errors, total, max and a histogram) so memory use does not grow
+with the number of requests. Use `RequestStats.snapshot` for a summary
+or `RequestStats.families` with `ox_profile.core.exposition.render` for
+the OpenMetrics text format. To cut overhead on busy services, pass a
+`RequestSampler` to time only some requests; recorded requests are
+weighted so counts still estimate the true totals.
+
+The WSGI middleware can also tag the thread serving a request so the
+sampler attributes samples to the request. Pass the dict returned by
+`Sampler.enable_thread_tags` as tags and stacks from that thread are
+recorded as 'request(GET /path);main;...' while the request runs.
+
+This module only imports small standard library modules so it is cheap
+to import at application startup.
+
+>>> from ox_profile.middleware import WSGIMiddleware
+>>> def app(environ, start_response):
+...     start_response('200 OK', [('Content-Type', 'text/plain')])
+...     return [b'hello']
+...
+>>> wrapped = WSGIMiddleware(app)
+>>> body = wrapped({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/hi'},
+...                lambda status, headers, exc_info=None: None)
+>>> b''.join(body)
+b'hello'
+>>> body.close()
+>>> info = wrapped.stats.snapshot()['GET /hi']
+>>> info['count'], info['errors']
+(1, 0)
+"""
+
+import itertools
+import random
+import threading
+import time
+
+from ox_profile.core import exposition, histograms
+
+
+class _EndpointStats(object):
+    """Streaming aggregates for the requests to one endpoint.
+    """
+
+    def __init__(self, bounds=None):
+        self.count = 0
+        self.errors = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.hist = histograms.Histogram(bounds)
+
+    def add(self, duration_ns, error, weight=1):
+        """Add a request which took duration_ns nanoseconds.
+
+        The weight is how many requests this one stands for (see
+        `RequestSampler`).
+        """
+        self.count += weight
+        self.errors += weight if error else 0
+        self.total_ns += duration_ns * weight
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+        self.hist.add(duration_ns * 1e-9, weight)
+
+
+class RequestStats(object):
+    """Thread safe per endpoint request timings.
+
+    >>> from ox_profile.middleware import RequestStats
+    >>> stats = RequestStats(max_endpoints=1)
+    >>> stats.record('GET /a', 2000000)
+    >>> stats.record('GET /b', 4000000, error=True)
+    >>> sorted(stats.snapshot())
+    ['GET /a', 'other']
+    >>> stats.snapshot()['other']['errors']
+    1
+    """
+
+    def __init__(self, max_endpoints=500, bounds=None):
+        """Initializer.
+
+        :param max_endpoints=500:  Maximum number of distinct endpoints to
+                                   track. Requests for more endpoints are
+                                   counted under 'other' so unusual paths
+                                   (e.g., from scanners) cannot use up
+                                   memory.
+
+        :param bounds=None:   Optional histogram bounds in seconds (see
+                              `histograms.Histogram`).
+
+        """
+        self.max_endpoints = max_endpoints
+        self.bounds = bounds
+        self.endpoints = {}  # endpoint name -> _EndpointStats
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, duration_ns, error=False, weight=1):
+        """Record a request.
+
+        :param endpoint:     String name of the endpoint.
+
+        :param duration_ns:  Nanoseconds the request took.
+
+        :param error=False:  Whether the request failed (an exception or a
+                             5xx status).
+
+        :param weight=1:     Number of requests this one stands for (e.g.,
+                             from `RequestSampler.weight`).
+
+        """
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                if len(self.endpoints) >= self.max_endpoints:
+                    endpoint = 'other'
+                    stats = self.endpoints.get(endpoint)
+                if stats is None:
+                    stats = _EndpointStats(self.bounds)
+                    self.endpoints[endpoint] = stats
+            stats.add(duration_ns, error, weight)
+
+    def reset(self):
+        """Forget all recorded requests.
+        """
+        with self.lock:
+            self.endpoints = {}
+
+    def snapshot(self):
+        """Return dict of endpoint -> dict summarizing its requests.
+
+        Each summary has the 'count', 'errors', 'total' seconds and the
+        'mean', 'max', 'p50', 'p90' and 'p99' durations in seconds.
+        """
+        with self.lock:
+            result = {}
+            for endpoint, stats in self.endpoints.items():
+                summary = stats.hist.summary()
+                summary.update(errors=stats.errors, max=stats.max_ns * 1e-9,
+                               total=stats.total_ns * 1e-9)
+                result[endpoint] = summary
+            return result
+
+    def families(self):
+        """Return list of `exposition.MetricFamily` for the requests.
+        """
+        errors = exposition.MetricFamily(
+            'ox_profile_request_errors', 'counter',
+            'Requests which raised an exception or returned a 5xx status.')
+        with self.lock:
+            items = sorted(self.endpoints.items())
+            series = []
+            for endpoint, stats in items:
+                hist = histograms.Histogram(stats.hist.bounds)
+                hist.merge(stats.hist)
+                series.append(({'endpoint': endpoint}, hist))
+                errors.add(stats.errors, '_total', [('endpoint', endpoint)])
+        return [exposition.histogram_family(
+            'ox_profile_request_duration_seconds', 'Request durations.',
+            series, unit='seconds'), errors]
+
+
+class RequestSampler(object):
+    """Decide which requests to record and how much each one counts.
+
+    With every=N we record one request in N and with probability=p we
+    record each request with probability p. Either way, `weight` returns
+    the number of requests a recorded one stands for (N or 1/p) so
+    counts and totals scaled by it are unbiased estimates.
+
+    >>> from ox_profile.middleware import RequestSampler
+    >>> sampler = RequestSampler(every=3)
+    >>> [sampler.weight() for dummy in range(6)]
+    [3, 0, 0, 3, 0, 0]
+    >>> RequestSampler(probability=1).weight()
+    1.0
+    """
+
+    def __init__(self, every=1, probability=None):
+        """Initializer.
+
+        :param every=1:   Record one out of this many requests.
+
+        :param probability=None:  If given, ignore every and record each
+                                  request with this probability instead.
+
+        """
+        if probability is not None and not 0 < probability <= 1:
+            raise ValueError('Request sampling probability %s not in (0, 1]'
+                             % probability)
+        if int(every) < 1:
+            raise ValueError('Request sampling every=%s must be >= 1' % every)
+        self.every = int(every)
+        self.probability = probability
+        self.counter = itertools.count()  # next() on this needs no lock
+
+    def weight(self):
+        """Return 0 to skip this request or its weight to record it.
+        """
+        if self.probability is not None:
+            if random.random() < self.probability:
+                return 1.0 / self.probability
+            return 0
+        if self.every == 1:
+            return 1
+        return self.every if next(self.counter) % self.every == 0 else 0
+
+
+class ThreadBuffers(object):
+    """Per thread lists of items which are merged into shared storage.
+
+    Calling `add` appends to a list owned by the calling thread so the
+    request path does not take a shared lock. When that list has
+    flush_size items (or someone calls `flush` before reading the shared
+    storage), we pass the items to merge while holding self.lock.
+
+    >>> from ox_profile.middleware import ThreadBuffers
+    >>> merged = []
+    >>> buffers = ThreadBuffers(merged.extend, flush_size=3)
+    >>> for item in range(4):
+    ...     buffers.add(item)
+    ...
+    >>> merged
+    [0, 1, 2]
+    >>> buffers.flush()
+    >>> merged
+    [0, 1, 2, 3]
+    """
+
+    def __init__(self, merge, flush_size=64):
+        """Initializer.
+
+        :param merge:    Callable taking a list of items to merge into
+                         shared storage.
+
+        :param flush_size=64:  Number of items a thread buffers before
+                               merging them.
+
+        """
+        self.merge = merge
+        self.flush_size = flush_size
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.buffers = []  # (thread, items) for each thread which added
+
+    def add(self, item):
+        """Add item from the current thread.
+        """
+        items = getattr(self.local, 'items', None)
+        if items is None:
+            items = self.local.items = []
+            with self.lock:
+                self.buffers.append((threading.current_thread(), items))
+        items.append(item)
+        if len(items) >= self.flush_size:
+            with self.lock:
+                self._drain(items)
+
+    def _drain(self, items):
+        "Merge items (a thread's list) and remove them. Must hold self.lock."
+        count = len(items)  # the owner may append while we do this
+        if count:
+            batch = items[:count]
+            del items[:count]
+            self.merge(batch)
+
+    def flush(self):
+        """Merge items buffered by all threads (e.g., before a report).
+        """
+        with self.lock:
+            for dummy_thread, items in self.buffers:
+                self._drain(items)
+            self.buffers = [(thread, items) for thread, items in self.buffers
+                            if thread.is_alive()]
+
+
+def wsgi_endpoint(environ):
+    """Default endpoint name for a WSGI environ (e.g., 'GET /path').
+    """
+    return '%s %s' % (environ.get('REQUEST_METHOD', ''),
+                      environ.get('PATH_INFO', '') or '/')
+
+
+def asgi_endpoint(scope):
+    """Default endpoint name for an ASGI http scope (e.g., 'GET /path').
+    """
+    return '%s %s' % (scope.get('method', ''), scope.get('path', '') or '/')
+
+
+class _TimedResponse(object):
+    """Wrap the iterable returned by a WSGI app to record on close.
+
+    The WSGI server calls close once it has sent the whole response so
+    the recorded time includes generating streamed responses. We pass
+    on len() so servers can still set Content-Length for a response
+    with one chunk (see also `_finish_on_close` for file wrappers).
+    """
+
+    def __init__(self, result, finish):
+        self.result = result
+        self.finish = finish
+
+    def __iter__(self):
+        try:
+            for chunk in self.result:
+                yield chunk
+        except BaseException:
+            self.finish(True)
+            raise
+
+    def __len__(self):
+        return len(self.result)  # TypeError if result has no length
+
+    def close(self):
+        "Close the wrapped iterable (if it can be) and record the request."
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            self.finish(False)
+
+
+def _finish_on_close(result, finish):
+    """Make result call finish when the server closes it and return it.
+
+    Servers only use their fast path (e.g., sendfile) for a response
+    which is an instance of their own 'wsgi.file_wrapper' so we cannot
+    wrap one in a _TimedResponse. Instead we hook its close method (or
+    record right away if that is not possible).
+    """
+    close = getattr(result, 'close', None)
+
+    def timed_close():
+        "Close result and record the request."
+        try:
+            if close is not None:
+                close()
+        finally:
+            finish(False)
+
+    try:
+        result.close = timed_close
+    except (AttributeError, TypeError):
+        finish(False)
+    return result
+
+
+class WSGIMiddleware(object):
+    """WSGI middleware to time requests (see module docstring).
+    """
+
+    def __init__(self, app, stats=None, endpoint_func=None, tags=None,
+                 sampler=None):
+        """Initializer.
+
+        :param app:          The WSGI application to wrap.
+
+        :param stats=None:   `RequestStats` to record in (a new one is made
+                             if this is None). Available as self.stats.
+
+        :param endpoint_func=None:  Callable taking the environ and returning
+                                    the endpoint name. Default is
+                                    `wsgi_endpoint`. Use this to map paths
+                                    with ids to one name.
+
+        :param tags=None:    Optional dict of thread id -> tag (e.g., from
+                             `Sampler.enable_thread_tags`). While a request
+                             runs, we tag its thread with
+                             'request(<endpoint>)'.
+
+        :param sampler=None: Optional `RequestSampler`. Requests it skips
+                             are passed straight to app.
+
+        """
+        self.app = app
+        self.stats = stats if stats is not None else RequestStats()
+        self.endpoint_func = endpoint_func or wsgi_endpoint
+        self.tags = tags
+        self.sampler = sampler
+
+    def __call__(self, environ, start_response):
+        weight = 1 if self.sampler is None else self.sampler.weight()
+        if not weight:
+            return self.app(environ, start_response)
+        start = time.perf_counter_ns()
+        endpoint = self.endpoint_func(environ)
+        thread_id = threading.get_ident()
+        status = []
+        done = []
+
+        def finish(error):
+            "Record the request (only once)."
+            if done:
+                return
+            done.append(True)
+            if self.tags is not None:
+                self.tags.pop(thread_id, None)
+            error = error or (status and status[0].startswith('5'))
+            self.stats.record(endpoint, time.perf_counter_ns() - start,
+                              bool(error), weight)
+
+        def timed_start_response(status_line, headers, exc_info=None):
+            "Call start_response and remember status_line."
+            status[:] = [status_line]
+            if exc_info is None:
+                return start_response(status_line, headers)
+            return start_response(status_line, headers, exc_info)
+
+        if self.tags is not None:
+            self.tags[thread_id] = 'request(%s)' % endpoint.replace(';', ',')
+        try:
+            result = self.app(environ, timed_start_response)
+        except BaseException:
+            finish(True)
+            raise
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(result, file_wrapper):
+            return _finish_on_close(result, finish)
+        return _TimedResponse(result, finish)
+
+
+class ASGIMiddleware(object):
+    """ASGI middleware to time http requests (see module docstring).
+
+    Requests in an event loop share one thread, so this does not tag
+    threads for the sampler.
+    """
+
+    def __init__(self, app, stats=None, endpoint_func=None, sampler=None):
+        """Initializer.
+
+        :param app:          The ASGI application to wrap.
+
+        :param stats=None:   `RequestStats` to record in (a new one is made
+                             if this is None). Available as self.stats.
+
+        :param endpoint_func=None:  Callable taking the scope and returning
+                                    the endpoint name. Default is
+                                    `asgi_endpoint`.
+
+        :param sampler=None: Optional `RequestSampler`. Requests it skips
+                             are passed straight to app.
+
+        """
+        self.app = app
+        self.stats = stats if stats is not None else RequestStats()
+        self.endpoint_func = endpoint_func or asgi_endpoint
+        self.sampler = sampler
+
+    async def __call__(self, scope, receive, send):
+        weight = 0
+        if scope.get('type') == 'http':
+            weight = 1 if self.sampler is None else self.sampler.weight()
+        if not weight:
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter_ns()
+        endpoint = self.endpoint_func(scope)
+        status = []
+
+        async def timed_send(message):
+            "Remember the response status and pass message on."
+            if message.get('type') == 'http.response.start':
+                status[:] = [message.get('status', 200)]
+            await send(message)
+
+        error = True
+        try:
+            await self.app(scope, receive, timed_send)
+            error = bool(status and status[0] >= 500)
+        finally:
+            self.stats.record(endpoint, time.perf_counter_ns() - start,
+                              error, weight)
+
+
+if __name__ == '__main__':
+    # Run doctest if file executed as a script
+    import doctest
+    doctest.testmod()
+    print('Finished Tests')
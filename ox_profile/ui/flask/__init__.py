@@ -14,10 +14,12 @@ import copy
 
 from flask import Blueprint
 
-from ox_profile.core import launchers
+from ox_profile.core import launchers, histograms, bursts, live, tracing
+from ox_profile import middleware
 
 
-ReqRecord = collections.namedtuple('ReqRecord', ['start_time', 'end_time'])
+ReqRecord = collections.namedtuple('ReqRecord', [
+    'start_time', 'end_time', 'weight'], defaults=[1])
 
 
 class OxProfBlueprint(Blueprint):
@@ -28,10 +30,16 @@ class OxProfBlueprint(Blueprint):
     def __init__(self, *args, **kwargs):
         Blueprint.__init__(self, *args, **kwargs)
         self.req_db = {}
+        self.req_hists = {}  # endpoint -> histograms.Histogram of durations
         self.db_lock = threading.Lock()
+        self.req_buffers = middleware.ThreadBuffers(self._merge_reqs)
+        self.request_sampler = None  # see get_request_sampler
         self.launcher = launchers.SimpleLauncher()
+        self.burst_profiler = None  # created by get_burst_profiler
+        self.live_top = None  # created by get_live_top
+        self.tracer = None  # most recent tracing.FunctionTracer
 
-    def record_req(self, username, endpoint, stime, etime):
+    def record_req(self, username, endpoint, stime, etime, weight=1):
         """Record request information.
 
         :param username:        String username initiating request.
@@ -42,25 +50,145 @@ class OxProfBlueprint(Blueprint):
 
         :param etime:    A datetime.datetime in UTC for end time.
 
+        :param weight=1: Number of requests this one stands for when
+                         requests are sampled (see get_request_sampler).
+
         ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
 
         PURPOSE:  Record data about a completed request. Expected to
-                  be called by something in teardown_app_request.
+                  be called by something in teardown_app_request. This
+                  only appends to a buffer for the current thread;
+                  buffers are merged into self.req_db in batches (and
+                  before get_reqs or get_req_hists read it) so requests
+                  do not contend for self.db_lock.
 
         """
+        self.req_buffers.add((username, endpoint, ReqRecord(
+            stime, etime, weight)))
+
+    def _merge_reqs(self, items):
+        "Merge list of (username, endpoint, ReqRecord) into self.req_db."
         with self.db_lock:
-            key = (username, endpoint)
-            record = self.req_db.get(key, [])
-            if not record:
-                self.req_db[key] = record
-            record.append(ReqRecord(stime, etime))
+            for username, endpoint, req in items:
+                key = (username, endpoint)
+                record = self.req_db.get(key, [])
+                if not record:
+                    self.req_db[key] = record
+                record.append(req)
+                hist = self.req_hists.get(endpoint)
+                if hist is None:
+                    hist = histograms.Histogram()
+                    self.req_hists[endpoint] = hist
+                hist.add((req.end_time - req.start_time).total_seconds(),
+                         req.weight)
 
     def get_reqs(self):
         """Return a copy of self.req_db.
         """
+        self.req_buffers.flush()
         with self.db_lock:
             return copy.deepcopy(self.req_db)
 
+    def get_req_hists(self):
+        """Return a copy of self.req_hists (endpoint -> Histogram).
+        """
+        self.req_buffers.flush()
+        with self.db_lock:
+            return copy.deepcopy(self.req_hists)
+
+    def get_request_sampler(self, every=1, probability=None):
+        """Return RequestSampler deciding which requests to record.
+
+        :param every=1, probability=None:  As for `middleware.RequestSampler`.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :returns:  A RequestSampler. We make a new one if the settings
+                   changed since the last call. This runs on every
+                   request so we do not take a lock (if two threads race
+                   to replace the sampler, either result is fine).
+
+        """
+        sampler = self.request_sampler
+        if sampler is None or (sampler.every, sampler.probability) != (
+                every, probability):
+            sampler = middleware.RequestSampler(every, probability)
+            self.request_sampler = sampler
+        return sampler
+
+    def get_burst_profiler(self, threshold, interval=.001):
+        """Return BurstProfiler for slow requests (creating it if needed).
+
+        :param threshold:       Seconds a request must run before we start
+                                sampling it (see `bursts.BurstProfiler`).
+
+        :param interval=.001:   Sampling interval for slow requests.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :returns:  A BurstProfiler. If threshold or interval changed since
+                   the last call, we make a new one (and stop the old one).
+                   This runs on every request so the common case only
+                   reads self.burst_profiler; we take self.db_lock (and
+                   check again) only when we need to make a new one.
+
+        """
+        old = self.burst_profiler
+        if old is not None and (old.threshold, old.interval) == (
+                threshold, interval):
+            return old
+        with self.db_lock:
+            old = self.burst_profiler
+            if old is not None and (old.threshold, old.interval) == (
+                    threshold, interval):
+                return old
+            self.burst_profiler = bursts.BurstProfiler(
+                threshold=threshold, interval=interval)
+        if old is not None:
+            old.cancel()
+        return self.burst_profiler
+
+    def get_live_top(self, interval=2.0, top_n=20):
+        """Return the LiveTop shared by all live viewers (creating if needed).
+
+        :param interval=2.0, top_n=20:  As for `live.LiveTop`; only used
+                                        when we create it.
+
+        """
+        with self.db_lock:
+            if self.live_top is None:
+                self.live_top = live.LiveTop(self.launcher.sampler.my_db,
+                                             interval=interval, top_n=top_n)
+            return self.live_top
+
+    def start_trace(self, target, max_calls=100000, max_seconds=10.0):
+        """Start tracing the function given by target.
+
+        :param target, max_calls=100000, max_seconds=10.0:  As for
+                                        `tracing.FunctionTracer`.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :returns:  The started FunctionTracer (also kept in self.tracer).
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Only one trace can run at a time so we raise
+                  RuntimeError if the previous one is still active.
+                  We are called from a request so we do not hook the
+                  current thread (see this_thread in
+                  `tracing.FunctionTracer`) to avoid slowing the
+                  worker serving it when sys.monitoring is missing.
+
+        """
+        with self.db_lock:
+            if self.tracer is not None and self.tracer.active:
+                raise RuntimeError('Already tracing %s.' % self.tracer.label)
+            self.tracer = tracing.FunctionTracer(
+                target, max_calls=max_calls, max_seconds=max_seconds,
+                this_thread=False).start()
+            return self.tracer
+
     def register(self, app, *args, **kwargs):
         """Override default register method to also activate plugins.
 
@@ -72,10 +200,27 @@ class OxProfBlueprint(Blueprint):
 
         ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
 
-        PURPOSE:   Override registration so we can start plugins.
+        PURPOSE:   Override registration so we can start plugins. If
+                   app.config['OX_PROF_TIME_SERIES'] is true, we also
+                   turn on time series of function hits (see the trends
+                   view), if app.config['OX_PROF_GIL'] is true, we
+                   estimate GIL contention (shown by the status view),
+                   if app.config['OX_PROF_STATES'] is true, we label
+                   samples as python, native or blocked (see
+                   `Sampler.enable_state_labels`) and if
+                   app.config['OX_PROF_CONTENTION'] is true, we report
+                   the most contended locks (also in the status view).
 
         """
         result = Blueprint.register(self, app, *args, **kwargs)
+        if app.config.get('OX_PROF_TIME_SERIES'):
+            self.launcher.sampler.my_db.enable_time_series()
+        if app.config.get('OX_PROF_GIL'):
+            self.launcher.sampler.enable_gil_estimation()
+        if app.config.get('OX_PROF_STATES'):
+            self.launcher.sampler.enable_state_labels()
+        if app.config.get('OX_PROF_CONTENTION'):
+            self.launcher.sampler.enable_contention()
         logging.debug('Registered ox_profile blueprint')
         return result
 
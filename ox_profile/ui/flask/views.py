@@ -6,14 +6,18 @@ import io
 import csv
 import collections
 import datetime
+import hmac
 import logging
+import time
 from functools import wraps
 
 from flask import (
-    request, Markup, current_app, render_template, url_for, g, make_response)
+    request, Markup, current_app, render_template, url_for, g, make_response,
+    jsonify, Response, stream_with_context)
 from flask_login import login_required
 from flask_login import current_user
 
+from ox_profile.core import exporters, exposition
 from ox_profile.ui.flask import OX_PROF_BP, ReqRecord
 
 RouteInfo = collections.namedtuple('RouteInfo', [
@@ -64,7 +68,8 @@ def index():
     """Top-level index for ox profile.
     """
     commands = [(n, url_for('%s.%s' % ('ox_profile', n))) for n in [
-        'status', 'pause', 'unpause', 'show_req_times']]
+        'status', 'pause', 'unpause', 'show_req_times', 'metrics',
+        'slow_requests', 'live', 'export', 'trends', 'trace']]
 
     return render_template('ox_prof_intro.html', commands=commands)
 
@@ -74,16 +79,112 @@ def index():
 @restrict_access
 def status():
     """Show status of current profiling.
+
+    If the as_json parameter is 1, we return the profiler overhead metrics
+    (see `SamplingTracker.metrics`) as JSON instead of HTML. If samples
+    are labelled by state (see app.config['OX_PROF_STATES']), we also
+    show how the hits of each function split between running python,
+    calling native code and blocking.
     """
+    metrics = OX_PROF_BP.launcher.metrics()
+    if int(request.args.get('as_json', 0)):
+        return jsonify(metrics)
+
     re_filter = request.args.get('re_filter', '.*')
     max_records = int(request.args.get('max_records', 50))
 
-    query, total_records = OX_PROF_BP.launcher.sampler.my_db.query(
+    sampler = OX_PROF_BP.launcher.sampler
+    query, total_records = sampler.my_db.query(
         re_filter=re_filter, max_records=max_records)
+    state_records, state_totals = sampler.my_db.query_states(
+        re_filter=re_filter, max_records=max_records) if getattr(
+            sampler, 'label_states', False) else (None, None)
 
     return render_template(
         'ox_prof_status.html', launcher=OX_PROF_BP.launcher,
-        max_records=max_records, total_records=total_records, query=query)
+        max_records=max_records, total_records=total_records, query=query,
+        state_records=state_records, state_totals=state_totals,
+        metrics=metrics, json_link=Markup(make_download_link(
+            request, {'as_json': 1}, text='Metrics as JSON')))
+
+
+def metrics_access(my_func):
+    """Decorator to allow scrapers with a token or logged in users.
+
+    If current_app.config['OX_PROF_METRICS_TOKEN'] is set and the request
+    has an 'Authorization: Bearer <token>' header with that token, we
+    call my_func. Otherwise we apply the usual login_required and
+    restrict_access checks.
+    """
+    guarded = login_required(restrict_access(my_func))
+
+    @wraps(my_func)
+    def wrapper(*args, **kwds):
+        """Check token or login before execution.
+        """
+        token = current_app.config.get('OX_PROF_METRICS_TOKEN')
+        if token and hmac.compare_digest(  # constant time comparison
+                request.headers.get('Authorization', '').encode('utf8'),
+                ('Bearer %s' % token).encode('utf8')):
+            return my_func(*args, **kwds)
+        return guarded(*args, **kwds)
+
+    return wrapper
+
+
+@OX_PROF_BP.route('/metrics')
+@metrics_access
+def metrics():
+    """Expose request timings and profile data in OpenMetrics text format.
+
+    The top_n parameter (default 20) controls how many functions to show.
+    Everything comes from incrementally maintained aggregates so frequent
+    scrapes are cheap.
+    """
+    top_n = int(request.args.get('top_n', 20))
+    families = exposition.collect_profile_families(
+        OX_PROF_BP.launcher, top_n=top_n)
+    families.append(exposition.histogram_family(
+        'ox_profile_request_duration_seconds', 'Request durations.', [
+            ({'endpoint': endpoint}, hist) for endpoint, hist in sorted(
+                OX_PROF_BP.get_req_hists().items(), key=str)],
+        unit='seconds'))
+    response = make_response(exposition.render(families))
+    response.headers['Content-Type'] = exposition.CONTENT_TYPE
+    return response
+
+
+def get_live_top():
+    "Return OX_PROF_BP.get_live_top() using settings from current_app.config"
+    return OX_PROF_BP.get_live_top(
+        interval=current_app.config.get('OX_PROF_LIVE_INTERVAL', 2.0),
+        top_n=current_app.config.get('OX_PROF_LIVE_TOP_N', 20))
+
+
+@OX_PROF_BP.route('/live')
+@login_required
+@restrict_access
+def live():
+    """Show page with a live top view fed by live_stream.
+    """
+    return render_template('ox_prof_live.html', launcher=OX_PROF_BP.launcher,
+                           live_top=get_live_top())
+
+
+@OX_PROF_BP.route('/live/stream')
+@login_required
+@restrict_access
+def live_stream():
+    """Stream top function deltas as Server-Sent Events.
+
+    All viewers share a single producer (see `live.LiveTop`) so more
+    viewers do not mean more work for the recorder.
+    """
+    response = Response(stream_with_context(get_live_top().stream()),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @OX_PROF_BP.route('/pause')
@@ -141,9 +242,35 @@ def set_interval():
 def monitor_routes():
     """Simple function to record start time of request.
 
-    See monitor_route_completion for more info.
+    This runs for every request of the app so it does as little as
+    possible. Set current_app.config['OX_PROF_RECORD_REQUESTS'] to False
+    to turn off recording request times. To record only some requests,
+    set OX_PROF_REQUEST_SAMPLE_EVERY to N (record 1 in N requests) or
+    OX_PROF_REQUEST_SAMPLE_RATE to a probability. Recorded requests are
+    weighted so the counts shown estimate the total.
+
+    If current_app.config['OX_PROF_SLOW_THRESHOLD'] is set to a number of
+    seconds, we also register the request with the burst profiler so that
+    it gets sampled (every OX_PROF_SLOW_INTERVAL seconds with default
+    0.001) if it runs longer than the threshold. See the slow_requests
+    view for results and monitor_route_completion for more info.
     """
-    g.ox_prof_ts = datetime.datetime.utcnow()
+    config = current_app.config
+    if config.get('OX_PROF_RECORD_REQUESTS', True):
+        weight = OX_PROF_BP.get_request_sampler(
+            config.get('OX_PROF_REQUEST_SAMPLE_EVERY', 1),
+            config.get('OX_PROF_REQUEST_SAMPLE_RATE')).weight()
+        if weight:
+            g.ox_prof_ts = datetime.datetime.utcnow()
+            g.ox_prof_weight = weight
+    threshold = config.get('OX_PROF_SLOW_THRESHOLD')
+    if threshold:
+        # Keep the profiler with the id since settings can change (and
+        # replace the profiler) before the request ends.
+        burst_profiler = OX_PROF_BP.get_burst_profiler(
+            threshold, current_app.config.get('OX_PROF_SLOW_INTERVAL', .001))
+        g.ox_prof_burst = (burst_profiler,
+                           burst_profiler.begin(request.endpoint))
 
 
 @OX_PROF_BP.teardown_app_request
@@ -158,12 +285,20 @@ def monitor_route_completion(exception=None):
                just completed for profiling information.
 
     """
+    burst = g.pop('ox_prof_burst', None)
+    if burst is not None:  # end on the profiler which issued the id
+        burst_profiler, burst_id = burst
+        burst_profiler.end(burst_id)
+    start = g.pop('ox_prof_ts', None)
+    if start is None:  # recording is off or request not sampled
+        return
     try:
         user = getattr(current_user, 'name', None)
         if user is None:
             user = getattr(current_user, 'username', 'unknown')
-        OX_PROF_BP.record_req(user, request.endpoint, g.ox_prof_ts,
-                              datetime.datetime.utcnow())
+        OX_PROF_BP.record_req(user, request.endpoint, start,
+                              datetime.datetime.utcnow(),
+                              g.pop('ox_prof_weight', 1))
     except Exception as problem:  # pylint:disable=broad-except
         logging.error('Got problem %s in monitor_route_completion', str(
             problem))
@@ -182,7 +317,8 @@ def show_req_times():
     user_times = {}
     func_times = {}
     for (user, endpoint), time_list in reqs.items():
-        runtimes = [(e - s).total_seconds() for s, e in time_list]
+        runtimes = [((r.end_time - r.start_time).total_seconds(), r.weight)
+                    for r in time_list]
         fdata = func_times.get(endpoint, [])
         if not fdata:
             func_times[endpoint] = fdata
@@ -191,8 +327,11 @@ def show_req_times():
         if not udata:
             user_times[endpoint] = udata
         udata.extend(runtimes)
-    rinfo = [RouteInfo(name, len(data), sum(data)/float(len(data))) for (
-        name, data) in func_times.items()]
+    rinfo = []
+    for name, data in func_times.items():
+        hits = sum(weight for dummy, weight in data)
+        rinfo.append(RouteInfo(name, hits, sum(
+            seconds * weight for seconds, weight in data) / float(hits)))
 
     result = render_template('ox_prof_rinfo.html', rinfo=reversed(sorted(
         rinfo, key=lambda r: r.avg_time)), csv_link=Markup(make_download_link(
@@ -201,6 +340,141 @@ def show_req_times():
     return result
 
 
+@OX_PROF_BP.route('/slow_requests')
+@OX_PROF_BP.route('/slow_requests/<int:sample_id>')
+@login_required
+@restrict_access
+def slow_requests(sample_id=None):
+    """Show recent slow requests and the profile for one of them.
+
+    Requires current_app.config['OX_PROF_SLOW_THRESHOLD'] to be set (see
+    monitor_routes).
+    """
+    burst_profiler = OX_PROF_BP.burst_profiler
+    if burst_profiler is None:
+        return render_template('ox_prof_err.html', error_msg=(
+            'No slow requests recorded. Configure'
+            ' app.config["OX_PROF_SLOW_THRESHOLD"] to enable.'))
+    slow = burst_profiler.get_slow_requests()
+    selected, query, total_records = None, [], 0
+    if sample_id is not None:
+        selected = burst_profiler.find(sample_id)
+        if selected is None:
+            return render_template('ox_prof_err.html', error_msg=(
+                'No slow request with sample id %s.' % sample_id))
+        max_records = int(request.args.get('max_records', 50))
+        query, total_records = selected.block.query(max_records=max_records)
+    return render_template(
+        'ox_prof_slow.html', slow=slow, selected=selected, query=query,
+        total_records=total_records, threshold=burst_profiler.threshold,
+        start_times=dict((item.sample_id, datetime.datetime.utcfromtimestamp(
+            item.start_time)) for item in slow))
+
+
+@OX_PROF_BP.route('/export')
+@OX_PROF_BP.route('/export/<fmt>')
+@login_required
+@restrict_access
+def export(fmt='pprof'):
+    """Download the current profile in the given format.
+
+    The fmt can be 'pprof' (gzipped protocol buffer for `go tool pprof`),
+    'speedscope' (JSON for https://www.speedscope.app) or 'callgrind'
+    (for KCachegrind). The file is streamed as it is generated.
+    """
+    if fmt not in exporters.EXPORTERS:
+        return render_template('ox_prof_err.html', error_msg=(
+            'Unknown export format %s; choose one of %s.' % (
+                fmt, ', '.join(sorted(exporters.EXPORTERS)))))
+    generator, dummy_binary, mimetype, ext = exporters.EXPORTERS[fmt]
+    launcher = OX_PROF_BP.launcher
+    metadata = {'interval': launcher.interval, 'command': request.url_root,
+                'time': time.time()}
+    response = Response(generator(launcher.sampler.my_db.stacks(), metadata),
+                        mimetype=mimetype)
+    response.headers["Content-Disposition"] = (
+        "attachment; filename=ox_profile.%s" % ext)
+    return response
+
+
+def sparkline_points(values, width=240, height=30):
+    """Return SVG polyline points for list of (time, hits) pairs.
+    """
+    peak = float(max([hits for dummy, hits in values] + [1]))
+    step = width / float(max(len(values) - 1, 1))
+    return ' '.join('%.1f,%.1f' % (index * step, height - (
+        height * hits / peak)) for index, (dummy, hits) in enumerate(values))
+
+
+@OX_PROF_BP.route('/trends')
+@login_required
+@restrict_access
+def trends():
+    """Show sparklines of hits over time for the most active functions.
+
+    The resolution parameter (1, 60 or 600 seconds; default 60) picks
+    the time series level and max_records (default 20) how many functions
+    to show. Functions whose share of samples jumped compared to their
+    trailing baseline are flagged. If the as_json parameter is 1, we
+    return the data as JSON.
+
+    Time series are kept if app.config['OX_PROF_TIME_SERIES'] is true;
+    otherwise, visiting this view turns them on.
+    """
+    recorder = OX_PROF_BP.launcher.sampler.my_db
+    resolution = int(request.args.get('resolution', 60))
+    max_records = int(request.args.get('max_records', 20))
+    report = recorder.series_report(resolution=resolution, limit=max_records)
+    if report is None:
+        recorder.enable_time_series()
+        return render_template('ox_prof_msg.html', message=(
+            'Started keeping time series; reload later to see trends.'))
+    if int(request.args.get('as_json', 0)):
+        report['anomalies'] = [item._asdict() for item in report[
+            'anomalies']]
+        return jsonify(report)
+    flagged = dict((item.name, item) for item in report['anomalies'])
+    rows = [(name, sparkline_points(values), sum(h for dummy, h in values),
+             flagged.get(name)) for name, values in report['functions']]
+    return render_template(
+        'ox_prof_trends.html', report=report, rows=rows,
+        total_points=sparkline_points(report['total']),
+        resolutions=[level[0] for level in recorder.series.levels],
+        json_link=Markup(make_download_link(
+            request, {'as_json': 1}, text='Trends as JSON')))
+
+
+@OX_PROF_BP.route('/trace')
+@login_required
+@restrict_access
+def trace():
+    """Trace calls of one function for a bounded window.
+
+    If the function parameter is given (a label such as
+    'render(app.views)' as shown by the status view), we start tracing
+    it for at most seconds (default 10) or calls (default 100000)
+    calls. Otherwise, we show the results of the most recent trace. If
+    the as_json parameter is 1, we return the report as JSON.
+    """
+    target = request.args.get('function', '').strip()
+    if target:
+        try:
+            OX_PROF_BP.start_trace(
+                target, max_calls=int(request.args.get('calls', 100000)),
+                max_seconds=float(request.args.get('seconds', 10)))
+        except (ValueError, RuntimeError) as problem:
+            return render_template('ox_prof_err.html', error_msg=problem)
+    tracer = OX_PROF_BP.tracer
+    report = tracer.report() if tracer is not None else None
+    if int(request.args.get('as_json', 0)):
+        return jsonify(report)
+    return render_template(
+        'ox_prof_trace.html', report=report, buckets=[] if (
+            tracer is None) else [(bound, count) for bound, count in zip(
+                tracer.hist.bounds + [float('inf')], tracer.hist.counts)
+                                  if count])
+
+
 def _make_csv_response(name, data):
     if isinstance(data, str):
         text = data
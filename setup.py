@@ -47,6 +47,9 @@ setup(
     # simple. Or you can use find_packages().
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
     install_requires=[],
+    # Optional faster aggregation for very large profiles (see
+    # ox_profile.core.columnar).
+    extras_require={'numpy': ['numpy']},
     # If there are data files included in your packages that need to be
     # installed, specify them here.
     package_data={
@@ -57,7 +60,9 @@ setup(
     # pip to create the appropriate form of executable for the target platform.
     entry_points={
         'console_scripts': [
-            'sample=sample:main',
+            'ox_profile=ox_profile.cli:main',
+            'ox_profile_merge=ox_profile.merge:main',
+            'ox_profile_agent=ox_profile.agent:main',
         ],
     },
 )
@@ -0,0 +1,15 @@
+"""Helpers shared by the unit tests.
+"""
+
+
+class FakeMeasurement(object):
+    """Stand-in for metrics.Measurement with a given stack name.
+
+    If state is given, we set it as the state of the sample (see
+    `Sampler.enable_state_labels`).
+    """
+
+    def __init__(self, name, state=None):
+        self.name = name
+        if state is not None:
+            self.state = state
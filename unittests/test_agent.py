@@ -0,0 +1,67 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from ox_profile import agent
+
+
+def busy_loop(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class AgentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = agent.socket_path(directory=self.tmp_dir.name)
+        self.agent = agent.Agent(path=self.path)
+        self.agent.listen()
+        self.agent.start()
+
+    def tearDown(self):
+        if self.agent.launcher is not None:
+            self.agent.launcher.cancel()
+        self.agent.stop()
+        self.tmp_dir.cleanup()
+
+    def ask(self, command):
+        return agent.request(None, command, path=self.path)
+
+    def test_zero_cost_until_started(self):
+        status = json.loads(self.ask('status'))
+        self.assertEqual(status['pid'], os.getpid())
+        self.assertFalse(status['running'])
+        self.assertIsNone(self.agent.launcher)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_start_delta_reset(self):
+        status = json.loads(self.ask('start .002'))
+        self.assertTrue(status['running'])
+        self.assertEqual(status['interval'], .002)
+        busy_loop(.3)
+        first = agent.decode_delta(self.ask('delta'))
+        self.assertTrue(any('busy_loop' in name for name, hits in first))
+        json.loads(self.ask('pause'))
+        busy_loop(.05)  # let a sample in progress finish
+        total = dict(self.agent.launcher.sampler.my_db.stacks())
+        second = agent.decode_delta(self.ask('delta'))
+        for name, hits in second:
+            self.assertEqual(dict(first).get(name, 0) + hits, total[name])
+        self.assertEqual(agent.decode_delta(self.ask('delta')), [])
+        self.assertIn('busy_loop', self.ask('show 100').decode('utf8'))
+        self.assertEqual(json.loads(self.ask('reset'))['stacks'], 0)
+
+    def test_errors(self):
+        with self.assertRaises(RuntimeError):
+            self.ask('no_such_command')
+        with self.assertRaises(RuntimeError):
+            self.ask('interval -1')
+        self.assertFalse(json.loads(self.ask('status'))['running'])
+
+
+if __name__ == '__main__':
+    unittest.main()
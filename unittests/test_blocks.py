@@ -0,0 +1,76 @@
+import sys
+import threading
+import unittest
+from time import sleep
+from unittest import mock
+
+from ox_profile import profile_block
+from ox_profile.core import blocks, recording
+
+
+def block_target_function():
+    sleep(.5)
+
+
+def other_thread_function(stop_event):
+    while not stop_event.is_set():
+        sleep(.01)
+
+
+class ProfileBlockTestCase(unittest.TestCase):
+
+    def test_context_manager_samples_only_calling_thread(self):
+        stop_event = threading.Event()
+        other = threading.Thread(target=other_thread_function,
+                                 args=(stop_event,))
+        other.start()
+        try:
+            with profile_block(interval=.001) as prof:
+                block_target_function()
+        finally:
+            stop_event.set()
+            other.join()
+
+        query, total_records = prof.query(max_records=None)
+        names = [i.name for i in query]
+        self.assertGreater(total_records, 0)
+        self.assertTrue(any('block_target_function' in n for n in names))
+        self.assertFalse(any('other_thread_function' in n for n in names))
+
+    def test_decorator_shares_launcher(self):
+        @profile_block(interval=.001)
+        def decorated():
+            block_target_function()
+
+        decorated()
+        launcher = blocks.SHARED_LAUNCHER.get()
+        decorated()
+        self.assertIs(launcher, blocks.SHARED_LAUNCHER.get())
+        self.assertTrue(launcher.is_paused())
+        query, dummy_total = decorated.profile.query(max_records=None)
+        self.assertTrue(any('block_target_function' in i.name
+                            for i in query))
+
+    def test_torn_stacks_are_skipped(self):
+        sampler = blocks.BlockSampler()
+        sampler.tolerate_torn = True  # as if the GIL were disabled
+        good, bad = [mock.Mock(my_db=recording.CountingRecorder())
+                     for dummy in range(2)]
+        sampler.add(1, good)
+        sampler.add(2, bad)
+
+        class TornFrame(object):
+            @property
+            def f_code(self):
+                raise RuntimeError('frame changed')
+
+        with mock.patch.object(sys, '_current_frames', return_value={
+                1: sys._getframe(), 2: TornFrame()}):
+            sampler.run()
+        self.assertEqual(sampler.torn_stacks, 1)
+        self.assertEqual(good.my_db.query()[1], 1)
+        self.assertEqual(bad.my_db.query()[1], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
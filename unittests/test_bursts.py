@@ -0,0 +1,56 @@
+import threading
+import unittest
+from time import sleep
+
+from ox_profile.core import blocks, bursts
+
+
+def slow_request_handler(seconds):
+    sleep(seconds)
+
+
+class BurstProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.bursts = bursts.BurstProfiler(threshold=.05, interval=.001,
+                                           max_kept=2)
+
+    def tearDown(self):
+        self.bursts.cancel()
+
+    def handle(self, endpoint, seconds):
+        sample_id = self.bursts.begin(endpoint)
+        slow_request_handler(seconds)
+        return self.bursts.end(sample_id)
+
+    def test_only_slow_requests_profiled(self):
+        self.assertIsNone(self.handle('fast', 0))
+        slow = self.handle('slow', .3)
+        self.assertEqual(slow.endpoint, 'slow')
+        query, dummy_total = slow.block.query(max_records=None)
+        self.assertTrue(any('slow_request_handler' in i.name
+                            for i in query))
+        self.assertEqual([i.endpoint for i in
+                          self.bursts.get_slow_requests()], ['slow'])
+        self.assertIs(self.bursts.find(slow.sample_id), slow)
+        self.assertFalse(blocks.SHARED_LAUNCHER.get().sampler.active)
+
+    def test_samples_request_thread(self):
+        results = []
+        worker = threading.Thread(target=lambda: results.append(
+            self.handle('threaded', .3)))
+        worker.start()
+        worker.join()
+        query, dummy_total = results[0].block.query(max_records=None)
+        self.assertTrue(any('slow_request_handler' in i.name
+                            for i in query))
+
+    def test_keeps_most_recent(self):
+        for endpoint in ['a', 'b', 'c']:
+            self.handle(endpoint, .1)
+        self.assertEqual([i.endpoint for i in
+                          self.bursts.get_slow_requests()], ['c', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
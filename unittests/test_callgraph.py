@@ -0,0 +1,39 @@
+import unittest
+
+from ox_profile.core import callgraph, recording
+from unittests.helpers import FakeMeasurement
+
+
+class CallGraphTestCase(unittest.TestCase):
+
+    def test_recursion_counts_once(self):
+        graph = callgraph.CallGraph()
+        graph.add(['main', 'walk', 'walk', 'walk', 'leaf'], 2)
+        self.assertEqual(graph.inclusive['walk'], 2)
+        self.assertEqual(graph.callees('walk'), [
+            callgraph.CallEdge('walk', 2, 0),
+            callgraph.CallEdge('leaf', 2, 2)])
+        self.assertEqual(graph.callers('walk'), [
+            callgraph.CallEdge('main', 2, 0),
+            callgraph.CallEdge('walk', 2, 0)])
+        self.assertEqual(graph.callers('main'), [])
+
+    def test_recorders_update_incrementally(self):
+        for recorder in [recording.CountingRecorder(),
+                         recording.ShardedRecorder(shards=3)]:
+            recorder.record_many([FakeMeasurement('main;render;execute')] * 3)
+            self.assertEqual(recorder.callers('execute'), [
+                callgraph.CallEdge('render', 3, 3)])
+            recorder.record(FakeMeasurement('main;execute'))
+            recorder.record(FakeMeasurement('main;render'))
+            self.assertEqual(recorder.callers('execute'), [
+                callgraph.CallEdge('render', 3, 3),
+                callgraph.CallEdge('main', 1, 1)])
+            self.assertEqual(recorder.callees('main', limit=1), [
+                callgraph.CallEdge('render', 4, 1)])
+            recorder.reset()
+            self.assertEqual(recorder.callees('main'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
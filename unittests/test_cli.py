@@ -0,0 +1,97 @@
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from ox_profile import cli
+from ox_profile.core import recording
+
+
+SCRIPT = '''
+import time
+
+def slow_target_function():
+    time.sleep(.5)
+
+if __name__ == '__main__':
+    slow_target_function()
+'''
+
+
+class CommandLineTestCase(unittest.TestCase):
+
+    def test_run_script_and_load_profile(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            script = os.path.join(tmp_dir, 'my_script.py')
+            output = os.path.join(tmp_dir, 'out.folded')
+            with open(script, 'w') as my_fd:
+                my_fd.write(SCRIPT)
+            cli.main(['-q', '-o', output, '-t', 'MainThread',
+                      '-l', 'release=7', script])
+            recorder = recording.CountingRecorder()
+            with open(output) as my_fd:
+                metadata = recorder.load(my_fd)
+
+        self.assertEqual(metadata['release'], '7')
+        self.assertEqual(metadata['command'], script)
+        query, total_records = recorder.query(max_records=None)
+        self.assertGreater(total_records, 0)
+        self.assertTrue(any(i.name.startswith('slow_target_function')
+                            for i in query))
+        self.assertFalse(any('ox_profile.core.launchers' in i.name
+                             for i in query))
+
+    def test_states_in_text_output(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            script = os.path.join(tmp_dir, 'my_script.py')
+            output = os.path.join(tmp_dir, 'out.txt')
+            with open(script, 'w') as my_fd:
+                my_fd.write(SCRIPT)
+            cli.main(['-q', '-o', output, '-t', 'MainThread', '--states',
+                      '-f', 'text', script])
+            with open(output) as my_fd:
+                text = my_fd.read()
+        self.assertNotIn('[blocked]', text)  # stacks have real frames only
+        self.assertIn('%blocked', text)
+
+    def test_module_options_go_to_module(self):
+        saved = sys.argv[:], sys.path[:], os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            try:
+                os.chdir(tmp_dir)  # python -m finds modules in cwd
+                with open('local_cli_mod.py', 'w') as my_fd:
+                    my_fd.write('import json, sys\n'
+                                'with open("argv.json", "w") as out:\n'
+                                '    json.dump(sys.argv[1:], out)\n')
+                with open('in.json', 'w') as my_fd:
+                    my_fd.write('{"b": 1, "a": 2}')
+                cli.main(['-q', '-o', 'a.folded', '-m', 'json.tool',
+                          '--sort-keys', 'in.json', 'sorted.json'])
+                cli.main(['-o', 'b.folded', '-m', 'local_cli_mod', '-q',
+                          '-o', 'x'])
+                with open('sorted.json') as my_fd:
+                    self.assertEqual(list(json.load(my_fd)), ['a', 'b'])
+                with open('argv.json') as my_fd:
+                    self.assertEqual(json.load(my_fd), ['-q', '-o', 'x'])
+                self.assertTrue(os.path.exists('b.folded'))
+            finally:
+                sys.modules.pop('local_cli_mod', None)
+                sys.argv[:], sys.path[:] = saved[0], saved[1]
+                os.chdir(saved[2])
+
+    def test_save_load_round_trip(self):
+        recorder = recording.CountingRecorder()
+        recorder.my_db['a(m);b(m)'] = 3
+        recorder.my_db['a(m);<lambda>(m)'] = 2
+        my_fd = io.StringIO()
+        self.assertEqual(recorder.save(my_fd, {'host': 'x'}), 2)
+        my_fd.seek(0)
+        other = recording.CountingRecorder()
+        self.assertEqual(other.load(my_fd), {'host': 'x'})
+        self.assertEqual(dict(other.my_db), dict(recorder.my_db))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import random
+import unittest
+
+from ox_profile.core import columnar, recording
+from unittests.helpers import FakeMeasurement
+
+
+def make_recorder(seed=3, num_stacks=300):
+    my_rand = random.Random(seed)
+    funcs = ['f%i(m)' % i for i in range(40)]
+    recorder = recording.CountingRecorder()
+    for dummy in range(num_stacks):
+        # allow repeats so recursion is counted like query does
+        name = ';'.join(my_rand.choice(funcs) for dummy in range(
+            my_rand.randint(1, 8)))
+        for dummy in range(my_rand.randint(1, 4)):
+            recorder.record(FakeMeasurement(name))
+    return recorder
+
+
+class ColumnarTestCase(unittest.TestCase):
+
+    def check_matches_recorder(self, use_numpy):
+        recorder = make_recorder()
+        prof = recorder.to_columnar(use_numpy=use_numpy)
+        for re_filter in ['.*', 'f1', '[37]\\(']:
+            expected, num_records = recorder.query(re_filter, None)
+            result, prof_records = prof.query(re_filter, None)
+            self.assertEqual(num_records, prof_records)
+            self.assertEqual(dict((i.name, i.hits) for i in expected),
+                             dict((i.name, i.hits) for i in result))
+            top = prof.query(re_filter, 5)[0]
+            self.assertEqual([i.hits for i in top],
+                             [i.hits for i in expected[:5]])
+        self_hits = dict(prof.top(prof.self_totals()))
+        self.assertEqual(sum(self_hits.values()),
+                         sum(recorder.my_db.values()))
+
+    def test_python_fallback(self):
+        self.check_matches_recorder(use_numpy=False)
+
+    @unittest.skipIf(columnar.get_numpy() is None, 'numpy not installed')
+    def test_numpy(self):
+        self.check_matches_recorder(use_numpy=True)
+
+    @unittest.skipIf(columnar.get_numpy() is None, 'numpy not installed')
+    def test_recorder_uses_columnar_for_large_profiles(self):
+        recorder = make_recorder()
+        expected = recorder.query('f2', None)[0]
+        recorder.query_cache.clear()
+        recorder.columnar_threshold = 1
+        result = recorder.query('f2', None)[0]
+        self.assertIsNotNone(recorder.columnar)
+        self.assertEqual(dict((i.name, i.hits) for i in expected),
+                         dict((i.name, i.hits) for i in result))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import gc
+import json
+import queue
+import sys
+import threading
+import time
+import unittest
+
+from ox_profile import cli
+from ox_profile.core import contention, metrics, recording, sampling
+
+
+class Cache(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def get(self, started):
+        with self._lock:
+            started.set()
+            time.sleep(.2)
+
+
+class TrackedLockTestCase(unittest.TestCase):
+
+    def test_counts_contended_acquires(self):
+        lock = contention.TrackedLock(threading.RLock())
+        with lock:
+            with lock:  # re-entrant
+                self.assertEqual(lock.depth, 2)
+            self.assertEqual(lock.owner, threading.get_ident())
+            worker = threading.Thread(target=lambda: lock.acquire(
+                timeout=5) and lock.release())
+            worker.start()
+            time.sleep(.05)
+        worker.join()
+        self.assertIsNone(lock.owner)
+        self.assertEqual((lock.acquires, lock.contended), (3, 1))
+        self.assertGreater(lock.wait, 0)
+
+    def test_condition_with_wrapped_rlock(self):
+        self.addCleanup(gc.collect)  # so other tests do not report it
+        for inner, depth in [(threading.RLock(), 2), (threading.Lock(), 1)]:
+            lock = contention.TrackedLock(inner)
+            cond = threading.Condition(lock)
+            with self.assertRaises(RuntimeError):
+                cond.wait(0)  # not held
+            ready = []
+
+            def notify():
+                with cond:
+                    ready.append(True)
+                    cond.notify()
+
+            with cond:
+                if depth == 2:
+                    lock.acquire()  # re-entrant
+                worker = threading.Thread(target=notify)
+                worker.start()
+                self.assertTrue(cond.wait_for(lambda: ready, timeout=5))
+                self.assertEqual((lock.owner, lock.depth),
+                                 (threading.get_ident(), depth))
+                if depth == 2:
+                    lock.release()
+            worker.join(5)
+            self.assertEqual((lock.owner, lock.depth), (None, 0))
+            got = []  # try from another thread since an RLock is re-entrant
+            checker = threading.Thread(target=lambda: got.append(
+                inner.acquire(False)) or inner.release())
+            checker.start()
+            checker.join()
+            self.assertEqual(got, [True])
+
+
+class ContentionProfilerTestCase(unittest.TestCase):
+
+    def test_groups_waits_by_lock(self):
+        cache, raw_lock, work = Cache(), threading.Lock(), queue.Queue()
+        tracked = contention.track(cache, '_lock')
+        started = threading.Event()
+        raw_lock.acquire()
+        workers = [
+            threading.Thread(target=cache.get, args=(started,)),
+            threading.Thread(target=cache.get, args=(threading.Event(),)),
+            threading.Thread(target=lambda: raw_lock.acquire(
+                timeout=5) and raw_lock.release()),
+            threading.Thread(target=work.get, kwargs={'timeout': 5})]
+        for worker in workers:
+            worker.start()
+        started.wait(5)
+        time.sleep(.05)
+        profiler = contention.ContentionProfiler()
+        try:
+            ids = set(worker.ident for worker in workers)
+            for now in range(4):  # only look at our threads
+                frames = sys._current_frames()
+                profiler.observe(dict((key, frames[key]) for key in ids),
+                                 metrics.Measurement, now=now)
+        finally:
+            raw_lock.release()
+            work.put(None)
+            for worker in workers:
+                worker.join()
+        report = profiler.report()
+        json.dumps(report)  # make sure it is machine readable
+        self.assertEqual((report['observations'], report['blocked']), (3, 9))
+        locks = dict((item['lock'], item) for item in report['locks'])
+        self.assertEqual(sorted(locks), ['Cache._lock', 'raw_lock in <lambda>',
+                                         'self in Queue.get'])
+        item = locks['Cache._lock']
+        self.assertEqual((item['kind'], item['samples'], item['wait']),
+                         ('with', 3, 3))
+        self.assertIn('get(%s)' % __name__, item['waiters'][0][0])
+        self.assertEqual(item['holders'][0][1], 3)
+        self.assertEqual(item['tracked']['contended'], 1)
+        self.assertIs(tracked, cache._lock)
+        self.assertEqual(locks['self in Queue.get']['kind'], 'get')
+        self.assertEqual(locks['raw_lock in <lambda>']['kind'], 'acquire')
+
+    def test_does_not_touch_waiting_objects(self):
+        lock, looked_up = threading.Lock(), []
+
+        class Holder(object):
+
+            def __getattr__(self, name):
+                looked_up.append(name)
+                return lock
+
+        holder = Holder()
+        lock.acquire()
+        worker = threading.Thread(target=lambda: holder.guard.acquire(
+            timeout=5) and lock.release())
+        worker.start()
+        time.sleep(.05)
+        profiler = contention.ContentionProfiler()
+        try:
+            for now in range(3):
+                profiler.observe({worker.ident: sys._current_frames()[
+                    worker.ident]}, now=now)
+        finally:
+            lock.release()
+            worker.join()
+        self.assertEqual(looked_up, ['guard'])  # only by the worker itself
+        self.assertEqual([(item['lock'], item['samples']) for item in
+                          profiler.report()['locks']],
+                         [('holder.guard in <lambda>', 2)])
+
+    def test_tracked_locks_have_unique_keys(self):
+        profiler = contention.ContentionProfiler()
+        first = contention.TrackedLock(name='first')
+        first.acquire()
+        waiter = threading.Thread(target=lambda: first.acquire(
+            timeout=5) and first.release())
+        waiter.start()
+        time.sleep(.05)
+        for now in range(2):
+            profiler.observe({waiter.ident: sys._current_frames()[
+                waiter.ident]}, now=now)
+        first.release()
+        waiter.join()
+        self.assertEqual(contention.WAITING, {})
+        keys = set(profiler.locks)
+        del first, waiter
+        second = contention.TrackedLock(name='second')  # may reuse the id
+        self.assertNotIn(second.key, keys)
+        self.assertEqual([item['lock'] for item in profiler.report()['locks']
+                          if item['samples']], ['first'])
+
+    def test_sampler_and_launcher_metrics(self):
+        lock = threading.Lock()
+        lock.acquire()
+        worker = threading.Thread(target=lambda: lock.acquire(
+            timeout=5) and lock.release())
+        worker.start()
+        sampler = sampling.Sampler(recording.CountingRecorder(),
+                                   thread_filter=lambda tid: tid == (
+                                       worker.ident))
+        profiler = sampler.enable_contention()
+        self.assertIs(profiler, sampler.enable_contention())
+        time.sleep(.05)
+        for dummy in range(3):
+            sampler.run()
+        lock.release()
+        worker.join()
+        self.assertEqual(profiler.report()['blocked'], 2)
+        self.assertIn('lock in <lambda> (acquire)',
+                      cli.format_contention_report(profiler.report()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import gzip
+import io
+import json
+import unittest
+
+from ox_profile.core import exporters, recording
+
+
+def read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return result, pos
+
+
+def decode(data):
+    """Minimal protocol buffer decoder: return dict field -> list of values.
+    """
+    result = {}
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        else:
+            assert wire_type == 2, wire_type
+            size, pos = read_varint(data, pos)
+            value, pos = data[pos:pos + size], pos + size
+        result.setdefault(field, []).append(value)
+    return result
+
+
+def decode_packed(data):
+    values, pos = [], 0
+    while pos < len(data):
+        value, pos = read_varint(data, pos)
+        values.append(value)
+    return values
+
+
+class ExportersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.recorder = recording.CountingRecorder()
+        self.recorder.load(io.StringIO(
+            'main(app);work(app);sleep(time) 300\nmain(app) 2\n'))
+
+    def test_pprof(self):
+        my_fd = io.BytesIO()
+        exporters.export(self.recorder, 'pprof', my_fd,
+                         {'interval': .001, 'host': 'h'})
+        profile = decode(gzip.decompress(my_fd.getvalue()))
+        strings = [s.decode('utf8') for s in profile[6]]
+        self.assertEqual(strings[0], '')
+        functions = dict((fields[1][0], strings[fields[2][0]]) for fields in [
+            decode(item) for item in profile[5]])
+        locations = dict((fields[1][0], functions[decode(fields[4][0])[1][0]])
+                         for fields in [decode(item) for item in profile[4]])
+        samples = []
+        for item in profile[2]:
+            fields = decode(item)
+            samples.append(([locations[i] for i in decode_packed(
+                fields[1][0])], decode_packed(fields[2][0])))
+        self.assertEqual(sorted(samples), [
+            (['main(app)'], [2, 2000000]),
+            (['sleep(time)', 'work(app)', 'main(app)'], [300, 300000000])])
+        self.assertEqual(profile[12], [1000000])
+        self.assertIn('host: h', [strings[i] for i in profile[13]])
+
+    def test_pprof_streams_chunks(self):
+        self.recorder.load(io.StringIO(''.join(
+            'main(app);f%i(app) 1\n' % i for i in range(5000))))
+        chunks = list(exporters.iter_pprof(self.recorder.stacks(),
+                                           chunk_size=1024))
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(len(decode(gzip.decompress(b''.join(chunks)))[2]),
+                         5002)
+
+    def test_speedscope(self):
+        my_fd = io.StringIO()
+        exporters.export(self.recorder, 'speedscope', my_fd,
+                         {'command': 'job.py'})
+        data = json.loads(my_fd.getvalue())
+        profile = data['profiles'][0]
+        frames = [f['name'] for f in data['shared']['frames']]
+        stacks = sorted(
+            ([frames[i] for i in sample], weight) for sample, weight in zip(
+                profile['samples'], profile['weights']))
+        self.assertEqual(stacks, [
+            (['main(app)'], 2),
+            (['main(app)', 'work(app)', 'sleep(time)'], 300)])
+        self.assertEqual((profile['type'], profile['endValue']),
+                         ('sampled', 302))
+        self.assertEqual(data['name'], 'job.py')
+
+
+    def test_callgrind(self):
+        my_fd = io.StringIO()
+        exporters.export(self.recorder, 'callgrind', my_fd)
+        text = my_fd.getvalue()
+        self.assertTrue(text.startswith('# callgrind format\n'))
+        self.assertIn('summary: 302\n', text)
+        blocks = dict((block.split('\n')[1], block.split('\n')[2:])
+                      for block in text.strip().split('\n\n')[1:])
+        self.assertEqual(blocks['fn=(1) main(app)'], [
+            '0 2', 'cfl=(1)', 'cfn=(2) work(app)', 'calls=300 0', '0 300'])
+        self.assertEqual(blocks['fn=(3) sleep(time)'], ['0 300'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import re
+import unittest
+
+from ox_profile.core import exposition, histograms, recording
+from ox_profile.core.launchers import SimpleLauncher
+from unittests.helpers import FakeMeasurement
+
+
+SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(.*)\})? (\S+)$')
+LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def scrape(text):
+    """Minimal stand-in for a Prometheus scraper.
+
+    Returns dict mapping (sample_name, sorted label pairs) to float value
+    and checks the basic structure of the exposition.
+    """
+    lines = text.rstrip('\n').split('\n')
+    assert lines[-1] == '# EOF', lines[-1]
+    result = {}
+    for line in lines[:-1]:
+        if line.startswith('#'):
+            assert line.split(' ')[1] in ('TYPE', 'UNIT', 'HELP'), line
+            continue
+        match = SAMPLE_RE.match(line)
+        assert match, line
+        labels = tuple(sorted(LABEL_RE.findall(match.group(3) or '')))
+        result[(match.group(1), labels)] = float(match.group(4))
+    return result
+
+
+class ExpositionTestCase(unittest.TestCase):
+
+    def test_function_totals_are_incremental(self):
+        recorder = recording.CountingRecorder()
+        stacks = ['main(m);a(m);b(m)', 'main(m);a(m)', 'main(m);c(m)']
+        for name in stacks:
+            recorder.record(FakeMeasurement(name))
+        self.assertIsNone(recorder.pending)  # not tracked until needed
+        first = recorder.function_totals()
+        self.assertEqual(recorder.pending, {})
+        recorder.record_many([FakeMeasurement(stacks[0])])
+        totals = {name: (hits, self_hits) for name, hits, self_hits in
+                  recorder.function_totals()}
+        query, dummy = recorder.query(max_records=None)
+        self.assertEqual({i.name: i.hits for i in query},
+                         {name: hits for name, (hits, dummy_self) in
+                          totals.items()})
+        self.assertEqual(totals['b(m)'], (2, 2))
+        self.assertEqual(totals['main(m)'], (4, 0))
+        self.assertEqual(first[0], ('main(m)', 3, 0))
+        self.assertEqual(len(recorder.function_totals(limit=2)), 2)
+
+    def test_render_scrape(self):
+        launcher = SimpleLauncher()
+        for name in ['main(m);a(m)', 'main(m);a(m)', 'main(m);"odd"(m)']:
+            launcher.sampler.my_db.record(FakeMeasurement(name))
+        hist = histograms.Histogram()
+        for value in [.001, .002, .5]:
+            hist.add(value)
+        families = exposition.collect_profile_families(launcher, top_n=2)
+        families.append(exposition.histogram_family(
+            'ox_profile_request_duration_seconds', 'Request durations.',
+            [({'endpoint': 'index'}, hist)], unit='seconds'))
+        data = scrape(exposition.render(families))
+
+        func = 'ox_profile_function_samples_total'
+        self.assertEqual(data[(func, (('function', 'main(m)'),))], 3)
+        self.assertEqual(data[(func, (('function', 'a(m)'),))], 2)
+        self.assertEqual(len([k for k in data if k[0] == func]), 2)
+        self.assertEqual(data[('ox_profile_recorder_stacks', ())], 2)
+        self.assertEqual(data[('ox_profile_paused', ())], 1)
+        req = 'ox_profile_request_duration_seconds'
+        self.assertEqual(data[(req + '_count', (('endpoint', 'index'),))], 3)
+        self.assertEqual(data[(req + '_bucket', (
+            ('endpoint', 'index'), ('le', '+Inf')))], 3)
+        self.assertAlmostEqual(
+            data[(req + '_sum', (('endpoint', 'index'),))], .503)
+
+
+if __name__ == '__main__':
+    unittest.main()
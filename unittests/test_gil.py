@@ -0,0 +1,87 @@
+import sys
+import threading
+import time
+import unittest
+
+from ox_profile.core import gil, recording, sampling
+
+
+def gil_spin_target(stop_event):
+    count = 0
+    while not stop_event.is_set():
+        count += 1
+
+
+def gil_sleep_target(stop_event):
+    while not stop_event.is_set():
+        time.sleep(.01)
+
+
+class GILEstimatorTestCase(unittest.TestCase):
+
+    def run_threads(self, target, num_threads=3, samples=150):
+        stop_event = threading.Event()
+        threads = [threading.Thread(target=target, args=(stop_event,))
+                   for dummy in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        try:
+            sampler = sampling.Sampler(recording.CountingRecorder(),
+                                       thread_filter=lambda t: t in set(
+                                           th.ident for th in threads))
+            estimator = sampler.enable_gil_estimation()
+            for dummy in range(samples):
+                sampler.run()
+                time.sleep(.002)
+        finally:
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+        return estimator.report()
+
+    def test_cpu_bound_threads_contend(self):
+        report = self.run_threads(gil_spin_target)
+        states = report['thread_states']
+        self.assertGreater(states.get('running', 0), 0)
+        self.assertGreater(states.get('stalled', 0), 0)
+        self.assertGreater(report['contention'], 0)
+        self.assertGreater(report['gil_utilization'], .5)
+        self.assertTrue(any('gil_spin_target' in name for name, dummy in
+                            report['waiting_stacks']))
+
+    def test_sleeping_threads_are_native(self):
+        report = self.run_threads(gil_sleep_target)
+        states = report['thread_states']
+        self.assertGreater(states.get('native', 0), 10 * (
+            states.get('running', 0) + states.get('stalled', 0)))
+        self.assertLess(report['gil_utilization'], .2)
+
+
+class FreeThreadedCaptureTestCase(unittest.TestCase):
+
+    def test_torn_stacks_are_skipped(self):
+        sampler = sampling.Sampler(recording.ShardedRecorder(shards=2),
+                                   freezer=sampling.NullFreezer())
+        sampler.tolerate_torn = True  # as if the GIL were disabled
+        good = sys._getframe()
+
+        class TornFrame(object):
+            @property
+            def f_code(self):
+                raise RuntimeError('frame changed')
+
+        info = sampler.record_frames([good, TornFrame()], ['tagged', None])
+        self.assertEqual((info.threads, sampler.torn_stacks), (1, 1))
+        query, dummy_total = sampler.query(re_filter='^tagged$')
+        self.assertEqual([i.hits for i in query], [1])
+
+    def test_defaults_follow_gil(self):
+        enabled = gil.is_enabled()
+        self.assertEqual(isinstance(sampling.make_freezer(),
+                                    sampling.Freezer), enabled)
+        self.assertEqual(isinstance(recording.make_recorder(),
+                                    recording.CountingRecorder), enabled)
+
+
+if __name__ == '__main__':
+    unittest.main()
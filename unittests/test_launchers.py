@@ -0,0 +1,155 @@
+import json
+import math
+import os
+import signal
+import sys
+import tempfile
+import types
+import unittest
+from time import sleep
+from unittest import mock
+
+from ox_profile.core import launchers, recording, sampling
+from ox_profile.core.launchers import SimpleLauncher, SignalLauncher
+
+
+def cpu_bound_function(count):
+    return sum(math.sqrt(i) for i in range(count))
+
+
+class SamplingTrackerTestCase(unittest.TestCase):
+
+    def test_metrics_track_overhead(self):
+        launcher = SimpleLauncher(interval=.001)
+        launcher.start()
+        launcher.unpause()
+        sleep(.5)
+        launcher.pause()
+        launcher.cancel()
+        launcher.unpause()
+        launcher.join(2)
+
+        metrics = launcher.metrics()
+        json.dumps(metrics)  # make sure it is machine readable
+        self.assertGreater(metrics['capture_time']['count'], 0)
+        self.assertEqual(metrics['capture_time']['count'],
+                         metrics['lock_wait']['count'])
+        self.assertGreater(metrics['capture_time']['mean'], 0)
+        self.assertGreater(metrics['frames_walked'], 0)
+        self.assertGreater(metrics['threads_per_capture'], 0)
+        self.assertGreater(metrics['recorder']['distinct_stacks'], 0)
+        self.assertGreater(metrics['recorder']['approx_bytes'], 0)
+
+        launcher.tracker.reset()
+        self.assertEqual(launcher.metrics()['capture_time']['count'], 0)
+
+
+@unittest.skipUnless(hasattr(signal, 'setitimer'), 'requires setitimer')
+class SignalLauncherTestCase(unittest.TestCase):
+
+    def test_signal_launcher_samples_main_thread(self):
+        launcher = SignalLauncher(interval=.001)
+        launcher.start()
+        launcher.unpause()
+        try:
+            for i in range(3000):
+                cpu_bound_function(i)
+        finally:
+            launcher.pause()
+            launcher.cancel()
+        launcher.join(2)
+        self.assertFalse(launcher.is_alive())
+        self.assertEqual(launcher.read_count, launcher.write_count)
+        query, total_records = launcher.query(max_records=None)
+        self.assertGreater(total_records, 0)
+        hits = [i.hits for i in query if i.name.startswith(
+            'cpu_bound_function')]
+        self.assertEqual(len(hits), 1)
+        self.assertGreater(hits[0], 10)
+
+    def test_unpause_before_start_does_not_arm_timer(self):
+        launcher = SignalLauncher(interval=.001, drain_interval=10)
+        launcher.unpause()
+        self.assertEqual(signal.getitimer(signal.ITIMER_PROF), (0.0, 0.0))
+        launcher.start()
+        try:
+            self.assertNotEqual(signal.getitimer(signal.ITIMER_PROF),
+                                (0.0, 0.0))
+            for i in range(3000):
+                cpu_bound_function(i)
+            launcher.pause()
+            saved = [launcher.buffer[i % launcher.buffer_size] for i in range(
+                launcher.read_count, launcher.write_count)]
+        finally:
+            launcher.pause()
+            launcher.cancel()
+        launcher.join(2)
+        self.assertGreater(len(saved), 0)
+        for item in saved[0]:  # no live frames kept in the buffer
+            self.assertNotIsInstance(item, types.FrameType)
+            self.assertNotIsInstance(item[0], types.FrameType)
+
+
+class RecordOnlyRecorder(object):
+    "Custom recorder which does not have record_many."
+
+    def __init__(self):
+        self.names = []
+
+    def record(self, measurement):
+        self.names.append(measurement.name)
+
+
+class CustomRecorderTestCase(unittest.TestCase):
+
+    def test_recorder_needs_only_record(self):
+        recorder = RecordOnlyRecorder()
+        sampler = sampling.Sampler(recorder)
+        info = sampler.record_frames([sys._getframe()] * 2)
+        self.assertEqual((info.threads, info.lock_wait), (2, 0.0))
+        self.assertEqual(len(recorder.names), 2)
+        self.assertTrue(recorder.names[0].endswith(
+            'test_recorder_needs_only_record(%s)' % __name__))
+
+
+class WatchdogLauncherTestCase(unittest.TestCase):
+
+    def check(self, launcher, now, cpu_time):
+        with mock.patch.object(launchers, 'process_cpu_time',
+                               return_value=cpu_time):
+            return launcher.check_cpu(now)
+
+    def test_capture_needs_sustained_usage_and_cools_down(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.object(launchers, 'process_cpu_time',
+                                   return_value=0.0):
+                launcher = launchers.WatchdogLauncher(
+                    threshold=.9, sustain=3, capture_seconds=5, cooldown=30,
+                    directory=directory)
+            launcher._cpu_prev = (0.0, 100.0)
+            self.assertEqual(self.check(launcher, 101, 1.0), 1.0)
+            self.assertAlmostEqual(self.check(launcher, 102, 1.2), .2)  # dip
+            self.check(launcher, 103, 2.2)
+            self.check(launcher, 104, 3.2)
+            self.assertIsNone(launcher.capture_sampler)
+            self.check(launcher, 105, 4.2)  # busy from 102 to 105
+            self.assertIsNotNone(launcher.capture_sampler)
+            launcher.capture_sampler()
+            self.check(launcher, 110, 9.2)
+            self.assertIsNone(launcher.capture_sampler)
+            capture = launcher.captures[0]
+            self.assertEqual(capture.end_time - capture.start_time, 5)
+            self.assertTrue(os.path.exists(capture.path))
+            with open(capture.path) as my_fd:
+                loaded = recording.CountingRecorder()
+                self.assertEqual(loaded.load(my_fd)['trigger'], 'cpu')
+            self.assertEqual(loaded.query()[1], capture.recorder.query()[1])
+            for now in range(111, 140, 3):  # busy but cooling down
+                self.check(launcher, now, now - 100.0)
+            self.assertIsNone(launcher.capture_sampler)
+            self.check(launcher, 142, 42.0)
+            self.assertIsNotNone(launcher.capture_sampler)
+
+
+if __name__ == '__main__':
+    unittest.main()
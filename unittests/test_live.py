@@ -0,0 +1,49 @@
+import json
+import unittest
+
+from ox_profile.core import live, recording
+from unittests.helpers import FakeMeasurement
+
+
+class LiveTopTestCase(unittest.TestCase):
+
+    def test_subscribers_share_producer(self):
+        recorder = recording.CountingRecorder()
+        top = live.LiveTop(recorder, interval=.05, top_n=5)
+        queues = [top.subscribe(), top.subscribe()]
+        producer = top.producer
+        recorder.record_many([FakeMeasurement('main;work')] * 3)
+        events = []
+        for my_queue in queues:
+            event = my_queue.get(timeout=1)
+            while not event['samples']:
+                event = my_queue.get(timeout=1)
+            events.append(event)
+        self.assertIs(events[0], events[1])
+        self.assertEqual(events[0]['self'], [['work', 3]])
+        self.assertIs(top.producer, producer)
+        for my_queue in queues:
+            top.unsubscribe(my_queue)
+        producer.join(1)
+        self.assertIsNone(top.producer)
+        self.assertEqual(recorder.deltas, {})  # stopped tracking deltas
+
+    def test_stream_yields_sse(self):
+        recorder = recording.CountingRecorder()
+        top = live.LiveTop(recorder, interval=.05)
+        stream = top.stream(timeout=1)
+        self.assertIn('"samples": 0', next(stream))
+        recorder.record_many([FakeMeasurement('main;work')])
+        text = next(stream)
+        while '"samples": 0' in text:
+            text = next(stream)
+        lines = text.rstrip('\n').split('\n')
+        self.assertEqual(lines[1], 'event: top')
+        data = json.loads(lines[2][len('data: '):])
+        self.assertEqual(data['inclusive'], [['main', 1], ['work', 1]])
+        stream.close()
+        self.assertEqual(top.subscribers, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
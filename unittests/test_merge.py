@@ -0,0 +1,64 @@
+import io
+import os
+import tempfile
+import unittest
+from collections import Counter
+
+from ox_profile import merge
+from ox_profile.core import recording
+
+
+def write_profile(path, stacks, **metadata):
+    recorder = recording.CountingRecorder()
+    recorder.load(io.StringIO(''.join(
+        '%s %i\n' % (name, hits) for name, hits in stacks.items())))
+    with open(path, 'w') as my_fd:
+        recorder.save(my_fd, metadata)
+
+
+class MergeTestCase(unittest.TestCase):
+
+    def test_merge_by_host(self):
+        expected = {'a': Counter(), 'b': Counter()}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = []
+            for index in range(6):
+                host = 'ab'[index % 2]
+                stacks = dict(('main(m);f%i(m)' % ((index + i) % 7), i + 1)
+                              for i in range(5))
+                expected[host].update(stacks)
+                paths.append(os.path.join(tmp_dir, 'p%i.folded' % index))
+                write_profile(paths[-1], stacks, host=host, release='1')
+            written = merge.merge_profiles(
+                paths, os.path.join(tmp_dir, 'merged.%(host)s.folded'),
+                group_by=['host'], jobs=2, run_size=2, fan_in=3)
+            self.assertEqual(len(written), 2)
+            for host in 'ab':
+                path = os.path.join(tmp_dir, 'merged.%s.folded' % host)
+                recorder = recording.CountingRecorder()
+                with open(path) as my_fd:
+                    metadata = recorder.load(my_fd)
+                self.assertEqual(dict(recorder.my_db), dict(expected[host]))
+                self.assertEqual(metadata['host'], host)
+                self.assertEqual(metadata['release'], '1')
+                self.assertEqual(metadata['merged_files'], '3')
+            self.assertEqual(sorted(os.listdir(tmp_dir)), sorted(
+                [os.path.basename(p) for p in paths] + [
+                    'merged.a.folded', 'merged.b.folded']))
+
+    def test_main_single_output(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [os.path.join(tmp_dir, name) for name in 'xy']
+            write_profile(paths[0], {'main;f': 2}, host='x')
+            write_profile(paths[1], {'main;f': 3, 'main;g': 1}, host='y')
+            output = os.path.join(tmp_dir, 'out.folded')
+            merge.main(['-j', '1', '-o', output] + paths)
+            recorder = recording.CountingRecorder()
+            with open(output) as my_fd:
+                metadata = recorder.load(my_fd)
+        self.assertEqual(dict(recorder.my_db), {'main;f': 5, 'main;g': 1})
+        self.assertNotIn('host', metadata)
+
+
+if __name__ == '__main__':
+    unittest.main()
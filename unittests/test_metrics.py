@@ -0,0 +1,109 @@
+import sys
+import types
+import unittest
+
+from ox_profile.core import metrics
+
+
+# Module with a fixed name (whatever the test runner calls this one and
+# whether or not its own frames are on the stack) for frames to drop or
+# collapse.
+frame_helpers = types.ModuleType('frame_helpers')
+exec(compile('''
+def helper_outer(callback, *args):
+    return helper_inner(callback, *args)
+
+def helper_inner(callback, *args):
+    return callback(*args)
+''', '<frame_helpers>', 'exec'), frame_helpers.__dict__)
+
+
+def level_three(frame_filter, cache):
+    return metrics.Measurement(sys._getframe(), cache=cache,
+                               frame_filter=frame_filter)
+
+
+def level_two(frame_filter, cache):
+    return frame_helpers.helper_outer(level_three, frame_filter, cache)
+
+
+def level_one(frame_filter, cache):
+    return level_two(frame_filter, cache)
+
+
+class FrameFilterTestCase(unittest.TestCase):
+
+    def check_both(self, frame_filter):
+        "Return name from cached and uncached measurement (must agree)."
+        cache = metrics.StackCache()
+        names = {level_one(frame_filter, cache).name,
+                 level_one(frame_filter, cache).name,
+                 level_one(frame_filter, None).name}
+        self.assertEqual(len(names), 1, names)
+        return names.pop()
+
+    def test_no_filter(self):
+        name = self.check_both(None)
+        self.assertTrue(name.endswith(
+            'level_one(%s);level_two(%s);helper_outer(frame_helpers);'
+            'helper_inner(frame_helpers);level_three(%s)' % (
+                (__name__,) * 3)))
+
+    def test_max_depth(self):
+        name = self.check_both(metrics.FrameFilter(max_depth=2))
+        self.assertEqual(name, 'helper_inner(frame_helpers);level_three(%s)'
+                         % __name__)
+
+    def test_drop_modules(self):
+        name = self.check_both(metrics.FrameFilter(
+            drop_modules=['^frame_helpers$']))
+        self.assertTrue(name.endswith(
+            ';test_drop_modules(%s);check_both(%s);level_one(%s);'
+            'level_two(%s);level_three(%s)' % ((__name__,) * 5)), name)
+        self.assertNotIn('frame_helpers', name)
+
+    def test_collapse_packages(self):
+        name = self.check_both(metrics.FrameFilter(
+            collapse_packages=['frame_helpers']))
+        self.assertTrue(name.endswith(
+            ';level_one(%s);level_two(%s);...(frame_helpers);level_three(%s)'
+            % ((__name__,) * 3)), name)
+        self.assertEqual(name.count('frame_helpers'), 1)
+
+    def test_drop_everything_keeps_top(self):
+        name = self.check_both(metrics.FrameFilter(drop_modules=['.*']))
+        self.assertEqual(name, 'level_three(%s)' % __name__)
+
+
+def recurse(depth, cache):
+    if depth:
+        return recurse(depth - 1, cache)
+    frame = sys._getframe()
+    return (metrics.Measurement(frame, cache=cache).name,
+            metrics.Measurement(frame).name)
+
+
+class StackCacheTestCase(unittest.TestCase):
+
+    def test_reused_frames_get_right_prefix(self):
+        # Frames freed by one call are reused at the same addresses (with
+        # the same code and offsets) by the next call at another depth.
+        cache = metrics.StackCache()
+        depths = list(range(16, 0, -1)) + list(range(17))
+        for dummy in range(5):
+            for depth in depths:
+                cached, uncached = recurse(depth, cache)
+                self.assertEqual(cached, uncached)
+
+    def test_live_stack_hits(self):
+        cache = metrics.StackCache()
+        frame = sys._getframe()
+        first, second = [metrics.Measurement(frame, cache=cache)
+                         for dummy in range(2)]
+        self.assertEqual(first.name, second.name)
+        self.assertEqual(second.depth, 0)  # found top frame in cache
+        self.assertEqual(cache.hits, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+import asyncio
+import io
+import os
+import subprocess
+import sys
+import threading
+import unittest
+from wsgiref.util import FileWrapper
+
+from ox_profile.core import exposition, recording, sampling
+from ox_profile import middleware
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    middleware.__file__)))
+
+
+def start_response(status, headers, exc_info=None):
+    return lambda data: None
+
+
+def wsgi_app(environ, start_response):
+    if environ['PATH_INFO'] == '/fail':
+        raise ValueError('failed')
+    if environ['PATH_INFO'] == '/missing':
+        start_response('500 Internal Server Error', [])
+        return [b'oops']
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return iter([b'hello ', b'world'])
+
+
+def environ(path, method='GET'):
+    return {'REQUEST_METHOD': method, 'PATH_INFO': path}
+
+
+class WSGIMiddlewareTestCase(unittest.TestCase):
+
+    def test_counts_requests_and_errors(self):
+        wrapped = middleware.WSGIMiddleware(wsgi_app)
+        for path in ['/ok', '/ok', '/missing']:
+            body = wrapped(environ(path), start_response)
+            self.assertTrue(b''.join(body))
+            body.close()
+            body.close()  # closing twice must not record twice
+        with self.assertRaises(ValueError):
+            wrapped(environ('/fail'), start_response)
+        info = wrapped.stats.snapshot()
+        self.assertEqual(info['GET /ok']['count'], 2)
+        self.assertEqual(info['GET /ok']['errors'], 0)
+        self.assertEqual(info['GET /missing']['errors'], 1)
+        self.assertEqual(info['GET /fail']['errors'], 1)
+        text = exposition.render(wrapped.stats.families())
+        self.assertIn('ox_profile_request_duration_seconds_count{'
+                      'endpoint="GET /ok"} 2', text)
+        self.assertIn('ox_profile_request_errors_total{'
+                      'endpoint="GET /fail"} 1', text)
+
+    def test_tags_thread_for_sampler(self):
+        sampler = sampling.Sampler(recording.CountingRecorder())
+        tags = sampler.enable_thread_tags()
+        started, release = threading.Event(), threading.Event()
+
+        def slow_app(environ, start_response):
+            start_response('200 OK', [])
+            started.set()
+            release.wait(5)
+            return [b'done']
+
+        wrapped = middleware.WSGIMiddleware(slow_app, tags=tags)
+        worker = threading.Thread(target=lambda: wrapped(
+            environ('/slow'), start_response).close())
+        worker.start()
+        started.wait(5)
+        sampler.run()
+        release.set()
+        worker.join()
+        self.assertEqual(tags, {})
+        query, dummy_total = sampler.query(
+            re_filter='request', max_records=None)
+        self.assertEqual([i.name for i in query], ['request(GET /slow)'])
+
+    def test_endpoint_limit(self):
+        stats = middleware.RequestStats(max_endpoints=2)
+        wrapped = middleware.WSGIMiddleware(wsgi_app, stats=stats)
+        for num in range(5):
+            wrapped(environ('/ok/%i' % num), start_response).close()
+        self.assertEqual(sorted(stats.snapshot()),
+                         ['GET /ok/0', 'GET /ok/1', 'other'])
+        self.assertEqual(stats.snapshot()['other']['count'], 3)
+
+    def test_keeps_length_and_file_wrapper(self):
+        wrapped = middleware.WSGIMiddleware(wsgi_app)
+        body = wrapped(environ('/missing'), start_response)
+        self.assertEqual(len(body), 1)  # server can set Content-Length
+        body.close()
+        with self.assertRaises(TypeError):
+            len(wrapped(environ('/ok'), start_response))
+
+        def file_app(environ, start_response):
+            start_response('200 OK', [])
+            return environ['wsgi.file_wrapper'](io.BytesIO(b'data'))
+
+        wrapped = middleware.WSGIMiddleware(file_app)
+        env = dict(environ('/file'), **{'wsgi.file_wrapper': FileWrapper})
+        body = wrapped(env, start_response)
+        self.assertIsInstance(body, FileWrapper)  # server can use sendfile
+        self.assertEqual(b''.join(body), b'data')
+        self.assertNotIn('GET /file', wrapped.stats.snapshot())
+        body.close()
+        self.assertEqual(wrapped.stats.snapshot()['GET /file']['count'], 1)
+
+
+class ASGIMiddlewareTestCase(unittest.TestCase):
+
+    @staticmethod
+    async def asgi_app(scope, receive, send):
+        if scope['path'] == '/fail':
+            raise ValueError('failed')
+        await send({'type': 'http.response.start',
+                    'status': 503 if scope['path'] == '/busy' else 200,
+                    'headers': []})
+        await send({'type': 'http.response.body', 'body': b'hi'})
+
+    def call(self, wrapped, path, kind='http'):
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request'}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(wrapped({'type': kind, 'method': 'GET', 'path': path},
+                            receive, send))
+        return sent
+
+    def test_counts_requests_and_errors(self):
+        wrapped = middleware.ASGIMiddleware(self.asgi_app)
+        self.assertEqual(len(self.call(wrapped, '/ok')), 2)
+        self.call(wrapped, '/busy')
+        self.call(wrapped, '/ok', kind='websocket')  # not timed
+        with self.assertRaises(ValueError):
+            self.call(wrapped, '/fail')
+        info = wrapped.stats.snapshot()
+        self.assertEqual(sorted(info), ['GET /busy', 'GET /fail', 'GET /ok'])
+        self.assertEqual(info['GET /ok']['count'], 1)
+        self.assertEqual(info['GET /ok']['errors'], 0)
+        self.assertEqual(info['GET /busy']['errors'], 1)
+        self.assertEqual(info['GET /fail']['errors'], 1)
+
+
+class SamplingTestCase(unittest.TestCase):
+
+    def test_every_n_scales_counts(self):
+        stats = middleware.RequestStats()
+        wrapped = middleware.WSGIMiddleware(
+            wsgi_app, stats=stats, sampler=middleware.RequestSampler(every=4))
+        for dummy in range(20):
+            body = wrapped(environ('/ok'), start_response)
+            if hasattr(body, 'close'):  # skipped requests are not wrapped
+                body.close()
+        self.assertEqual(stats.snapshot()['GET /ok']['count'], 20)
+        self.assertEqual(stats.endpoints['GET /ok'].hist.count, 20)
+
+    def test_probability_estimate(self):
+        sampler = middleware.RequestSampler(probability=.25)
+        total = sum(sampler.weight() for dummy in range(20000))
+        self.assertAlmostEqual(total / 20000.0, 1.0, delta=.1)
+        with self.assertRaises(ValueError):
+            middleware.RequestSampler(probability=0)
+
+    def test_thread_buffers_lose_nothing(self):
+        merged = []
+        buffers = middleware.ThreadBuffers(merged.extend, flush_size=7)
+
+        def add_items(start):
+            for num in range(start, start + 1000):
+                buffers.add(num)
+
+        workers = [threading.Thread(target=add_items, args=(i * 1000,))
+                   for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for dummy in range(20):
+            buffers.flush()  # flush while workers are adding
+        for worker in workers:
+            worker.join()
+        buffers.flush()
+        self.assertEqual(sorted(merged), list(range(4000)))
+        self.assertEqual(buffers.buffers, [])
+
+
+class ImportTestCase(unittest.TestCase):
+
+    def test_import_is_light(self):
+        code = ('import sys, ox_profile.middleware; print(sorted(set(['
+                '"flask", "numpy", "doctest", "ox_profile.core.sampling"])'
+                ' & set(sys.modules)))')
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=TOP_DIR)
+        self.assertEqual(output.strip(), b'[]')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+import io
+import random
+import threading
+import unittest
+from collections import Counter
+from unittest import mock
+
+from ox_profile.core import recording
+from unittests.helpers import FakeMeasurement
+
+
+def brute_force_query(recorder, regexp):
+    counter = Counter()
+    for name, hits in recorder.my_db.items():
+        for fname in name.split(';'):
+            if regexp is None or regexp.search(fname):
+                counter[fname] += hits
+    return dict(counter)
+
+
+class QueryCacheTestCase(unittest.TestCase):
+
+    def test_incremental_query_matches_full(self):
+        my_rand = random.Random(7)
+        funcs = ['f%i' % i for i in range(30)]
+        recorder = recording.CountingRecorder()
+        recorder.max_journal = 50  # force some full recomputes
+        filters = ['.*', '^f1', '[25]$']
+        for dummy_round in range(40):
+            recorder.record_many([FakeMeasurement(';'.join(
+                my_rand.sample(funcs, my_rand.randint(1, 6))))
+                                  for dummy in range(my_rand.randint(0, 30))])
+            for re_filter in filters:
+                query, num_records = recorder.query(re_filter, None)
+                tally = recording._FilterTally(re_filter)
+                self.assertEqual(
+                    dict((i.name, i.hits) for i in query),
+                    brute_force_query(recorder, tally.regexp))
+                self.assertEqual(num_records, len(recorder.my_db))
+
+    def test_journal_is_bounded_without_queries(self):
+        recorder = recording.CountingRecorder()
+        recorder.max_journal = 10
+        recorder.record(FakeMeasurement('main;work'))
+        recorder.query()  # starts the journal
+        for dummy in range(25):
+            recorder.record(FakeMeasurement('main;work'))
+            self.assertLessEqual(len(recorder.journal or []), 10)
+        recorder.record_many([FakeMeasurement('main;idle')] * 25)
+        self.assertIsNone(recorder.journal)
+        self.assertEqual([(i.name, i.hits) for i in recorder.query()[0]],
+                         [('main', 51), ('work', 26), ('idle', 25)])
+
+    def test_load_invalidates_cache(self):
+        recorder = recording.CountingRecorder()
+        recorder.record(FakeMeasurement('main;work'))
+        self.assertEqual(recorder.query()[0][0].hits, 1)
+        recorder.load(io.StringIO('main;work 5\n'))
+        self.assertEqual([(i.name, i.hits) for i in recorder.query()[0]],
+                         [('main', 6), ('work', 6)])
+
+    def test_filter_cache_is_bounded(self):
+        recorder = recording.CountingRecorder()
+        recorder.max_cached_filters = 3
+        recorder.record(FakeMeasurement('main;work'))
+        for re_filter in ['a', 'b', 'c', 'd']:
+            recorder.query(re_filter)
+        self.assertEqual(list(recorder.query_cache), ['b', 'c', 'd'])
+
+    def test_top_cache_is_bounded(self):
+        recorder = recording.CountingRecorder()
+        recorder.record_many([FakeMeasurement('main;f%i' % i)
+                              for i in range(20) for dummy in range(i)])
+        expected, dummy = recorder.query(max_records=None)
+        for limit in [5, 3, 12, 100, None, 7]:
+            query, dummy = recorder.query(max_records=limit)
+            self.assertEqual([(i.name, i.hits) for i in query],
+                             [(i.name, i.hits) for i in expected[:limit]])
+        tally = recorder.query_cache['.*']
+        self.assertEqual(tally.top_hits[:2], (tally.generation, None))
+
+    def test_delta_consumers_are_bounded(self):
+        recorder = recording.CountingRecorder()
+        recorder.max_delta_consumers = 2
+        for consumer in ['a', 'b']:
+            recorder.take_function_deltas(consumer)
+        recorder.record(FakeMeasurement('main;work'))
+        self.assertEqual(recorder.take_function_deltas('a')[1],
+                         Counter(work=1))
+        recorder.take_function_deltas('c')  # forgets b (the oldest)
+        self.assertEqual(list(recorder.deltas), ['a', 'c'])
+        recorder.drop_function_deltas('a')
+        self.assertEqual(list(recorder.deltas), ['c'])
+
+
+class TimeSeriesTestCase(unittest.TestCase):
+
+    def test_recorder_feeds_series(self):
+        recorder = recording.CountingRecorder()
+        recorder.record(FakeMeasurement('main;before'))
+        self.assertIsNone(recorder.series_report())
+        series = recorder.enable_time_series(levels=[(1, 10), (60, 5)])
+        self.assertIs(series, recorder.enable_time_series())
+        recorder.record_many([FakeMeasurement('main;work')] * 3)
+        report = recorder.series_report(resolution=1)
+        self.assertEqual(sum(hits for dummy, hits in report['total']), 3)
+        functions = dict(report['functions'])
+        self.assertEqual(sorted(functions), ['main', 'work'])
+        self.assertEqual(sum(hits for dummy, hits in functions['work']), 3)
+        self.assertEqual(len(recorder.series_report(60)['total']), 5)
+        with self.assertRaises(ValueError):
+            recorder.series_report(resolution=7)
+
+    def test_series_prunes_functions(self):
+        recorder = recording.CountingRecorder()
+        series = recorder.enable_time_series(max_functions=4)
+        recorder.record_many([FakeMeasurement('main;f%i' % i)
+                              for i in range(10) for dummy in range(i)])
+        recorder.series_report()
+        self.assertLessEqual(len(series.functions), 5)
+        self.assertIn('f9', series.functions)
+
+    def test_hits_go_in_second_recorded(self):
+        clock = [1000.0]
+        with mock.patch.object(recording.time, 'time',
+                               side_effect=lambda: clock[0]):
+            recorder = recording.CountingRecorder()
+            recorder.enable_time_series(levels=[(1, 10)])
+            for when in [1000.2, 1000.5, 1005.1]:
+                clock[0] = when
+                recorder.record(FakeMeasurement('main;work'))
+            clock[0] = 1005.9
+            report = recorder.series_report(resolution=1)
+        self.assertEqual([item for item in report['total'] if item[0] >= 999],
+                         [(999, 0), (1000, 2), (1001, 0), (1002, 0),
+                          (1003, 0), (1004, 0), (1005, 1)])
+
+
+class ShardedRecorderTestCase(unittest.TestCase):
+
+    def make_names(self, count, seed=3):
+        my_rand = random.Random(seed)
+        funcs = ['f%i' % i for i in range(20)]
+        return [';'.join(my_rand.sample(funcs, my_rand.randint(1, 5)))
+                for dummy in range(count)]
+
+    def test_matches_counting_recorder(self):
+        plain = recording.CountingRecorder()
+        sharded = recording.ShardedRecorder(shards=8)
+        for recorder in [plain, sharded]:
+            names = self.make_names(500)
+            recorder.record_many([FakeMeasurement(n) for n in names[:400]])
+            for name in names[400:]:
+                recorder.record(FakeMeasurement(name))
+        for re_filter in ['.*', '^f1', '[25]$']:
+            expected, count = plain.query(re_filter, None)
+            result, sharded_count = sharded.query(re_filter, None)
+            self.assertEqual(count, sharded_count)
+            self.assertEqual(sorted((i.name, i.hits) for i in expected),
+                             sorted((i.name, i.hits) for i in result))
+        self.assertEqual(sorted(plain.function_totals()),
+                         sorted(sharded.function_totals()))
+        self.assertEqual(dict(plain.my_db), dict(sharded.my_db))
+        my_fd = io.StringIO()
+        sharded.save(my_fd)
+        sharded.reset()
+        self.assertEqual(sharded.query()[1], 0)
+        my_fd.seek(0)
+        sharded.load(my_fd)
+        self.assertEqual(sorted(plain.stacks()), sorted(sharded.stacks()))
+        self.assertIn('f1', sharded.show())
+
+    def test_concurrent_writers(self):
+        sharded = recording.ShardedRecorder(shards=4)
+        names = self.make_names(200)
+
+        def write():
+            for start in range(0, len(names), 10):
+                sharded.record_many([FakeMeasurement(n)
+                                     for n in names[start:start + 10]])
+
+        workers = [threading.Thread(target=write) for dummy in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(sum(sharded.my_db.values()), 800)
+        self.assertEqual(sharded.size_info()['hits'], 800)
+
+    def test_time_series(self):
+        sharded = recording.ShardedRecorder(shards=4)
+        series = sharded.enable_time_series(levels=[(1, 10)])
+        sharded.record_many([FakeMeasurement('main;work')] * 3)
+        report = sharded.series_report(resolution=1)
+        self.assertIs(series, sharded.series)
+        self.assertEqual(sum(hits for dummy, hits in report['total']), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
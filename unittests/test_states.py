@@ -0,0 +1,90 @@
+import dis
+import sys
+import threading
+import time
+import unittest
+
+from ox_profile.core import recording, sampling, states
+from unittests.helpers import FakeMeasurement
+
+
+def classify_caller(dummy):
+    return states.classify(sys._getframe(1))
+
+
+def nap(ready, release):
+    ready.set()
+    while not release.is_set():
+        time.sleep(.01)
+
+
+class ClassifyTestCase(unittest.TestCase):
+
+    def test_classify(self):
+        self.assertEqual(states.classify(sys._getframe()), states.PYTHON)
+        # map is a C function so our frame is at the call to list(...)
+        self.assertEqual(list(map(classify_caller, [1])), [states.NATIVE])
+        self.assertEqual(states.split_state('a;b;[blocked]'),
+                         ('a;b', states.BLOCKED))
+        self.assertEqual(states.split_state('a;b'), ('a;b', states.PYTHON))
+
+    @unittest.skipIf(sys.version_info < (3, 11), 'needs co_positions')
+    def test_callee_name(self):
+        def fetch(sock, json):
+            return json.loads(sock.recv(10))
+
+        calls = [inst for inst in dis.get_instructions(fetch)
+                 if inst.opname in ('CALL', 'CALL_FUNCTION', 'CALL_METHOD')]
+        self.assertEqual([states.callee_name(fetch.__code__, inst.offset)
+                          for inst in calls], ['recv', 'loads'])
+
+    def test_sampler_labels_blocked_thread(self):
+        for recorder in [recording.CountingRecorder(),
+                         recording.ShardedRecorder(shards=2)]:
+            sampler = sampling.Sampler(recorder)
+            sampler.enable_state_labels()
+            ready, release = threading.Event(), threading.Event()
+            worker = threading.Thread(target=nap, args=(ready, release))
+            worker.start()
+            ready.wait(5)
+            time.sleep(.05)
+            for dummy in range(5):
+                sampler.run()
+            release.set()
+            worker.join()
+            records, totals = recorder.query_states(re_filter='^nap')
+            self.assertEqual(len(records), 1)
+            self.assertEqual(records[0].blocked, records[0].hits)
+            self.assertGreater(totals[states.BLOCKED], 0)
+            text = recorder.show_states(re_filter='^nap')
+            self.assertIn('100.0', text.splitlines()[-1])
+            query, dummy = recorder.query(max_records=None)
+            self.assertNotIn('[blocked]', [i.name for i in query])
+            self.assertEqual([i.hits for i in query if i.name.startswith(
+                'nap(')], [records[0].hits])
+
+    def test_states_do_not_change_stacks(self):
+        stacks = [('main;parse', states.NATIVE), ('main;parse', None),
+                  ('main;fetch', states.BLOCKED), ('main;fetch', None)]
+        labelled, plain = [], []
+        for name, state in stacks:
+            plain.append(FakeMeasurement(name))
+            labelled.append(FakeMeasurement(name, state))
+        for recorder_class in [recording.CountingRecorder,
+                               recording.ShardedRecorder]:
+            results = []
+            for measurements in [plain, labelled]:
+                recorder = recorder_class()
+                recorder.record_many(measurements)
+                recorder.record(measurements[0])
+                query, total = recorder.query(max_records=None)
+                results.append(([(i.name, i.hits) for i in query], total,
+                                recorder.function_totals(),
+                                sorted(recorder.stacks())))
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(recorder.query_states()[1], {
+                states.PYTHON: 2, states.NATIVE: 2, states.BLOCKED: 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
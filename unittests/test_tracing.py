@@ -0,0 +1,122 @@
+import sys
+import threading
+import time
+import unittest
+
+from ox_profile.core import tracing
+
+
+def fast(value):
+    return value + 1
+
+
+def fails():
+    raise KeyError('fails')
+
+
+def recurse(depth):
+    return recurse(depth - 1) if depth else 0
+
+
+class Widget(object):
+
+    def fast(self):
+        return 2
+
+
+def counter():
+    yield 1
+
+
+class FunctionTracerTestCase(unittest.TestCase):
+
+    def test_counts_calls_until_stopped(self):
+        tracer = tracing.FunctionTracer(fast, max_calls=None,
+                                        max_seconds=10).start()
+        for num in range(500):
+            fast(num)
+        Widget().fast()  # same name but different function
+        tracer.stop()
+        fast(0)  # after stop so not counted
+        info = tracer.report()
+        self.assertEqual(info['calls'], 500)
+        self.assertEqual(info['count'], 500)
+        self.assertFalse(info['active'])
+        self.assertTrue(tracer.wait(0))
+        self.assertIsNone(sys.getprofile())
+
+    def test_exceptions_and_recursion(self):
+        tracer = tracing.FunctionTracer(fails, max_calls=2).start()
+        for dummy in range(2):
+            with self.assertRaises(KeyError):
+                fails()
+        self.assertEqual((tracer.calls, tracer.active), (2, False))
+        tracer = tracing.FunctionTracer(recurse, max_calls=5).start()
+        recurse(4)
+        self.assertEqual((tracer.calls, tracer.active), (5, False))
+
+    def test_time_limit(self):
+        tracer = tracing.FunctionTracer(fast, max_calls=None,
+                                        max_seconds=.05).start()
+        self.assertTrue(tracer.wait(5))
+        self.assertFalse(tracer.active)
+        fast(1)
+        self.assertEqual(tracer.calls, 0)
+
+    def test_new_threads_and_labels(self):
+        tracer = tracing.FunctionTracer('fast(%s)' % __name__,
+                                        max_calls=None).start()
+        self.addCleanup(tracer.stop)
+        self.assertEqual(tracer.codes, {fast.__code__, Widget.fast.__code__})
+        worker = threading.Thread(target=lambda: [fast(i) for i in range(7)])
+        worker.start()
+        worker.join()
+        tracer.stop()
+        self.assertEqual(tracer.calls, 7)
+
+    def test_setprofile_fallback_threads(self):
+        started, release = threading.Event(), threading.Event()
+
+        def call_fast_later():
+            started.set()
+            release.wait(5)
+            fast(0)  # thread existed before the trace so not counted
+
+        existing = threading.Thread(target=call_fast_later)
+        existing.start()
+        started.wait(5)
+        for this_thread, expected in [(True, 3 + 7), (False, 7)]:
+            tracer = tracing.FunctionTracer(
+                fast, max_calls=None, use_monitoring=False,
+                this_thread=this_thread).start()
+            self.addCleanup(tracer.stop)
+            for num in range(3):
+                fast(num)
+            worker = threading.Thread(
+                target=lambda: [fast(i) for i in range(7)])
+            worker.start()
+            worker.join()
+            if this_thread:
+                release.set()
+                existing.join()
+            tracer.stop()
+            self.assertEqual(tracer.calls, expected)
+            self.assertEqual(tracer.report()['threads'], (
+                'this thread and new threads' if this_thread else (
+                    'new threads only')))
+            self.assertIsNone(sys.getprofile())
+
+    def test_bad_targets(self):
+        for target in ['no_such_function(nowhere)', counter, len]:
+            with self.assertRaises(ValueError):
+                tracing.FunctionTracer(target)
+        tracer = tracing.FunctionTracer(fast).start()
+        try:
+            with self.assertRaises(RuntimeError):
+                tracing.FunctionTracer(Widget.fast).start()
+        finally:
+            tracer.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()